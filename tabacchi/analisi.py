@@ -0,0 +1,180 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import itertools
+import threading
+import time
+
+import numpy as np
+
+from . import archivio
+from .config import log
+from .preferencesTabacchi import prefs
+
+# Storico degli ordini caricato una sola volta in matrici dense articoli x ordini
+# (ordini in ordine di data), interrogate con operazioni vettoriali da statistiche e previsioni.
+
+
+class Storico:
+    def __init__(self, articoli, idOrdini, date, ordine, giacenza, consumo, presente):
+        self.articoli = articoli        # ID articoli (righe delle matrici), ordinati
+        self.idOrdini = idOrdini        # ID ordini (colonne), in ordine di data
+        self.date = date                # Date degli ordini (datetime64[s])
+        self.ordine = ordine
+        self.giacenza = giacenza
+        self.consumo = consumo
+        self.presente = presente        # True se l'articolo ha una riga nell'ordine
+        self.prezzi = None              # Prezzi alle date degli ordini, caricati da getPrezzi
+        self.indiceArticoli = {idArt: i for i, idArt in enumerate(articoli.tolist())}
+        self.indiceOrdini = {idOrdine: j for j, idOrdine in enumerate(idOrdini.tolist())}
+
+    # Colonne degli ordini con data nel periodo [dataInizio, dataFine) ('%Y-%m-%d')
+    def colonne(self, dataInizio, dataFine):
+        inizio = np.searchsorted(self.date, np.datetime64(dataInizio, 's'), side='left')
+        fine = np.searchsorted(self.date, np.datetime64(dataFine, 's'), side='left')
+        return slice(inizio, fine)
+
+    # Righe dell'articolo nel periodo: (date, consumo, ordine, giacenza).
+    # Ritorna None se l'articolo non ha mai avuto righe
+    def serieArticolo(self, idArt, dataInizio, dataFine):
+        i = self.indiceArticoli.get(idArt)
+        if i is None:
+            return None
+        periodo = self.colonne(dataInizio, dataFine)
+        presente = self.presente[i, periodo]
+        return (self.date[periodo][presente], self.consumo[i, periodo][presente],
+                self.ordine[i, periodo][presente], self.giacenza[i, periodo][presente])
+
+    # Totali per ordine nel periodo delle righe con almeno un valore positivo: (date, consumo, ordine, giacenza)
+    def totaliOrdini(self, dataInizio, dataFine):
+        periodo = self.colonne(dataInizio, dataFine)
+        consumo = self.consumo[:, periodo]
+        ordine = self.ordine[:, periodo]
+        giacenza = self.giacenza[:, periodo]
+        attive = (consumo > 0) | (giacenza > 0) | (ordine > 0)
+        ordini = attive.any(axis=0)
+        return (self.date[periodo][ordini],
+                np.where(attive, consumo, 0).sum(axis=0)[ordini],
+                np.where(attive, ordine, 0).sum(axis=0)[ordini],
+                np.where(attive, giacenza, 0).sum(axis=0)[ordini])
+
+    # Acquisti per articolo nel periodo, in ordine decrescente di peso: (articoli, totale, data ultimo acquisto)
+    def acquisti(self, dataInizio, dataFine):
+        periodo = self.colonne(dataInizio, dataFine)
+        ordine = self.ordine[:, periodo]
+        acquistato = ordine > 0
+        righe = np.flatnonzero(acquistato.any(axis=1))
+        totale = np.where(acquistato[righe], ordine[righe], 0).sum(axis=1)
+        ordinamento = np.argsort(-totale, kind='stable')
+        righe, totale = righe[ordinamento], totale[ordinamento]
+        if len(righe) == 0:
+            return (self.articoli[righe], totale, self.date[:0])
+        # Indice dell'ultima colonna con un acquisto (argmax sulle colonne invertite)
+        ultimo = ordine.shape[1] - 1 - np.argmax(acquistato[righe, ::-1], axis=1)
+        return (self.articoli[righe], totale, self.date[periodo][ultimo])
+
+
+# Carica lo storico dalle tabelle (o viste sull'archivio) indicate
+def carica(conn, ordini="ordineTabacchi", righe="rigaOrdineTabacchi"):
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        testate = cursor.execute(f"SELECT ID, Data FROM {ordini} ORDER BY Data").fetchall()
+        rows = cursor.execute(f"SELECT ID, ID_Ordine, Ordine, Giacenza, Consumo FROM {righe}").fetchall()
+    finally:
+        cursor.close()
+
+    idOrdini = np.array([row[0] for row in testate], dtype=np.int64)
+    date = np.array([row[1] for row in testate], dtype='datetime64[s]')
+    if not testate:
+        rows = []
+    ids, righeOrdini, ordine, giacenza, consumo = zip(*rows) if rows else ((), (), (), (), ())
+    articoli, i = np.unique(np.array(ids, dtype=str), return_inverse=True)
+
+    # Colonna di ogni riga: posizione del suo ordine tra quelli ordinati per data
+    # (le righe senza ordine vengono scartate)
+    righeOrdini = np.array(righeOrdini, dtype=np.int64)
+    sorter = np.argsort(idOrdini)
+    pos = np.searchsorted(idOrdini, righeOrdini, sorter=sorter).clip(0, max(len(idOrdini) - 1, 0))
+    j = sorter[pos] if rows else pos
+    valide = (idOrdini[j] == righeOrdini)
+    i, j = i[valide], j[valide]
+
+    shape = (len(articoli), len(idOrdini))
+    matrici = []
+    for valori in (ordine, giacenza, consumo):
+        matrice = np.zeros(shape)
+        matrice[i, j] = np.array(valori, dtype=float)[valide]
+        matrici.append(matrice)
+    presente = np.zeros(shape, dtype=bool)
+    presente[i, j] = True
+
+    log.debug(f"[analisi] caricate {len(rows)} righe ({shape[0]} articoli x {shape[1]} ordini) in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return Storico(articoli, idOrdini, date, matrici[0], matrici[1], matrici[2], presente)
+
+
+# Storico in cache per (tabelle, versione dei dati): ricaricato solo dopo una modifica del DB
+__cache = {}
+__lock = threading.Lock()
+
+
+# Ritorna lo storico che comprende il periodo da dataInizio ('%Y-%m-%d') in poi
+# (con gli ordini archiviati solo se servono)
+def getStorico(dataInizio=""):
+    conn = None
+    try:
+        conn = prefs.getRawConn()
+        tabelle = archivio.tabelle(conn, dataInizio)
+        with __lock:
+            versione = prefs.dataVersion
+            cached = __cache.get(tabelle)
+            if cached and (cached[0] == versione):
+                return cached[1]
+            storico = carica(conn, *tabelle)
+            __cache.clear()
+            __cache[tabelle] = (versione, storico)
+            return storico
+    finally:
+        if conn:
+            archivio.detach(conn)
+            conn.close()
+
+
+# Prezzo al kg di ogni articolo alla data di ogni ordine, dallo storico dei prezzi (NaN se l'articolo
+# non ha prezzi registrati). Prima della prima decorrenza registrata vale il primo prezzo.
+def caricaPrezzi(conn, storico):
+    cursor = conn.cursor()
+    try:
+        # Le decorrenze non valide (default '0000-00-00') valgono dall'inizio
+        rows = cursor.execute("SELECT ID, CASE WHEN Decorrenza < '1970-01-01' THEN '1970-01-01' ELSE substr(Decorrenza, 1, 10) END, PrezzoKg "
+                              "FROM prezziStorico ORDER BY ID, Decorrenza").fetchall()
+    finally:
+        cursor.close()
+
+    prezzi = np.full(storico.ordine.shape, np.nan)
+    giorni = storico.date.astype('datetime64[D]')
+    for idArt, gruppo in itertools.groupby(rows, key=lambda row: row[0]):
+        i = storico.indiceArticoli.get(idArt)
+        if i is None:
+            continue
+        gruppo = list(gruppo)
+        decorrenze = np.array([row[1] for row in gruppo], dtype='datetime64[D]')
+        valori = np.array([row[2] for row in gruppo], dtype=float)
+        # Ultima decorrenza non successiva alla data dell'ordine
+        k = np.searchsorted(decorrenze, giorni, side='right') - 1
+        prezzi[i] = valori[k.clip(min=0)]
+    return prezzi
+
+
+# Ritorna i prezzi per lo storico, caricati una sola volta per ogni storico in cache
+# (una modifica del catalogo aggiorna anche la versione dei dati)
+def getPrezzi(storico):
+    with __lock:
+        if storico.prezzi is None:
+            conn = prefs.getRawConn()
+            try:
+                storico.prezzi = caricaPrezzi(conn, storico)
+            finally:
+                conn.close()
+        return storico.prezzi
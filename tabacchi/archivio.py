@@ -0,0 +1,156 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import sqlite3
+import gi
+
+from . import config
+from .config import log
+from .preferencesTabacchi import prefs
+from . import utility
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib  # noqa: E402
+
+# Gli ordini più vecchi dell'orizzonte impostato nelle preferenze vengono spostati
+# in un DB separato, collegato con ATTACH solo quando serve (statistiche su periodi lunghi)
+ARCHIVE_PATHNAME = config.user_data_dir / f'{config.PACKAGE_NAME}_archive.sqlite'
+SCHEMA_NAME = "archivio"
+
+# Tabelle dell'archivio: stesse colonne del DB principale, senza trigger e AUTOINCREMENT
+ARCHIVE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS archivio.ordineTabacchi (ID INTEGER NOT NULL PRIMARY KEY, Data DATETIME NOT NULL, LastPos INTEGER NOT NULL DEFAULT (0), DataSuppletivo DATE DEFAULT NULL, Stato INTEGER NOT NULL DEFAULT (0), Levata DATE DEFAULT NULL, Suppletivo BOOLEAN NOT NULL DEFAULT (0), ID_Precedente INTEGER DEFAULT NULL, ID_Successivo INTEGER DEFAULT NULL, UNIQUE (Data));",
+    "CREATE TABLE IF NOT EXISTS archivio.rigaOrdineTabacchi (ID TEXT (8) NOT NULL, Descrizione TEXT (50) NOT NULL, ID_Ordine INTEGER NOT NULL, Ordine REAL NOT NULL DEFAULT (0), Prezzo REAL NOT NULL DEFAULT (0), Giacenza REAL NOT NULL DEFAULT (0), Consumo REAL NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_Ordine));",
+    "CREATE TABLE IF NOT EXISTS archivio.rigaOrdineSuppletivo (ID varchar (8) NOT NULL, Descrizione varchar (50) NOT NULL, ID_Ordine integer NOT NULL, Ordine float NOT NULL DEFAULT '0', PRIMARY KEY (ID, ID_Ordine));",
+    "CREATE TABLE IF NOT EXISTS archivio.verificaOrdine (ID VARCHAR (8) NOT NULL, ID_ordine INTEGER NOT NULL, Carico REAL NOT NULL DEFAULT (0), Peso REAL NOT NULL DEFAULT (0), Eliminato BOOLEAN NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_ordine));",
+    "CREATE INDEX IF NOT EXISTS archivio.idx_rigaOrdineTabacchi_fk_riga_ordine ON rigaOrdineTabacchi (ID_Ordine);",
+]
+
+# Viste (temporanee, della singola connessione) che uniscono DB principale e archivio
+VIEWS = [
+    "CREATE TEMP VIEW IF NOT EXISTS storicoOrdineTabacchi AS "
+    "SELECT ID, Data, Stato, Levata, Suppletivo, DataSuppletivo FROM main.ordineTabacchi UNION ALL "
+    "SELECT ID, Data, Stato, Levata, Suppletivo, DataSuppletivo FROM archivio.ordineTabacchi;",
+    "CREATE TEMP VIEW IF NOT EXISTS storicoRigaOrdineTabacchi AS "
+    "SELECT ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo FROM main.rigaOrdineTabacchi UNION ALL "
+    "SELECT ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo FROM archivio.rigaOrdineTabacchi;",
+]
+
+# Tabelle spostate nell'archivio, le righe prima degli ordini (vincoli di foreign key)
+ARCHIVED_TABLES = [
+    ("verificaOrdine", "ID_ordine"),
+    ("rigaOrdineSuppletivo", "ID_Ordine"),
+    ("rigaOrdineTabacchi", "ID_Ordine"),
+]
+
+ORDINE_COLUMNS = "ID, Data, LastPos, DataSuppletivo, Stato, Levata, Suppletivo, ID_Precedente, ID_Successivo"
+
+
+# Controlla se esiste un archivio
+def exists():
+    return ARCHIVE_PATHNAME.exists()
+
+
+# Collega l'archivio alla connessione (se non è già collegato) e crea le viste.
+# ATTACH non si può eseguire dentro una transazione.
+def attach(conn):
+    databases = [row[1] for row in conn.execute("pragma database_list;").fetchall()]
+    if SCHEMA_NAME not in databases:
+        conn.execute("ATTACH DATABASE ? AS archivio", (str(ARCHIVE_PATHNAME),))
+        for statement in ARCHIVE_SCHEMA + VIEWS:
+            conn.execute(statement)
+        conn.commit()
+
+
+# Scollega l'archivio, se collegato, quando la connessione (persistente, del thread) non lo usa più.
+# DETACH non si può eseguire dentro una transazione: in quel caso resta collegato fino alla prossima chiamata.
+def detach(conn):
+    if conn.in_transaction:
+        return
+    databases = [row[1] for row in conn.execute("pragma database_list;").fetchall()]
+    if SCHEMA_NAME in databases:
+        try:
+            conn.execute("DETACH DATABASE archivio")
+        except sqlite3.Error as e:
+            log.error(f"[archivio] detach non riuscito: {e}")
+
+
+# Ritorna i nomi di (ordini, righe ordine) da usare nelle query che partono da dataInizio ('%Y-%m-%d'):
+# le viste sull'archivio solo se il periodo comincia prima dell'ordine più vecchio del DB principale.
+# Chi usa le viste deve chiamare detach() alla fine.
+def tabelle(conn, dataInizio):
+    if exists():
+        row = conn.execute("SELECT min(Data) FROM main.ordineTabacchi").fetchone()
+        if (row[0] is None) or (dataInizio < row[0]):
+            attach(conn)
+            return ("storicoOrdineTabacchi", "storicoRigaOrdineTabacchi")
+    return ("ordineTabacchi", "rigaOrdineTabacchi")
+
+
+# Sposta nell'archivio gli ordini con data precedente a dataLimite
+class ArchiviaOrdiniThread(utility.WorkerThread):
+    def __init__(self, dataLimite):
+        super().__init__()
+        self.dataLimite = dataLimite
+        self.archiviati = 0
+
+    def run(self):
+        conn = None
+        cursor = None
+        try:
+            conn = prefs.getConn()
+            attach(conn)
+            cursor = prefs.getCursor(conn)
+            self.progressDialog.setSteps(2 * len(ARCHIVED_TABLES) + 3)
+            selezione = "SELECT ID FROM main.ordineTabacchi WHERE Data < ?"
+
+            cursor.execute(f"INSERT OR REPLACE INTO archivio.ordineTabacchi ({ORDINE_COLUMNS}) SELECT {ORDINE_COLUMNS} FROM main.ordineTabacchi WHERE Data < ?",
+                           (self.dataLimite,))
+            self.archiviati = cursor.rowcount
+            self.update()
+            for table, column in ARCHIVED_TABLES:
+                cursor.execute(f"INSERT OR REPLACE INTO archivio.{table} SELECT * FROM main.{table} WHERE {column} IN ({selezione})", (self.dataLimite,))
+                self.update()
+            # Le righe spostate nell'archivio non cambiano i consumi: i trigger che segnano gli articoli in consumiDirty
+            # scattano anche su queste DELETE, per cui consumiDirty viene riportata com'era prima dello spostamento
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS consumiDirtyPrima AS SELECT * FROM main.consumiDirty WHERE 0;")
+            cursor.execute("DELETE FROM temp.consumiDirtyPrima;")
+            cursor.execute("INSERT INTO temp.consumiDirtyPrima SELECT * FROM main.consumiDirty;")
+            for table, column in ARCHIVED_TABLES:
+                cursor.execute(f"DELETE FROM main.{table} WHERE {column} IN ({selezione})", (self.dataLimite,))
+                self.update()
+            cursor.execute("DELETE FROM main.ordineTabacchi WHERE Data < ?", (self.dataLimite,))
+            cursor.execute("DELETE FROM main.consumiDirty;")
+            cursor.execute("INSERT INTO main.consumiDirty SELECT * FROM temp.consumiDirtyPrima;")
+            cursor.execute("DELETE FROM temp.consumiDirtyPrima;")
+            self.update()
+            conn.commit()
+
+            # Recupera lo spazio liberato nel DB principale
+            if self.archiviati > 0:
+                conn.execute("VACUUM main;")
+            self.update()
+        except StopIteration:
+            if conn:
+                conn.rollback()
+        except sqlite3.Error as e:
+            if conn:
+                conn.rollback()
+            self.setError(e)
+        else:
+            self.status = self.DONE
+            log.debug(f"[archivio] archiviati {self.archiviati} ordini precedenti al {self.dataLimite}")
+            if self.archiviati > 0:
+                # Le preferenze si modificano solo nel thread della GUI
+                GLib.idle_add(prefs.setDBDirty)
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                detach(conn)
+                conn.close()
+            prefs.releaseConn()
+            GLib.idle_add(self.progressDialog.close)
+
+        return False
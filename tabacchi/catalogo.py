@@ -0,0 +1,141 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import collections
+import re
+import threading
+import time
+
+from .config import log
+from .preferencesTabacchi import prefs
+from . import repository
+
+# Catalogo degli articoli (tabella tabacchi) letto una sola volta e condiviso dai dialoghi.
+# Viene riletto solo quando cambia prefs.catalogoVersion (vedi Preferences.setCatalogoDirty).
+# Le righe sono FastRow in sola lettura: chi deve modificarle ne copia i valori.
+
+COLONNE = "ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza, PezziUnitaMin, Barcode"
+
+
+class Catalogo:
+    def __init__(self, articoli):
+        self.articoli = articoli        # Tutti gli articoli, ordinati per Tipo (decrescente) e Descrizione
+        self.perCodice = {articolo["ID"]: articolo for articolo in articoli}
+        self.perBarcode = {articolo["Barcode"]: articolo for articolo in articoli if articolo["Barcode"]}
+        self.inMagazzino = [articolo for articolo in articoli if articolo["InMagazzino"]]
+
+    def __len__(self):
+        return len(self.articoli)
+
+    def get(self, idArt):
+        return self.perCodice.get(idArt)
+
+
+# Indice per la ricerca incrementale degli articoli su codice AAMS, descrizione e barcode.
+# Le parole cercate di 1 o 2 caratteri sono prefissi di una parola indicizzata, quelle più lunghe
+# possono comparire ovunque nel testo: i candidati sono l'intersezione degli insiemi dei loro trigrammi,
+# poi verificati sul testo. Con più parole devono essere trovate tutte.
+class IndiceRicerca:
+    def __init__(self):
+        self.testi = dict()                             # chiave: testo normalizzato
+        self.trigrammi = collections.defaultdict(set)   # trigramma: chiavi
+        self.prefissi = collections.defaultdict(set)    # prefisso di 1 o 2 caratteri di una parola: chiavi
+
+    def __len__(self):
+        return len(self.testi)
+
+    # Minuscole e solo lettere e cifre: "BLUE*AST20" diventa "blue ast20"
+    @staticmethod
+    def normalizza(testo):
+        return " ".join(re.split(r"\W+", testo.casefold())).strip()
+
+    @staticmethod
+    def trigrammiParola(parola):
+        return {parola[i:i + 3] for i in range(len(parola) - 2)}
+
+    def __voci(self, testo):
+        trigrammi = set()
+        prefissi = set()
+        for parola in testo.split():
+            trigrammi |= self.trigrammiParola(parola)
+            prefissi.add(parola[:1])
+            prefissi.add(parola[:2])
+        return (trigrammi, prefissi)
+
+    # Aggiunge o aggiorna l'articolo con i campi indicati (quelli vuoti sono ignorati)
+    def aggiungi(self, chiave, *campi):
+        self.rimuovi(chiave)
+        testo = self.normalizza(" ".join(campo for campo in campi if campo))
+        self.testi[chiave] = testo
+        trigrammi, prefissi = self.__voci(testo)
+        for trigramma in trigrammi:
+            self.trigrammi[trigramma].add(chiave)
+        for prefisso in prefissi:
+            self.prefissi[prefisso].add(chiave)
+
+    def rimuovi(self, chiave):
+        testo = self.testi.pop(chiave, None)
+        if testo is None:
+            return
+        trigrammi, prefissi = self.__voci(testo)
+        for indice, voci in ((self.trigrammi, trigrammi), (self.prefissi, prefissi)):
+            for voce in voci:
+                chiavi = indice[voce]
+                chiavi.discard(chiave)
+                if not chiavi:
+                    del indice[voce]
+
+    # Ritorna l'insieme delle chiavi trovate, None se il testo cercato è vuoto
+    def cerca(self, testo):
+        parole = self.normalizza(testo).split()
+        if not parole:
+            return None
+        # Prima le parole più lunghe, che restringono di più la ricerca
+        risultato = None
+        for parola in sorted(parole, key=len, reverse=True):
+            if len(parola) < 3:
+                trovate = self.prefissi.get(parola, set())
+            else:
+                insiemi = [self.trigrammi.get(trigramma) for trigramma in self.trigrammiParola(parola)]
+                if not all(insiemi):
+                    return set()
+                insiemi.sort(key=len)
+                trovate = insiemi[0].intersection(*insiemi[1:])
+                if len(parola) > 3:
+                    trovate = {chiave for chiave in trovate if parola in self.testi[chiave]}
+            risultato = trovate if risultato is None else (risultato & trovate)
+            if not risultato:
+                return set()
+        return set(risultato)
+
+
+def carica(conn):
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        articoli = repository.fetchRows(cursor, f"SELECT {COLONNE} FROM tabacchi ORDER BY Tipo desc, Descrizione", dates={'Decorrenza': 'date'})
+    finally:
+        cursor.close()
+    log.debug(f"[catalogo] caricati {len(articoli)} articoli in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return Catalogo(articoli)
+
+
+__cache = None
+__lock = threading.Lock()
+
+
+# Ritorna il catalogo, rileggendolo dal DB solo se è stato modificato
+def getCatalogo():
+    global __cache
+    with __lock:
+        versione = prefs.catalogoVersion
+        if __cache and (__cache[0] == versione):
+            return __cache[1]
+        conn = prefs.getRawConn()
+        try:
+            catalogo = carica(conn)
+        finally:
+            conn.close()
+        __cache = (versione, catalogo)
+        return catalogo
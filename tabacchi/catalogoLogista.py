@@ -0,0 +1,248 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import collections
+import csv
+import datetime
+import functools
+import hashlib
+import json
+import os
+from urllib import request
+from urllib.error import HTTPError
+
+import xlrd
+import gi
+
+from . import config
+from .config import log
+from . import utility
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib  # noqa: E402
+
+# Catalogo Logista: download condizionale con cache locale e lettura a righe dei formati xls, xlsx e csv
+
+# Nella cache utente, fuori dai dati inclusi nel backup
+CACHE_DIR = config.user_cache_dir / "catalogo"
+METADATI_PATHNAME = CACHE_DIR / "catalogo.json"
+
+XLS, XLSX, CSV = ("xls", "xlsx", "csv")
+
+# Riga del catalogo, con i valori già convertiti
+ArticoloCatalogo = collections.namedtuple("ArticoloCatalogo", "ID Descrizione Tipo UnitaMin PrezzoKg Decorrenza")
+
+# Colonne del foglio Logista
+COL_CODICE, COL_DESCRIZIONE, COL_TIPO, COL_UNITA_MIN, COL_PREZZO_KG, COL_DECORRENZA = (0, 2, 3, 4, 5, 7)
+
+DECORRENZA_DEFAULT = datetime.date(1970, 1, 1)
+
+
+# Metadati dell'ultimo catalogo scaricato: url, ETag, Last-Modified, file, sha256
+# e sha256 dell'ultimo catalogo applicato al DB
+def leggiMetadati():
+    try:
+        with open(METADATI_PATHNAME, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def scriviMetadati(metadati):
+    tmpPathname = METADATI_PATHNAME.with_suffix(".tmp")
+    with open(tmpPathname, "w") as f:
+        json.dump(metadati, f)
+    os.replace(tmpPathname, METADATI_PATHNAME)
+
+
+# Da chiamare dopo aver applicato al DB il catalogo con questo hash
+def segnaApplicato(sha256):
+    metadati = leggiMetadati()
+    metadati["applicato"] = sha256
+    try:
+        scriviMetadati(metadati)
+    except OSError as e:
+        log.error(f"[catalogo] metadati non salvati: {e}")
+
+
+# Scarica il catalogo solo se è cambiato (If-None-Match / If-Modified-Since), conservandolo in CACHE_DIR.
+# Al termine: pathname del catalogo in cache, sha256 del contenuto e modificato = False se il contenuto
+# è lo stesso dell'ultimo catalogo applicato (non serve rileggerlo).
+class DownloadCatalogoThread(utility.WorkerThread):
+    CHUNK_SIZE = 65536
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.pathname = None
+        self.sha256 = None
+        self.modificato = True
+
+    def run(self):
+        response = None
+        fileObj = None
+        tmpPathname = CACHE_DIR / "download.tmp"
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            metadati = leggiMetadati()
+            cached = CACHE_DIR / metadati["file"] if ("file" in metadati) else None
+            myrequest = request.Request(self.url)
+            if cached and cached.exists() and (metadati.get("url") == self.url):
+                if metadati.get("etag"):
+                    myrequest.add_header("If-None-Match", metadati["etag"])
+                if metadati.get("lastModified"):
+                    myrequest.add_header("If-Modified-Since", metadati["lastModified"])
+
+            try:
+                response = request.urlopen(myrequest)
+            except HTTPError as e:
+                if e.code != 304:
+                    raise
+                log.debug(f"[catalogo] non modificato (304), uso {cached}")
+                self.pathname = cached
+                self.sha256 = metadati.get("sha256")
+            else:
+                lenght = response.headers.get("Content-Length")
+                self.progressDialog.setSteps((int(lenght) / self.CHUNK_SIZE) + 1 if lenght else 0)
+                sha = hashlib.sha256()
+                fileObj = open(tmpPathname, "wb")
+                while True:
+                    chunk = response.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    fileObj.write(chunk)
+                    self.update()
+                fileObj.close()
+                fileObj = None
+
+                self.sha256 = sha.hexdigest()
+                self.pathname = CACHE_DIR / f"catalogo.{formato(tmpPathname)}"
+                os.replace(tmpPathname, self.pathname)
+                if cached and (cached != self.pathname) and cached.exists():
+                    cached.unlink()
+                metadati.update({"url": self.url, "etag": response.headers.get("ETag"), "lastModified": response.headers.get("Last-Modified"),
+                                 "file": self.pathname.name, "sha256": self.sha256})
+                scriviMetadati(metadati)
+            self.modificato = (self.sha256 != metadati.get("applicato"))
+        except StopIteration:
+            pass
+        except Exception as e:
+            self.setError(e)
+        else:
+            self.status = self.DONE
+        finally:
+            if response:
+                response.close()
+            if fileObj:
+                fileObj.close()
+            if tmpPathname.exists():
+                tmpPathname.unlink()
+            GLib.idle_add(self.progressDialog.close, self)
+
+        return False
+
+
+# Riconosce il formato dai primi byte: xls (OLE2), xlsx (zip) o testo csv
+def formato(pathname):
+    with open(pathname, "rb") as f:
+        header = f.read(8)
+    if header.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        return XLS
+    elif header.startswith(b"PK\x03\x04"):
+        return XLSX
+    return CSV
+
+
+def __righeXls(pathname):
+    book = xlrd.open_workbook(pathname, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            yield sheet.row_values(i)
+    finally:
+        book.release_resources()
+
+
+# openpyxl è opzionale: serve solo per i cataloghi xlsx
+def __righeXlsx(pathname):
+    import openpyxl
+    book = openpyxl.load_workbook(pathname, read_only=True, data_only=True)
+    try:
+        yield from book.worksheets[0].iter_rows(values_only=True)
+    finally:
+        book.close()
+
+
+def __righeCsv(pathname):
+    with open(pathname, "rb") as f:
+        sample = f.read(65536)
+    try:
+        encoding = "utf-8-sig"
+        text = sample.decode(encoding)
+    except UnicodeDecodeError as e:
+        # Un carattere multibyte troncato alla fine del campione non esclude utf-8
+        if e.start < len(sample) - 3:
+            encoding = "cp1252"
+        text = sample.decode(encoding, errors="ignore")
+    try:
+        dialect = csv.Sniffer().sniff(text, delimiters=";,\t")
+    except csv.Error:
+        dialect = csv.excel
+    with open(pathname, "r", encoding=encoding, newline="") as f:
+        yield from csv.reader(f, dialect)
+
+
+# Righe del primo foglio (o del file csv) come sequenze di valori, una alla volta
+def righe(pathname):
+    tipo = formato(pathname)
+    if tipo == XLS:
+        return __righeXls(pathname)
+    elif tipo == XLSX:
+        return __righeXlsx(pathname)
+    return __righeCsv(pathname)
+
+
+def __testo(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+# Numeri anche in formato italiano nei csv ("1.234,5"): il punto separa le migliaia
+# solo se c'è la virgola decimale, altrimenti è il separatore decimale ("0.020")
+def __numero(value):
+    if isinstance(value, str):
+        value = value.strip()
+        if "," in value:
+            value = value.replace(".", "").replace(",", ".")
+    return float(value) if value not in (None, "") else 0.0
+
+
+# La stessa data si ripete su molte righe: viene convertita una sola volta
+@functools.lru_cache(maxsize=1024)
+def __parseDecorrenza(value):
+    try:
+        return datetime.datetime.strptime(value.strip(), "%d/%m/%Y").date()
+    except ValueError:
+        return DECORRENZA_DEFAULT
+
+
+def __decorrenza(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    elif isinstance(value, str):
+        return __parseDecorrenza(value)
+    return DECORRENZA_DEFAULT
+
+
+# Articoli del catalogo (esclusa la riga di intestazione e le righe senza codice)
+def articoli(pathname):
+    for i, row in enumerate(righe(pathname)):
+        if (i == 0) or (len(row) <= COL_DECORRENZA) or not row[COL_CODICE]:
+            continue
+        yield ArticoloCatalogo(__testo(row[COL_CODICE]), __testo(row[COL_DESCRIZIONE]), __testo(row[COL_TIPO]),
+                               __numero(row[COL_UNITA_MIN]), __numero(row[COL_PREZZO_KG]), __decorrenza(row[COL_DECORRENZA]))
@@ -24,6 +24,7 @@ RESOURCE_PATH = BASE_PATH / 'resources'
 user_data_dir = Path(dirs.user_data_dir)
 user_config_dir = Path(dirs.user_config_dir)
 user_log_dir = Path(dirs.user_log_dir)
+user_cache_dir = Path(dirs.user_cache_dir)
 
 # Se non esistono le directory standard per la configurazione, dati, logging
 if not user_data_dir.exists():
@@ -0,0 +1,77 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import sqlite3
+import threading
+import time
+
+import gi
+
+from . import archivio
+from .config import log
+from .preferencesTabacchi import prefs
+from . import repository
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib  # noqa: E402
+
+# Ricalcolo in background dei consumi degli articoli segnati in consumiDirty
+# (i trigger li segnano quando si modifica, importa, riceve o elimina un ordine)
+
+
+class AggiornaConsumiThread(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.richiesta = threading.Event()
+
+    def run(self):
+        while True:
+            self.richiesta.wait()
+            self.richiesta.clear()
+            self.__ricalcola()
+
+    def __ricalcola(self):
+        conn = None
+        cursor = None
+        start = time.perf_counter()
+        try:
+            conn = prefs.getConn()
+            ordini, righe = archivio.tabelle(conn, "")
+            # Nessun'altra scrittura tra la lettura di consumiDirty e il suo svuotamento
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = prefs.getCursor(conn)
+            aggiornate = repository.ricalcolaConsumiDirty(cursor, ordini, righe)
+            conn.commit()
+        except sqlite3.Error as e:
+            if conn:
+                conn.rollback()
+            log.error(f"[consumi] ricalcolo non riuscito: {e}")
+        else:
+            if aggiornate > 0:
+                # Le preferenze si modificano solo nel thread della GUI
+                GLib.idle_add(prefs.setDBDirty)
+            log.debug(f"[consumi] aggiornate {aggiornate} righe in {(time.perf_counter() - start) * 1000:.1f} ms")
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                archivio.detach(conn)
+                conn.close()
+            # Il thread resta in attesa della prossima richiesta: senza connessioni aperte
+            prefs.releaseConn()
+
+
+__thread = None
+__lock = threading.Lock()
+
+
+# Chiede il ricalcolo dei consumi segnati. Le richieste arrivate durante un ricalcolo
+# sono accorpate in un unico ricalcolo successivo.
+def aggiorna():
+    global __thread
+    with __lock:
+        if __thread is None:
+            __thread = AggiornaConsumiThread()
+            __thread.start()
+        __thread.richiesta.set()
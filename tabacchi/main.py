@@ -4,25 +4,33 @@
 #
 
 import datetime
+import math
 import os
 import re
 import sqlite3
 import subprocess
 import sys
 import tempfile
-import xlrd
+import time
 import xlwt
 import base64
 import locale
 import gi
 
+from . import archivio
+from . import catalogo
+from . import catalogoLogista
 from . import browserWebkit2
 from .browserWebkit2 import Browser
 from . import config
 from .config import log
+from . import consumi
 from . import ordini
 from . import preferencesTabacchi
 from .preferencesTabacchi import prefs
+from . import previsioni
+from . import regolePezzi
+from . import repository
 from . import stampe
 from . import stats
 from . import utility
@@ -49,6 +57,18 @@ MENU_XML = """
                     <attribute name="label">Statistiche...</attribute>
                     <attribute name="action">app.statistiche</attribute>
                 </item>
+                <item>
+                    <attribute name="label">Ricostruisci riepilogo ordini</attribute>
+                    <attribute name="action">app.riepilogo</attribute>
+                </item>
+                <item>
+                    <attribute name="label">Calcola livelli minimi...</attribute>
+                    <attribute name="action">app.livelli</attribute>
+                </item>
+                <item>
+                    <attribute name="label">Archivia ordini...</attribute>
+                    <attribute name="action">app.archivia</attribute>
+                </item>
             </section>
         </submenu>
         <submenu>
@@ -154,24 +174,11 @@ class ImportDialog(utility.GladeWindow):
 
     # Genera un dizionario con l'attuale listino tabacchi
     def __getTabacchiDict(self):
-        conn = None
-        cursor = None
         tabacchiDict = None
         try:
-            conn = prefs.getConn()
-            cursor = prefs.getCursor(conn)
-            cursor.execute("SELECT ID, Descrizione, PrezzoKg FROM tabacchi")
-            resultset = cursor.fetchall()
-            tabacchiDict = dict()
-            for row in resultset:
-                tabacchiDict[row["ID"]] = [row["Descrizione"], row["PrezzoKg"]]
+            tabacchiDict = {articolo["ID"]: [articolo["Descrizione"], articolo["PrezzoKg"]] for articolo in catalogo.getCatalogo().articoli}
         except sqlite3.Error as e:
             utility.gtkErrorMsg(e, self.importDialog)
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
 
         return tabacchiDict
 
@@ -398,13 +405,17 @@ class TabacchiDialog(utility.GladeWindow):
         self.data = prefs.dataCatalogo
         self.readBarcodeThread = None
         self.barcodeDict = dict()
-        self.deleteList = []
+        self.modificati = set()             # ID degli articoli modificati, da salvare nel DB
+        self.indiceRicerca = catalogo.IndiceRicerca()
+        self.risultatiRicerca = None        # ID degli articoli trovati, None se non si sta cercando
+        self.iterListino = dict()           # ID: iter della riga nel modello del listino
 
         self.tabacchiDialog = self.builder.get_object("tabacchiDialog")
         self.tabacchiNotebook = self.builder.get_object("tabacchiNotebook")
         self.bluetoothStatusImage = self.builder.get_object('bluetoothStatusImage')
         self.listinoTreeView = self.builder.get_object("listinoTreeView")
         self.magazzinoTreeView = self.builder.get_object("magazzinoTreeView")
+        self.ricercaEntry = self.builder.get_object("ricercaEntry")
 
         self.tabacchiDialog.set_transient_for(parent)
 
@@ -419,22 +430,14 @@ class TabacchiDialog(utility.GladeWindow):
         utility.ExtTreeView(self.MODEL_INFO_LIST, self.listinoTreeView, edit_callbacks=listino_callbacks, properties=listino_properties)
         self.listinoModel = self.listinoTreeView.get_model()
         self.magazzinoModel = self.listinoModel.filter_new()
-        self.magazzinoModel.set_visible_column(0)
+        self.magazzinoModel.set_visible_func(self.__visibileMagazzino)
 
         utility.ExtTreeView(self.MODEL_INFO_LIST_MAGAZZINO, self.magazzinoTreeView, modelCallback=self.modelCallback,
                             edit_callbacks=magazzino_callbacks, properties=magazzino_properties)
 
-        # Prima di caricare i dati nel modello, lo "sgancio" dalla Treeview
-        self.listinoTreeView.set_model(None)
-        self.magazzinoTreeView.set_model(None)
-
-        # Legge da db i dati nel modello
+        # Legge il catalogo nel modello (sganciato dalle Treeview durante il caricamento)
         self.loadListino(self.listinoModel)
 
-        # Finita la lettura da DB lo "riaggancio" alla Treeview
-        self.magazzinoTreeView.set_model(self.magazzinoModel)
-        self.listinoTreeView.set_model(self.listinoModel)
-
         self.updateTitle()
 
         self.listinoTreeView.connect("row-activated", self.changeView)
@@ -444,6 +447,8 @@ class TabacchiDialog(utility.GladeWindow):
                                       "on_updateButton_clicked": self.updateCatalogo,
                                       "on_okButton_clicked": self.close,
                                       "on_barcodeToolbutton_clicked": self.enableBarcode,
+                                      "on_ricercaEntry_search_changed": self.cerca,
+                                      "on_ricercaEntry_activate": self.vaiAlRisultato,
                                       "on_cancelButton_clicked": self.forcedClose})
 
         self.bluetoothStatusImage.hide()
@@ -451,6 +456,34 @@ class TabacchiDialog(utility.GladeWindow):
     def modelCallback(self, model):
         return self.magazzinoModel
 
+    # Nel magazzino solo gli articoli in magazzino, ristretti a quelli trovati se si sta cercando
+    def __visibileMagazzino(self, model, iterator, data=None):
+        if not model.get_value(iterator, self.IN_MAGAZZINO):
+            return False
+        return (self.risultatiRicerca is None) or (model.get_value(iterator, self.ID) in self.risultatiRicerca)
+
+    # Ricerca incrementale: filtra il magazzino con l'indice e nel listino si posiziona sul primo articolo trovato
+    def cerca(self, widget=None):
+        start = time.perf_counter()
+        self.risultatiRicerca = self.indiceRicerca.cerca(self.ricercaEntry.get_text())
+        self.magazzinoModel.refilter()
+        if self.tabacchiNotebook.get_current_page() == self.LISTINO_TAB:
+            self.vaiAlRisultato()
+        log.debug(f"[ricerca] {len(self.risultatiRicerca) if self.risultatiRicerca is not None else '-'} articoli in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # Seleziona il primo articolo trovato (nell'ordine attuale della lista)
+    def vaiAlRisultato(self, widget=None):
+        if self.tabacchiNotebook.get_current_page() == self.LISTINO_TAB:
+            if self.risultatiRicerca:
+                paths = [self.listinoModel.get_path(self.iterListino[idArt]) for idArt in self.risultatiRicerca if idArt in self.iterListino]
+                if paths:
+                    path = min(paths)
+                    self.listinoTreeView.set_cursor(path)
+                    self.listinoTreeView.scroll_to_cell(path, None, True, 0.5, 0)
+        elif self.magazzinoModel.iter_n_children(None) > 0:
+            self.magazzinoTreeView.set_cursor(Gtk.TreePath.new_first())
+            self.magazzinoTreeView.grab_focus()
+
     def onBarcodeCellEdited(self, widget, path, value, model, col_id):
         self.__changeBarcode(value, path, model)
 
@@ -458,12 +491,16 @@ class TabacchiDialog(utility.GladeWindow):
         parent_path = model.convert_path_to_child_path(Gtk.TreePath.new_from_string(path))
         parent_model = model.get_model()
         parent_model[parent_path][col_id] = value
-        parent_model[parent_path][self.DIRTY] = True
-        self.dirtyFlag = True
+        self.__setModificato(parent_model[parent_path])
 
     def onListinoCellEdited(self, widget, path, value, model, col_id):
         model[path][col_id] = value
-        model[path][self.DIRTY] = True
+        self.__setModificato(model[path])
+
+    # Segna la riga del listino come da salvare
+    def __setModificato(self, row):
+        row[self.DIRTY] = True
+        self.modificati.add(row[self.ID])
         self.dirtyFlag = True
 
     def __changeBarcode(self, barcode, path, model):
@@ -484,13 +521,13 @@ class TabacchiDialog(utility.GladeWindow):
             if len(barcode) > 0:
                 self.barcodeDict[barcode] = parent_model[parent_path][self.DESCRIZIONE]
             parent_model[parent_path][self.BARCODE] = barcode
-            parent_model[parent_path][self.DIRTY] = True
-            self.dirtyFlag = True
+            self.__setModificato(parent_model[parent_path])
+            idArt = parent_model[parent_path][self.ID]
+            self.indiceRicerca.aggiungi(idArt, idArt, parent_model[parent_path][self.DESCRIZIONE], barcode)
 
     def __toggledCallback(self, widget, path, model, col_id):
         new_value = model[path][col_id] = not model[path][col_id]
-        model[path][self.DIRTY] = True
-        self.dirtyFlag = True
+        self.__setModificato(model[path])
         if new_value:
             child_path = self.magazzinoModel.convert_child_path_to_path(Gtk.TreePath.new_from_string(path))
             self.tabacchiNotebook.set_current_page(self.MAGAZZINO_TAB)
@@ -549,60 +586,44 @@ class TabacchiDialog(utility.GladeWindow):
                 self.magazzinoTreeView.set_cursor(child_path)
 
     def loadListino(self, model):
-        cursor = None
-        conn = None
         try:
-            conn = prefs.getConn()
-            cursor = prefs.getCursor(conn)
-            cursor.execute(
-                "SELECT ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza as 'Decorrenza [date]', PezziUnitaMin, Barcode FROM tabacchi order by Tipo desc, Descrizione")
-            result_set = cursor.fetchall()
-
-            model.clear()
+            result_set = catalogo.getCatalogo().articoli
             self.barcodeDict.clear()
-
-            for row in result_set:
-                tipo = row["Tipo"].strip()
-                iterator = model.append()
-                model.set_value(iterator, self.ID, row["ID"])
-                desc = row["Descrizione"].strip()
-
-                model.set_value(iterator, self.DESCRIZIONE, desc)
-                model.set_value(iterator, self.TIPO, tipo)
-
-                model.set_value(iterator, self.LIVELLO_MIN, row["LivelloMin"])
-                model.set_value(iterator, self.IN_MAGAZZINO, row["InMagazzino"])
-                barcode = row["Barcode"]
-                if barcode and len(barcode) > 0:
-                    self.barcodeDict[barcode] = desc
-                    model.set_value(iterator, self.BARCODE, barcode)
-                else:
-                    model.set_value(iterator, self.BARCODE, '')
-                decorrenza = row["Decorrenza"]
-
-                if not decorrenza:
-                    decorrenza = datetime.datetime(1970, 1, 1, 0, 0)
-
-                model.set_value(iterator, self.DECORRENZA, decorrenza)
-                prezzoKg = row["PrezzoKg"]
-                unitaMin = row["UnitaMin"]
-                pezziUnitaMin = row["PezziUnitaMin"]
-                if pezziUnitaMin > 0:
-                    prezzoPezzo = (prezzoKg * unitaMin) / pezziUnitaMin
-                else:
-                    prezzoPezzo = 0
-                model.set_value(iterator, self.PREZZO_KG, prezzoKg)
-                model.set_value(iterator, self.UNITA_MIN, unitaMin)
-                model.set_value(iterator, self.PEZZI_UNITA_MIN, pezziUnitaMin)
-                model.set_value(iterator, self.PREZZO_PEZZO, prezzoPezzo)
-                model.set_value(iterator, self.DIRTY, False)
+            # Il listino riletto dal DB non ha modifiche da salvare
+            self.modificati.clear()
+            self.indiceRicerca = catalogo.IndiceRicerca()
+            # Gli iter di un ListStore restano validi anche riordinando il modello
+            iterators = utility.ExtTreeView.bulkLoad(model, self.__righeListino(result_set), treeviews=(self.listinoTreeView, self.magazzinoTreeView))
+            self.iterListino = {row["ID"]: iterator for row, iterator in zip(result_set, iterators)}
+            # Riapplica la ricerca in corso al catalogo appena caricato
+            self.risultatiRicerca = self.indiceRicerca.cerca(self.ricercaEntry.get_text())
+            self.magazzinoModel.refilter()
         except sqlite3.Error as e:
             utility.gtkErrorMsg(e, self.tabacchiDialog)
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+
+    # Righe del modello del listino, nell'ordine delle colonne
+    def __righeListino(self, result_set):
+        for row in result_set:
+            desc = row["Descrizione"].strip()
+            barcode = row["Barcode"]
+            if barcode and len(barcode) > 0:
+                self.barcodeDict[barcode] = desc
+            else:
+                barcode = ''
+            self.indiceRicerca.aggiungi(row["ID"], row["ID"], desc, barcode)
+            decorrenza = row["Decorrenza"]
+            if not decorrenza:
+                decorrenza = datetime.datetime(1970, 1, 1, 0, 0)
+            prezzoKg = row["PrezzoKg"]
+            unitaMin = row["UnitaMin"]
+            pezziUnitaMin = row["PezziUnitaMin"]
+            if pezziUnitaMin > 0:
+                prezzoPezzo = (prezzoKg * unitaMin) / pezziUnitaMin
+            else:
+                prezzoPezzo = 0
+            # IN_MAGAZZINO, ID, DESCRIZIONE, TIPO, PREZZO_PEZZO, DECORRENZA, LIVELLO_MIN, PEZZI_UNITA_MIN, UNITA_MIN, PREZZO_KG, BARCODE, DIRTY
+            yield (row["InMagazzino"], row["ID"], desc, row["Tipo"].strip(), prezzoPezzo, decorrenza, row["LivelloMin"], pezziUnitaMin,
+                   unitaMin, prezzoKg, barcode, False)
 
     def __saveModelToDB(self):
         cursor = None
@@ -610,38 +631,22 @@ class TabacchiDialog(utility.GladeWindow):
         try:
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
-            for _id in self.deleteList:
-                cursor.execute("delete from tabacchi where ID = ?", (_id,))
-            for row in self.listinoModel:
-                if row[self.DIRTY]:
-                    inMagazzino = row[self.IN_MAGAZZINO]
-                    codiceAAMS = row[self.ID]
-                    descrizione = row[self.DESCRIZIONE]
-                    tipo = row[self.TIPO]
-                    decorrenza = row[self.DECORRENZA]
-                    livelloMin = row[self.LIVELLO_MIN]
-                    pezziUnitaMin = row[self.PEZZI_UNITA_MIN]
-                    unitaMin = row[self.UNITA_MIN]
-                    prezzoKg = row[self.PREZZO_KG]
-                    barcode = row[self.BARCODE]
-
-                    cursor.execute(
-                        "UPDATE tabacchi SET Descrizione=?, UnitaMin=?, PrezzoKg=?, Tipo=?, InMagazzino=?, LivelloMin=?, Decorrenza=?, PezziUnitaMin=?, Barcode=?  WHERE ID = ?",
-                        (descrizione, unitaMin, prezzoKg, tipo, inMagazzino, livelloMin, decorrenza, pezziUnitaMin, barcode, codiceAAMS))
-                    if cursor.rowcount == 0:
-                        cursor.execute(
-                            "INSERT INTO tabacchi(Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza, PezziUnitaMin, Barcode, ID) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                            (descrizione, unitaMin, prezzoKg, tipo, inMagazzino, livelloMin, decorrenza, pezziUnitaMin, barcode, codiceAAMS))
-
+            # Solo le righe modificate, senza scorrere tutto il listino
+            rows = [self.listinoModel[self.iterListino[idArt]] for idArt in self.modificati if idArt in self.iterListino]
+            repository.upsertTabacchi(cursor, [(row[self.ID], row[self.DESCRIZIONE], row[self.UNITA_MIN], row[self.PREZZO_KG], row[self.TIPO],
+                                                row[self.IN_MAGAZZINO], row[self.LIVELLO_MIN], row[self.DECORRENZA], row[self.PEZZI_UNITA_MIN],
+                                                row[self.BARCODE]) for row in rows])
             conn.commit()
         except sqlite3.Error as e:
             if conn:
                 conn.rollback()
             utility.gtkErrorMsg(e, self.tabacchiDialog)
         else:
-            del self.deleteList[:]
+            for row in rows:
+                row[self.DIRTY] = False
+            self.modificati.clear()
             if self.dirtyFlag:
-                prefs.setDBDirty()
+                prefs.setCatalogoDirty()
             # Aggiornamento data catalogo
             prefs.dataCatalogo = self.data
             prefs.save()
@@ -678,18 +683,19 @@ class TabacchiDialog(utility.GladeWindow):
             self.readBarcodeThread.stop()
         self.tabacchiDialog.destroy()
 
-    # Logica per interpretare il n. di pezzi in una confezione (pezziUnitaMin)
-    def __fuzzyCount(self, unitaMin, descrizione):
-        value = 0
-        if ("*CART20" in descrizione) or ("*AST20" in descrizione):
-            value = 10
-        elif ("*AST10" in descrizione):
-            value = 20
-        else:
-            match = re.search(r"\*(\d{1,3})GR", descrizione)
-            if match:
-                value = int(unitaMin / (float(match.group(1)) / 1000))
-        return value
+    # Segnala gli articoli in magazzino rimasti senza n. di pezzi per confezione (nessuna regola applicabile
+    # e nessun valore inserito a mano): nelle etichette non avrebbero il prezzo del pezzo
+    def __avvisoSenzaPezzi(self, senzaPezzi):
+        inMagazzino = [[row[0], row[1]] for row in senzaPezzi if row[2]]
+        log.debug(f"[updateCatalogo] {len(senzaPezzi)} articoli senza n. di pezzi, {len(inMagazzino)} in magazzino")
+        if len(inMagazzino) > 0:
+            modelInfo = [("Codice", "str"), ("+Descrizione", "str")]
+            extMsgDialog = utility.ExtMsgDialog(
+                self.tabacchiDialog, modelInfo, "I seguenti articoli in magazzino non hanno il n. di pezzi per confezione.", "Attenzione", "dialog-warning-symbolic",
+                buttons=utility.ExtMsgDialog.CANCEL)
+            extMsgDialog.setSecondaryLabel("Inserirlo nella colonna Pezzi del listino.")
+            extMsgDialog.setData(inMagazzino)
+            extMsgDialog.run()
 
     # Aggiornamento DB Tabacchi tramite portale Logista (scaricando listino su file Excel)
     def updateCatalogo(self, widget=None):
@@ -698,8 +704,7 @@ class TabacchiDialog(utility.GladeWindow):
         # Download dal portale Logista del file con il catalogo aggionato.
         # Utente e password non servono, il file è in chiaro (servono per inserire gli ordini sul portale).
         if url is not None and (len(url) > 0):
-            filename = f"{tempfile.mkdtemp()}/catalogo.xls"
-            downloadThread = utility.DownloadThread(url, filename)
+            downloadThread = catalogoLogista.DownloadCatalogoThread(url)
             progressDialog = utility.ProgressDialog(self.tabacchiDialog, "Download catalogo Tabacchi in corso..", "Dal sito www.logista.it", "Aggiornamento catalogo Logista", downloadThread)
             progressDialog.setResponseCallback(self.__updateCatalogoCallback)
             progressDialog.start()
@@ -711,99 +716,72 @@ class TabacchiDialog(utility.GladeWindow):
             msgDialog.destroy()
 
     #
-    def __updateCatalogoCallback(self, filename):
-        # Apre il file Excel
-        book = xlrd.open_workbook(filename)
-        sheet = book.sheet_by_index(0)
-
-        tabacchiDict = dict()
-        i = 0
-        for row in self.listinoModel:
-            codiceAAMS = row[self.ID]
-            tabacchiDict[codiceAAMS] = i
-            i += 1
-
-        for row in range(1, sheet.nrows):
-            codiceAAMS = sheet.cell_value(row, 0).strip()
-            descrizione = sheet.cell_value(row, 2).strip()
-
-            prezzoKg = float(sheet.cell_value(row, 5))
-            unitaMin = float(sheet.cell_value(row, 4))
-            tipo = sheet.cell_value(row, 3).strip()
-            data = sheet.cell_value(row, 7).strip()
-            try:
-                data = datetime.datetime.strptime(data, "%d/%m/%Y")
-                decorrenza = datetime.date(data.year, data.month, data.day)
-            except ValueError:
-                decorrenza = datetime.date(1970, 1, 1)
-
-            pezziUnitaMin = self.__fuzzyCount(unitaMin, descrizione)
-
-            # Se è un nuovo articolo
-            if codiceAAMS not in tabacchiDict:
-                iterator = self.listinoModel.append()
-                self.listinoModel.set_value(iterator, self.IN_MAGAZZINO, False)
-                self.listinoModel.set_value(iterator, self.ID, codiceAAMS)
-                self.listinoModel.set_value(iterator, self.DESCRIZIONE, descrizione)
-                self.listinoModel.set_value(iterator, self.LIVELLO_MIN, float(0))
-                self.listinoModel.set_value(iterator, self.TIPO, tipo)
-                self.listinoModel.set_value(iterator, self.UNITA_MIN, unitaMin)
-                self.listinoModel.set_value(iterator, self.PREZZO_KG, prezzoKg)
-                self.listinoModel.set_value(iterator, self.DECORRENZA, decorrenza)
-                self.listinoModel.set_value(iterator, self.PEZZI_UNITA_MIN, pezziUnitaMin)
-                self.listinoModel.set_value(iterator, self.DIRTY, True)
-                self.listinoModel.set_value(iterator, self.BARCODE, '')
-                self.dirtyFlag = True
-            else:  # Se già esiste..
-                path = tabacchiDict[codiceAAMS]
-                row = self.listinoModel[path]
-
-                if (row[self.PREZZO_KG] != prezzoKg) or (row[self.DESCRIZIONE] != descrizione) or (row[self.UNITA_MIN] != unitaMin) or (row[self.TIPO] != tipo) or (row[self.DECORRENZA] != decorrenza) or ((pezziUnitaMin > 0) and (row[self.PEZZI_UNITA_MIN] != pezziUnitaMin)):
-                    row[self.PREZZO_KG] = prezzoKg
-                    row[self.DECORRENZA] = decorrenza
-                    row[self.DESCRIZIONE] = descrizione
-                    row[self.UNITA_MIN] = unitaMin
-                    row[self.TIPO] = tipo
-                    row[self.DIRTY] = True
-                    if (pezziUnitaMin > 0) and (row[self.PEZZI_UNITA_MIN] != pezziUnitaMin):
-                        row[self.PEZZI_UNITA_MIN] = pezziUnitaMin
-                    else:
-                        pezziUnitaMin = row[self.PEZZI_UNITA_MIN]
-                    row[self.PREZZO_PEZZO] = (prezzoKg * unitaMin) / pezziUnitaMin if pezziUnitaMin > 0 else 0
-                    self.dirtyFlag = True
-
-                # Elimina gli articoli che sono sia in memoria che nel file excel
-                del tabacchiDict[codiceAAMS]
-
-        self.data = datetime.datetime.now().replace(microsecond=0)
-
-        # Se sono rimasti articoli, questi sono da cancellare..
-        if len(tabacchiDict) > 0:
-            del self.deleteList[:]
-            deleteDesc = []
-            for key_value in tabacchiDict.keys():
-                row = self.listinoModel[tabacchiDict[key_value]]
-                deleteDesc.append([row[self.ID], row[self.DESCRIZIONE], row[self.IN_MAGAZZINO]])
-                self.deleteList.append(key_value)
-            modelInfo = [("Codice", "str"), ("+Descrizione", "str"), ("^Magazzino", "bool")]
-            extMsgDialog = utility.ExtMsgDialog(
-                self.tabacchiDialog, modelInfo, "Nel listino Logista i seguenti articoli non esistono più.", "Attenzione", "dialog-warning-symbolic",
-                buttons=utility.ExtMsgDialog.YES_NO)
-            extMsgDialog.setSecondaryLabel("Vuoi cancellarli?")
-            extMsgDialog.setData(deleteDesc)
-            response = extMsgDialog.run()
-
-            if response == Gtk.ResponseType.YES:
-                iterator = self.listinoModel.get_iter_first()
-                result = True
-                self.dirtyFlag = True
-                while iterator and result:
-                    codiceAAMS = self.listinoModel.get_value(iterator, self.ID)
-                    if codiceAAMS in tabacchiDict:
-                        result = self.listinoModel.remove(iterator)
-                    else:
-                        iterator = self.listinoModel.iter_next(iterator)
-        self.updateTitle()
+    def __updateCatalogoCallback(self, downloadThread):
+        # Stesso contenuto dell'ultimo catalogo applicato: niente da leggere né da confrontare
+        if not downloadThread.modificato:
+            msgDialog = Gtk.MessageDialog(parent=self.tabacchiDialog, modal=True, message_type=Gtk.MessageType.INFO,
+                                          buttons=Gtk.ButtonsType.OK, text="Il catalogo Logista non è cambiato.")
+            msgDialog.set_title("Aggiornamento catalogo Logista")
+            msgDialog.run()
+            msgDialog.destroy()
+            return
+
+        try:
+            # N. di pezzi delle confezioni ricavato dalla descrizione con le regole configurate
+            regole = regolePezzi.RegolePezzi(prefs.regolePezzi)
+            catalogoList = [(articolo.ID, articolo.Descrizione, articolo.UnitaMin, articolo.PrezzoKg, articolo.Tipo, articolo.Decorrenza,
+                             regole.pezzi(articolo.UnitaMin, articolo.Descrizione)) for articolo in catalogoLogista.articoli(downloadThread.pathname)]
+        except Exception as e:
+            utility.gtkErrorMsg(e, self.tabacchiDialog, "Formato del catalogo non riconosciuto.")
+            return
+
+        # Le modifiche non salvate vanno nel DB prima del confronto con il catalogo scaricato
+        if self.dirtyFlag:
+            self.__saveModelToDB()
+
+        cursor = None
+        conn = None
+        try:
+            conn = prefs.getConn()
+            cursor = prefs.getCursor(conn)
+            repository.caricaCatalogo(cursor, catalogoList)
+            (nuovi, modificati, rimossi) = repository.diffCatalogo(cursor)
+            conn.commit()
+
+            eliminaRimossi = False
+            # Se sono rimasti articoli, questi sono da cancellare..
+            if len(rimossi) > 0:
+                modelInfo = [("Codice", "str"), ("+Descrizione", "str"), ("^Magazzino", "bool")]
+                extMsgDialog = utility.ExtMsgDialog(
+                    self.tabacchiDialog, modelInfo, "Nel listino Logista i seguenti articoli non esistono più.", "Attenzione", "dialog-warning-symbolic",
+                    buttons=utility.ExtMsgDialog.YES_NO)
+                extMsgDialog.setSecondaryLabel("Vuoi cancellarli?")
+                extMsgDialog.setData([list(row) for row in rimossi])
+                eliminaRimossi = (extMsgDialog.run() == Gtk.ResponseType.YES)
+
+            repository.applicaCatalogo(cursor, eliminaRimossi)
+            conn.commit()
+            senzaPezzi = repository.articoliSenzaPezzi(cursor)
+        except sqlite3.Error as e:
+            if conn:
+                conn.rollback()
+            utility.gtkErrorMsg(e, self.tabacchiDialog)
+        else:
+            log.debug(f"[updateCatalogo] {nuovi} nuovi, {modificati} modificati, {len(rimossi) if eliminaRimossi else 0} cancellati")
+            prefs.setCatalogoDirty()
+            catalogoLogista.segnaApplicato(downloadThread.sha256)
+            self.data = datetime.datetime.now().replace(microsecond=0)
+            # Aggiornamento data catalogo
+            prefs.dataCatalogo = self.data
+            prefs.save()
+            self.loadListino(self.listinoModel)
+            self.updateTitle()
+            self.__avvisoSenzaPezzi(senzaPezzi)
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.close()
 
 # Thread dedicato a ricalcolare i consumi
 
@@ -817,25 +795,14 @@ class RicalcolaConsumiThread(utility.WorkerThread):
         cursor = None
         try:
             conn = prefs.getConn()
+            self.progressDialog.setSteps(2)
+            # Se c'è un archivio la prima riga di ogni articolo nel DB principale parte dall'ultima archiviata
+            ordini, righe = archivio.tabelle(conn, "")
+            self.update()
             cursor = prefs.getCursor(conn)
-            cursor.execute("SELECT r.ID, r.Ordine, r.Giacenza, r.ID_Ordine FROM rigaOrdineTabacchi r, ordineTabacchi o where r.ID_Ordine = o.ID order by r.ID, r.ID_Ordine")
-            resultList = cursor.fetchall()
-            old_id = -1
-            self.progressDialog.setSteps(len(resultList))
-
-            for row in resultList:
-                peso = round(row["Ordine"], 3)
-                quantita = round(row["Giacenza"], 3)
-                idCod = row["ID"]
-                if (idCod != old_id):
-                    old_quantita = 0
-                    old_peso = 0
-                consumo = round((old_quantita + old_peso) - quantita, 3)
-                cursor.execute("update rigaOrdineTabacchi set Consumo = ? where ID = ? and ID_Ordine = ?", (consumo, idCod, row["ID_Ordine"]))
-                old_peso = peso
-                old_quantita = quantita
-                old_id = idCod
-                self.update()
+            aggiornate = repository.ricalcolaConsumi(cursor, ordini, righe)
+            self.update()
+            log.debug(f"[ricalcolaConsumi] aggiornate {aggiornate} righe")
             conn.commit()
         except StopIteration:
             if conn:
@@ -851,7 +818,9 @@ class RicalcolaConsumiThread(utility.WorkerThread):
             if cursor:
                 cursor.close()
             if conn:
+                archivio.detach(conn)
                 conn.close()
+            prefs.releaseConn()
             GLib.idle_add(self.progressDialog.close)
 
         return False
@@ -870,6 +839,8 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
         ("Suppletivo", ordini.TIPO_ORDINE, SUPPLETIVO),
         (None, "date", DATA_SUPPLETIVO)]
 
+    ORDINI_PAGE_SIZE = 60
+
     def __init__(self, *args, **kwargs):
         Gtk.ApplicationWindow.__init__(self, *args, **kwargs)
         utility.GladeWindow.__init__(self, self, "mainWindowContent.glade")
@@ -932,9 +903,13 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
                         self.STATO: {"xalign": 0.5},
                         self.SUPPLETIVO: {"xalign": 0.5}})
         self.ordiniModel = self.ordiniTreeview.get_model()
+        self.ordiniGeneration = 0
+        self.ordiniKey = None
+        self.dataFiltro = "1970-01-01"
         self.__buildCombo()
 
         self.loadOrders()
+        self.ordiniTreeview.get_vadjustment().connect("value-changed", self.__ordiniScrolled)
 
         selection = self.ordiniTreeview.get_selection()
         selection.connect('changed', self.selectionChanged)
@@ -965,17 +940,8 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
 
     # Aggiorna il Popover con la treeview del Piano Levate
     def updatePianoLevatePopover(self, widget=None):
-        model = self.levataTreeview.get_model()
-        self.levataTreeview.set_model(None)
-        model.clear()
-        for row in prefs.pianoConsegneList:
-            iterator = model.append()
-            model.set_value(iterator, 0, row[1])
-            model.set_value(iterator, 1, row[0])
-            model.set_value(iterator, 2, row[3])
-            model.set_value(iterator, 3, row[5])
-
-        self.levataTreeview.set_model(model)
+        utility.ExtTreeView.bulkLoad(self.levataTreeview.get_model(), ((row[1], row[0], row[3], row[5]) for row in prefs.pianoConsegneList),
+                                     treeviews=(self.levataTreeview,))
 
     def __buildCombo(self):
         oggi = datetime.datetime.now()
@@ -1082,55 +1048,67 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
 
         return result
 
-    # Carica lista ordini
+    # Carica lista ordini: la prima pagina subito, le successive (più vecchie) durante l'idle
+    # o quando si scorre la lista fino in fondo
     def loadOrders(self, widget=None):
         model = self.ordiniModel
         self.ordiniTreeview.set_model(None)
-        cursor = None
-        conn = None
+        self.ordiniGeneration += 1
+        self.ordiniKey = None
         iterator = self.filtroCombobox.get_active_iter()
         if iterator:
-            dataFiltro = self.filtroCombobox.get_model()[iterator][0]
+            self.dataFiltro = self.filtroCombobox.get_model()[iterator][0]
+        model.clear()
+        more = self.__loadOrdersPage(model)
+        self.ordiniTreeview.set_model(model)
+        if more:
+            GLib.idle_add(self.__loadOrdersIdle, self.ordiniGeneration, priority=GLib.PRIORITY_LOW)
+
+    # Carica la pagina di ordini più recenti di quelli già caricati (keyset su Data).
+    # Ritorna True se ci sono altre pagine da caricare
+    def __loadOrdersPage(self, model):
+        more = False
+        cursor = None
+        conn = None
         try:
-            conn = prefs.getConn()
+            conn = prefs.getRawConn()
             cursor = prefs.getCursor(conn)
-            cursor.execute(
-                'SELECT O.ID as ID, O.Data as "Data [timestamp]", O.Levata as "Levata [date]", sum(R.Ordine*R.Prezzo) as Costo, sum(R.Ordine) as Ordine, O.Stato, O.Suppletivo, O.DataSuppletivo as "DataSuppletivo [date]" FROM ordineTabacchi O left join rigaOrdineTabacchi R on O.ID = R.ID_Ordine where O.Data > ? group by O.ID order by O.Data desc',
-                (dataFiltro,))
-            result_set = cursor.fetchall()
-            model.clear()
-            for row in result_set:
-                idOrdine = row["ID"]
-                costo = row["Costo"]
-                ordine = row["Ordine"]
-                stato = row["Stato"]
-                data = row["Data"]
-                levata = row["Levata"]
-                if not costo:
-                    costo = 0
-                if not ordine:
-                    ordine = 0
-                iterator = model.append()
-                model.set_value(iterator, self.ID, idOrdine)
-                model.set_value(iterator, self.DATA, data)
-                model.set_value(iterator, self.PESO, ordine)
-                model.set_value(iterator, self.IMPORTO, costo)
-                model.set_value(iterator, self.STATO, stato)
-                model.set_value(iterator, self.CONSEGNA, levata)
-                model.set_value(iterator, self.SUPPLETIVO, row["Suppletivo"])
-                model.set_value(iterator, self.DATA_SUPPLETIVO, row["DataSuppletivo"])
-            conn.commit()
+            if self.ordiniKey is None:
+                where = "O.Data > ?"
+                parameters = (self.dataFiltro, self.ORDINI_PAGE_SIZE)
+            else:
+                where = "O.Data > ? and O.Data < ?"
+                parameters = (self.dataFiltro, self.ordiniKey, self.ORDINI_PAGE_SIZE)
+            result_set = repository.fetchRows(
+                cursor, f'SELECT O.ID as ID, O.Data as Chiave, O.Data as Data, O.Levata as Levata, S.Importo as Costo, S.Peso as Ordine, O.Stato as Stato, O.Suppletivo as Suppletivo, O.DataSuppletivo as DataSuppletivo FROM ordineTabacchi O left join ordineSummary S on S.ID_Ordine = O.ID where {where} order by O.Data desc limit ?',
+                parameters, dates={'Data': 'timestamp', 'Levata': 'date', 'DataSuppletivo': 'date'})
+            # ID, DATA, PESO, IMPORTO, STATO, DATA_SUPPLETIVO, CONSEGNA, SUPPLETIVO
+            utility.ExtTreeView.bulkLoad(model, ((row["ID"], row["Data"], row["Ordine"] or 0, row["Costo"] or 0, row["Stato"], row["DataSuppletivo"],
+                                                  row["Levata"], row["Suppletivo"]) for row in result_set), clear=False)
+            if len(result_set) > 0:
+                self.ordiniKey = result_set[-1]["Chiave"]
+            more = (len(result_set) == self.ORDINI_PAGE_SIZE)
         except sqlite3.Error as e:
-            if conn:
-                conn.rollback()
             utility.gtkErrorMsg(e, self)
         finally:
             if cursor:
                 cursor.close()
             if conn:
                 conn.close()
+        if not more:
+            self.ordiniKey = None
+        return more
 
-        self.ordiniTreeview.set_model(model)
+    # Carica una pagina per volta finché ci sono ordini, a meno che nel frattempo la lista sia stata ricaricata
+    def __loadOrdersIdle(self, generation):
+        if (generation != self.ordiniGeneration) or (self.ordiniKey is None):
+            return False
+        return self.__loadOrdersPage(self.ordiniModel)
+
+    # Scorrendo fino in fondo carica subito la pagina successiva
+    def __ordiniScrolled(self, adjustment):
+        if (self.ordiniKey is not None) and (adjustment.get_value() + adjustment.get_page_size() >= adjustment.get_upper() - adjustment.get_page_size()):
+            self.__loadOrdersPage(self.ordiniModel)
 
     # Aggiorna informazioni su ordine
     def refreshOrder(self, idOrdine, model, iterator=None):
@@ -1140,7 +1118,7 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
             cursor.execute(
-                "SELECT O.Data as 'Data [timestamp]', O.Levata as 'Levata [date]', sum(R.Ordine*R.Prezzo) as Costo, sum(R.Ordine) as Ordine, O.Stato, O.Suppletivo, O.DataSuppletivo as 'DataSuppletivo [date]' FROM ordineTabacchi O left join rigaOrdineTabacchi R on O.ID = R.ID_Ordine where O.ID = ?",
+                "SELECT O.Data as 'Data [timestamp]', O.Levata as 'Levata [date]', S.Importo as Costo, S.Peso as Ordine, O.Stato, O.Suppletivo, O.DataSuppletivo as 'DataSuppletivo [date]' FROM ordineTabacchi O left join ordineSummary S on S.ID_Ordine = O.ID where O.ID = ?",
                 (idOrdine,))
             result_set = cursor.fetchall()
             if len(result_set) > 0:
@@ -1347,9 +1325,8 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
                     cursor.execute("SELECT ID, Descrizione, Ordine, Giacenza FROM rigaOrdineTabacchi where ID_Ordine = ? and Ordine > 0 order by Descrizione", (idOrdine,))
                     ordineList = cursor.fetchall()
 
-                    # Legge la lista dei record dei tabacchi
-                    cursor.execute("SELECT ID, Descrizione, UnitaMin, PrezzoKg, LivelloMin, Tipo FROM tabacchi where InMagazzino order by Tipo desc, Descrizione")
-                    tabaccoList = cursor.fetchall()
+                    # Lista dei tabacchi in magazzino
+                    tabaccoList = catalogo.getCatalogo().inMagazzino
                 except sqlite3.Error as e:
                     utility.gtkErrorMsg(e, self)
                 finally:
@@ -1475,6 +1452,7 @@ class MainWindow(Gtk.ApplicationWindow, utility.GladeWindow):
                         conn.commit()
                         self.ordiniModel.remove(iterator)
                         prefs.setDBDirty()
+                        consumi.aggiorna()
                     except sqlite3.Error as e:
                         utility.gtkErrorMsg(e, self)
                         if conn:
@@ -1778,49 +1756,8 @@ class MainApplication(Gtk.Application):
                 response = msgDialog.run()
                 msgDialog.destroy()
                 if (response == Gtk.ResponseType.NO):
-                    conn = None
-                    try:
-                        conn = sqlite3.connect(prefs.DB_PATHNAME)
-                        conn.execute("pragma foreign_keys=off;")
-
-                        # Table: ordineTabacchi
-                        conn.execute("CREATE TABLE ordineTabacchi (ID INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, Data DATETIME NOT NULL, LastPos INTEGER NOT NULL DEFAULT (0), DataSuppletivo DATE DEFAULT NULL, Stato INTEGER NOT NULL DEFAULT (0), Levata DATE DEFAULT NULL, Suppletivo BOOLEAN NOT NULL DEFAULT (0), UNIQUE (Data), UNIQUE (Levata));")
-
-                        # Table: rigaOrdineSuppletivo
-                        conn.execute("CREATE TABLE rigaOrdineSuppletivo (ID varchar (8) NOT NULL, Descrizione varchar (50) NOT NULL, ID_Ordine integer NOT NULL, Ordine float NOT NULL DEFAULT '0', PRIMARY KEY (ID, ID_Ordine), CONSTRAINT fk_riga_suppletivo FOREIGN KEY (ID_Ordine) REFERENCES ordineTabacchi (ID));")
-
-                        # Table: rigaOrdineTabacchi
-                        conn.execute("CREATE TABLE rigaOrdineTabacchi (ID TEXT (8) NOT NULL, Descrizione TEXT (50) NOT NULL, ID_Ordine INTEGER NOT NULL, Ordine REAL NOT NULL DEFAULT (0), Prezzo REAL NOT NULL DEFAULT (0), Giacenza REAL NOT NULL DEFAULT (0), Consumo REAL NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_Ordine), CONSTRAINT fk_riga_ordine FOREIGN KEY (ID_Ordine) REFERENCES ordineTabacchi (ID));")
-
-                        # Table: tabacchi
-                        conn.execute("CREATE TABLE tabacchi (ID TEXT (8) NOT NULL, Descrizione TEXT (50) NOT NULL DEFAULT NULL, UnitaMin REAL NOT NULL DEFAULT (0), PrezzoKg REAL NOT NULL DEFAULT (0), Tipo TEXT (50) NOT NULL, InMagazzino BOOLEAN NOT NULL DEFAULT (0), LivelloMin REAL NOT NULL DEFAULT (0), Decorrenza DATE NOT NULL DEFAULT ('0000-00-00'), PezziUnitaMin INTEGER NOT NULL DEFAULT (0), Barcode TEXT (20) NOT NULL, PRIMARY KEY (ID));")
-
-                        # Table: verificaOrdine
-                        conn.execute("CREATE TABLE verificaOrdine (ID VARCHAR (8) NOT NULL, ID_ordine INTEGER NOT NULL, Carico REAL NOT NULL DEFAULT (0), Peso REAL NOT NULL DEFAULT (0), Eliminato BOOLEAN NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_ordine), CONSTRAINT fk_verificaOrdine_OrdineTabacchi FOREIGN KEY (ID_ordine) REFERENCES ordineTabacchi (ID) ON DELETE NO ACTION ON UPDATE NO ACTION);")
-
-                        # Index: idx_rigaOrdineSuppletivo_fk_riga_suppletivo
-                        conn.execute("CREATE INDEX idx_rigaOrdineSuppletivo_fk_riga_suppletivo ON rigaOrdineSuppletivo (ID_Ordine);")
-
-                        # Index: idx_rigaOrdineTabacchi_fk_riga_ordine
-                        conn.execute("CREATE INDEX idx_rigaOrdineTabacchi_fk_riga_ordine ON rigaOrdineTabacchi (ID_Ordine);")
-
-                        # Index: idx_tabacchi_k_inmagazzino
-                        conn.execute("CREATE INDEX idx_tabacchi_k_inmagazzino ON tabacchi (InMagazzino);")
-
-                        # Index: idx_tabacchi_k_tipo
-                        conn.execute("CREATE INDEX idx_tabacchi_k_tipo ON tabacchi (Tipo);")
-
-                        # Index: idx_verificaOrdine_fk_verificaOrdine_OrdineTabacchi
-                        conn.execute("CREATE INDEX idx_verificaOrdine_fk_verificaOrdine_OrdineTabacchi ON verificaOrdine (ID_ordine);")
-
-                        conn.commit()
-                    except sqlite3.Error as e:
-                        if conn:
-                            conn.rollback()
-                        raise e
-                    finally:
-                        if conn:
-                            conn.close()
+                    # Il DB vuoto sarà creato dalle migrazioni dello schema
+                    pass
                 elif (response == Gtk.ResponseType.YES):
                     src = config.BASE_PATH / 'demo/tabacchi.sqlite'
                     dest = prefs.DB_PATHNAME
@@ -1834,10 +1771,16 @@ class MainApplication(Gtk.Application):
                     sys.exit(1)
 
             prefs.load()
+            prefs.setupDB()
+            prefs.migrateDB()
         except Exception as e:
             utility.gtkErrorMsg(e, None)
             sys.exit(1)
 
+        # Modifiche agli ordini non salvate e consumi rimasti da ricalcolare nella sessione precedente
+        ordini.recuperaJournal()
+        consumi.aggiorna()
+
         action = Gio.SimpleAction.new("about", None)
         action.connect("activate", self.on_about)
         self.add_action(action)
@@ -1858,6 +1801,18 @@ class MainApplication(Gtk.Application):
         action.connect("activate", self.globalStats)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new("riepilogo", None)
+        action.connect("activate", self.ricostruisciRiepilogo)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("livelli", None)
+        action.connect("activate", self.calcolaLivelliMinimi)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new("archivia", None)
+        action.connect("activate", self.archiviaOrdini)
+        self.add_action(action)
+
         action = Gio.SimpleAction.new("etichette", None)
         action.connect("activate", self.printLabels)
         self.add_action(action)
@@ -1906,6 +1861,82 @@ class MainApplication(Gtk.Application):
         if response == Gtk.ResponseType.OK:
             self.mainWindow.pianoLevataToolbutton.set_sensitive(prefs.pianoConsegneDaSito)
 
+    # Ricalcola da zero il riepilogo (peso e importo) degli ordini
+    def ricostruisciRiepilogo(self, action, param):
+        try:
+            with prefs.transaction() as cursor:
+                repository.rebuildOrdineSummary(cursor)
+        except sqlite3.Error as e:
+            utility.gtkErrorMsg(e, self.mainWindow)
+        else:
+            prefs.setDBDirty()
+            self.mainWindow.loadOrders()
+
+    # Propone i livelli minimi degli articoli in magazzino calcolati dai consumi, e applica quelli scelti
+    def calcolaLivelliMinimi(self, action, param):
+        try:
+            livelli = previsioni.livelliMinimi()
+            tabacchiList = catalogo.getCatalogo().inMagazzino
+        except (sqlite3.Error, ValueError, IndexError) as e:
+            utility.gtkErrorMsg(e, self.mainWindow)
+            return
+
+        modifiche = []
+        for row in tabacchiList:
+            if row["ID"] in livelli:
+                unitaMin = row["UnitaMin"]
+                livello = livelli[row["ID"]]
+                if unitaMin > 0:
+                    livello = math.ceil(round(livello / unitaMin, 6)) * unitaMin
+                livello = round(livello, 3)
+                if livello != round(row["LivelloMin"], 3):
+                    modifiche.append([True, row["Descrizione"], row["LivelloMin"], livello, row["ID"]])
+
+        if len(modifiche) == 0:
+            msgDialog = Gtk.MessageDialog(parent=self.mainWindow, modal=True, message_type=Gtk.MessageType.INFO,
+                                          buttons=Gtk.ButtonsType.OK, text="I livelli minimi sono già aggiornati.")
+            msgDialog.run()
+            msgDialog.destroy()
+            return
+
+        modelInfo = [("*Applica", "bool"), ("+Descrizione", "str"), ("Attuale", "float"), ("Proposto", "float"), (None, "str")]
+        extMsgDialog = utility.ExtMsgDialog(
+            self.mainWindow, modelInfo, f"Livelli minimi proposti per {len(modifiche)} articoli.", "Livelli minimi", "dialog-information-symbolic")
+        extMsgDialog.setSecondaryLabel(f"Consumo settimanale (percentile {previsioni.PERCENTILE_LIVELLO}) dell'ultimo anno per le settimane tra una levata e la successiva.")
+        extMsgDialog.setData(modifiche)
+        model = extMsgDialog.dataTreeview.get_model()
+        response = extMsgDialog.run()
+        if response == Gtk.ResponseType.OK:
+            rows = [(row[4], row[3]) for row in model if row[0]]
+            try:
+                with prefs.transaction() as cursor:
+                    repository.setLivelliMinimi(cursor, rows)
+            except sqlite3.Error as e:
+                utility.gtkErrorMsg(e, self.mainWindow)
+            else:
+                log.debug(f"[calcolaLivelliMinimi] aggiornati {len(rows)} articoli")
+                prefs.setCatalogoDirty()
+
+    # Sposta nell'archivio gli ordini più vecchi di prefs.anniArchivio anni
+    def archiviaOrdini(self, action, param):
+        oggi = datetime.date.today()
+        try:
+            dataLimite = oggi.replace(year=oggi.year - prefs.anniArchivio)
+        except ValueError:
+            dataLimite = oggi.replace(year=oggi.year - prefs.anniArchivio, day=28)
+
+        msgDialog = Gtk.MessageDialog(parent=self.mainWindow, modal=True, message_type=Gtk.MessageType.QUESTION,
+                                      buttons=Gtk.ButtonsType.YES_NO, text=f"Archiviare gli ordini precedenti al {dataLimite.strftime('%d/%m/%Y')}?")
+        msgDialog.format_secondary_text("Gli ordini archiviati non saranno più visibili nell'elenco, ma resteranno disponibili per le statistiche.")
+        response = msgDialog.run()
+        msgDialog.destroy()
+        if response == Gtk.ResponseType.YES:
+            thread = archivio.ArchiviaOrdiniThread(dataLimite.strftime("%Y-%m-%d"))
+            progressDialog = utility.ProgressDialog(self.mainWindow, "Archiviazione ordini in corso..",
+                                                    f"In {archivio.ARCHIVE_PATHNAME}", "Archiviazione ordini", thread)
+            progressDialog.setResponseCallback(self.mainWindow.loadOrders)
+            progressDialog.start()
+
     # Ricalcola i consumi
     def ricalcolaConsumi(self, action, param):
         thread = RicalcolaConsumiThread()
@@ -2111,22 +2142,6 @@ class MainApplication(Gtk.Application):
                 listCur = None
                 listSucc = None
 
-                # "estrapolo" i livelli dall'ordine precedente
-                cursor.execute(
-                    "SELECT ID, (Ordine + Giacenza) Livello FROM rigaOrdineTabacchi where ID_ordine = (select ID from ordineTabacchi where Data = (select max(Data) from ordineTabacchi where Data < ? order by Data desc))",
-                    (dataOrdine,))
-                listPrec = cursor.fetchall()
-
-                # "estrapolo" i livelli dall'ordine successivo
-                cursor.execute(
-                    "SELECT r.ID, (r.Ordine + r.Giacenza) Livello FROM rigaOrdineTabacchi r where r.ID_ordine = (select ID from ordineTabacchi where Data = (select min(Data) from ordineTabacchi where Data > ? order by Data))",
-                    (dataOrdine,))
-                listSucc = cursor.fetchall()
-
-                # Nel caso in cui non ci siano info uso i livelli correnti
-                cursor.execute("SELECT ID, LivelloMin FROM tabacchi")
-                listCur = cursor.fetchall()
-
                 stato = ordini.RICEVUTO if (tipo == importDialog.FATTURA) else ordini.INVIATO
 
                 response = Gtk.ResponseType.OK
@@ -2156,6 +2171,22 @@ class MainApplication(Gtk.Application):
                     idOrdine = cursor.lastrowid
 
                 if response != Gtk.ResponseType.CANCEL:
+                    # Ordini precedente e successivo (collegamenti aggiornati dai trigger)
+                    cursor.execute("SELECT ID_Precedente, ID_Successivo from ordineTabacchi where ID = ?", (idOrdine,))
+                    links = cursor.fetchone()
+
+                    # "estrapolo" i livelli dall'ordine precedente
+                    cursor.execute("SELECT ID, (Ordine + Giacenza) Livello FROM rigaOrdineTabacchi where ID_ordine = ?", (links["ID_Precedente"],))
+                    listPrec = cursor.fetchall()
+
+                    # "estrapolo" i livelli dall'ordine successivo
+                    cursor.execute("SELECT ID, (Ordine + Giacenza) Livello FROM rigaOrdineTabacchi where ID_ordine = ?", (links["ID_Successivo"],))
+                    listSucc = cursor.fetchall()
+
+                    # Nel caso in cui non ci siano info uso i livelli correnti
+                    cursor.execute("SELECT ID, LivelloMin FROM tabacchi")
+                    listCur = cursor.fetchall()
+
                     # Se è possibile fare una stima delle quantità
                     if listPrec and listSucc:
                         precDict = dict()
@@ -2169,6 +2200,7 @@ class MainApplication(Gtk.Application):
                         for row in listCur:
                             curDict[row["ID"]] = row["LivelloMin"]
 
+                    righe = []
                     iterator = model.get_iter_first()
                     while iterator:
                         id_cod = model.get_value(iterator, importDialog.ID_CODICE)
@@ -2190,10 +2222,9 @@ class MainApplication(Gtk.Application):
                         else:
                             quantita = 0
                         log.debug("Ordine:%.2f Prezzo:%.2f " % (peso, costo))
-                        cursor.execute(
-                            "INSERT INTO rigaOrdineTabacchi(ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo) VALUES(?, ?, ?, ?, ?, ?, ?)",
-                            (id_cod, descrizione, idOrdine, peso, costo, quantita, 0))
+                        righe.append((id_cod, descrizione, peso, costo, quantita, 0))
                         iterator = model.iter_next(iterator)
+                    repository.insertRigheOrdine(cursor, idOrdine, righe)
                     conn.commit()
             except sqlite3.Error as e:
                 utility.gtkErrorMsg(e, self.mainWindow)
@@ -2201,6 +2232,7 @@ class MainApplication(Gtk.Application):
                     conn.rollback()
             else:
                 prefs.setDBDirty()
+                consumi.aggiorna()
             finally:
                 if cursor:
                     cursor.close()
@@ -2212,6 +2244,7 @@ class MainApplication(Gtk.Application):
     def on_quit(self, event=None, data=None):
         log.debug("Salva le preferenze su file..")
         prefs.save()
+        prefs.closeConn()
         if prefs.checkBackup(self.mainWindow):
             thread = preferencesTabacchi.BackupThread(prefs)
             progressDialog = utility.ProgressDialog(self.mainWindow, "Backup in corso..", "", "Backup", thread)
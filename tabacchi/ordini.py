@@ -2,22 +2,28 @@
 # Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
 #
 
+import json
 import locale
+import math
 import sqlite3
 import datetime
 
 from playsound import playsound
 import gi
 
+from . import catalogo
 from . import config
 from .config import log
+from . import consumi
+from . import previsioni
+from . import repository
 from . import utility
 from . import stats
 from .preferencesTabacchi import prefs
 from . import preferencesTabacchi
 
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk   # noqa: E402
+from gi.repository import Gtk, GLib   # noqa: E402
 
 BEEP_SOUND = str(config.RESOURCE_PATH / 'beep.ogg')
 ERROR_SOUND = str(config.RESOURCE_PATH / 'error.ogg')
@@ -300,15 +306,9 @@ class RicezioneOrdineDialog(utility.GladeWindow):
         try:
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
-            for _id in self.deletedList:
-                cursor.execute("update verificaOrdine set Carico=?, Peso=?, Eliminato=? where ID=? and ID_Ordine=?", (0, 0, True, _id, self.idOrdine))
-                if cursor.rowcount == 0:
-                    cursor.execute("INSERT INTO verificaOrdine (Carico, Peso, Eliminato, ID, ID_Ordine) VALUES (?, ?, ?, ?, ?)", (0, 0, True, _id, self.idOrdine))
-            for row in model:
-                riga = (row[self.CARICO], row[self.PESO], row[self.ELIMINATO], row[self.ID], self.idOrdine)
-                cursor.execute("update verificaOrdine set Carico=?, Peso=?, Eliminato=? where ID=? and ID_Ordine=?", riga)
-                if cursor.rowcount == 0:
-                    cursor.execute("INSERT INTO verificaOrdine (Carico, Peso, Eliminato, ID, ID_Ordine) VALUES (?, ?, ?, ?, ?)", riga)
+            righe = [(_id, 0, 0, True) for _id in self.deletedList]
+            righe.extend((row[self.ID], row[self.CARICO], row[self.PESO], row[self.ELIMINATO]) for row in model)
+            repository.upsertVerifiche(cursor, self.idOrdine, righe)
             conn.commit()
         except sqlite3.Error as e:
             if conn:
@@ -327,14 +327,13 @@ class RicezioneOrdineDialog(utility.GladeWindow):
         cursor = None
         conn = None
         try:
-            conn = prefs.getConn()
+            conn = prefs.getRawConn()
             cursor = prefs.getCursor(conn)
             cursor.execute("SELECT count(ID) as size from verificaOrdine where ID_Ordine = ?", (self.idOrdine,))
             row = cursor.fetchone()
-            if row["size"] > 0:
-                cursor.execute(
-                    "SELECT t.Descrizione, t.ID, t.barcode, v.Peso as Ordine, v.Carico, t.unitaMin, t.prezzoKg, v.Eliminato FROM (tabacchi t LEFT JOIN (select * from verificaOrdine where ID_Ordine = ?) as v on v.ID = t.ID) order by t.Tipo desc, t.Descrizione",
-                    (self.idOrdine,))
+            if row[0] > 0:
+                cursor.execute("SELECT ID, Peso, Carico, Eliminato FROM verificaOrdine where ID_Ordine = ?", (self.idOrdine,))
+                verificaDict = {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
             else:
                 # Inizializza la tabella per la verifica
                 cursor.execute(
@@ -342,49 +341,39 @@ class RicezioneOrdineDialog(utility.GladeWindow):
                     (self.idOrdine,))
                 conn.commit()
                 # Legge i dati per popolare la treeview
-                cursor.execute(
-                    "SELECT t.Descrizione, t.ID, t.barcode, r.Ordine, 0 as Carico, t.unitaMin, t.prezzoKg, 0 as Eliminato FROM (tabacchi t LEFT JOIN (select * from rigaOrdineTabacchi where ID_Ordine = ?) as r on r.ID = t.ID) order by t.Tipo desc, t.Descrizione",
-                    (self.idOrdine,))
+                cursor.execute("SELECT ID, Ordine FROM rigaOrdineTabacchi where ID_Ordine = ?", (self.idOrdine,))
+                verificaDict = {row[0]: (row[1], 0, 0) for row in cursor.fetchall()}
 
-            resultList = cursor.fetchall()
-
-            model.clear()
             self.ordineDict.clear()
             self.listinoDict.clear()
             self.totPeso = 0
-            for row in resultList:
-                peso = row["Ordine"]
-                barcode = row["barcode"]
-                eliminato = row["Eliminato"]
-                idOrdine = row["ID"]
-                prezzoKg = round(row["prezzoKg"], 3) if row["prezzoKg"] else 0
-                descrizione = row["Descrizione"]
-                unitaMin = round(row["unitaMin"], 3) if row["unitaMin"] else 0
+            rows = []
+            for articolo in catalogo.getCatalogo().articoli:
+                idOrdine = articolo["ID"]
+                (peso, caricoDB, eliminato) = verificaDict.get(idOrdine, (None, None, None))
+                barcode = articolo["Barcode"]
+                prezzoKg = round(articolo["PrezzoKg"], 3) if articolo["PrezzoKg"] else 0
+                descrizione = articolo["Descrizione"]
+                unitaMin = round(articolo["UnitaMin"], 3) if articolo["UnitaMin"] else 0
                 if not eliminato and peso and (peso > 0):
                     peso = round(peso, 3)
-                    carico = round(row["Carico"], 3) if row["Carico"] else 0
+                    carico = round(caricoDB, 3) if caricoDB else 0
                     costo = round(prezzoKg * peso, 3)
                     self.totPeso += peso
                     self.totCarico += carico
                     self.totEuroCarico += round(prezzoKg * carico, 3)
                     self.totEuroPeso += costo
-                    iterator = model.append()
-                    model.set_value(iterator, self.ID, idOrdine)
-                    model.set_value(iterator, self.DESCRIZIONE, descrizione)
-                    model.set_value(iterator, self.PESO, peso)
-                    model.set_value(iterator, self.COSTO, costo)
-                    model.set_value(iterator, self.UNITA_MIN, unitaMin)
-                    model.set_value(iterator, self.CARICO, carico)
-                    model.set_value(iterator, self.VERIFICA, carico == peso)
-                    model.set_value(iterator, self.PREZZO_KG, prezzoKg)
-                    model.set_value(iterator, self.BARCODE, barcode)
-                    if barcode and (len(barcode) > 0):
-                        self.ordineDict[barcode] = model.get_path(iterator)
+                    # ID, DESCRIZIONE, PESO, CARICO, COSTO, UNITA_MIN, VERIFICA, PREZZO_KG, ELIMINATO, BARCODE
+                    rows.append((idOrdine, descrizione, peso, carico, costo, unitaMin, carico == peso, prezzoKg, False, barcode))
                 else:
                     if eliminato:
                         self.deletedList.append(idOrdine)
                     if barcode and (len(barcode) > 0):
                         self.listinoDict[barcode] = [idOrdine, descrizione, unitaMin, prezzoKg]
+            for row, iterator in zip(rows, utility.ExtTreeView.bulkLoad(model, rows)):
+                barcode = row[self.BARCODE]
+                if barcode and (len(barcode) > 0):
+                    self.ordineDict[barcode] = model.get_path(iterator)
         except sqlite3.Error as e:
             if conn:
                 conn.rollback()
@@ -406,15 +395,11 @@ class RicezioneOrdineDialog(utility.GladeWindow):
         try:
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
-            for idDeleted in self.deletedList:
-                cursor.execute("update rigaOrdineTabacchi set Ordine=? where ID=? and ID_Ordine=?", (0, idDeleted, self.idOrdine))
-            for row in model:
-                cursor.execute("update rigaOrdineTabacchi set Ordine=? where ID=? and ID_Ordine=?", (row[self.PESO], row[self.ID], self.idOrdine))
-                if cursor.rowcount == 0:
-                    cursor.execute("insert into rigaOrdineTabacchi (ID, Descrizione, ID_Ordine, Ordine, Prezzo) values (?, ?, ?, ?, ?)",
-                                   (row[self.ID], row[self.DESCRIZIONE], self.idOrdine, row[self.PESO], row[self.PREZZO_KG]))
-            cursor.execute("update ordineTabacchi set Stato = ? where ID = ?", (RICEVUTO, self.idOrdine))
-            cursor.execute("delete from verificaOrdine where ID_Ordine = ?", (self.idOrdine,))
+            repository.azzeraOrdinato(cursor, self.idOrdine, self.deletedList)
+            repository.upsertOrdinato(cursor, self.idOrdine,
+                                      [(row[self.ID], row[self.DESCRIZIONE], row[self.PESO], row[self.PREZZO_KG]) for row in model])
+            repository.setStatoOrdine(cursor, self.idOrdine, RICEVUTO)
+            repository.deleteVerifiche(cursor, self.idOrdine)
             conn.commit()
         except sqlite3.Error as e:
             if conn:
@@ -423,6 +408,7 @@ class RicezioneOrdineDialog(utility.GladeWindow):
         else:
             self.dirty = False
             prefs.setDBDirty()
+            consumi.aggiorna()
         finally:
             if cursor:
                 cursor.close()
@@ -545,23 +531,20 @@ class SuppletivoDialog(utility.GladeWindow):
         try:
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
-            cursor.execute(
-                "SELECT t.ID, t.Descrizione, t.PrezzoKg, t.Tipo, t.UnitaMin, r.Ordine FROM (tabacchi t LEFT JOIN (select * from rigaOrdineSuppletivo where ID_Ordine = ?) as r on r.ID = t.ID) where t.InMagazzino order by t.Tipo, t.Descrizione",
-                (self.idOrdine,))
-            result_set = cursor.fetchall()
-            self.ordineModel.clear()
+            cursor.execute("SELECT ID, Ordine FROM rigaOrdineSuppletivo where ID_Ordine = ?", (self.idOrdine,))
+            ordineDict = {row["ID"]: row["Ordine"] for row in cursor.fetchall()}
             self.totale = 0
             self.totaleKg = 0
-            for row in result_set:
+            rows = []
+            for row in sorted(catalogo.getCatalogo().inMagazzino, key=lambda articolo: (articolo["Tipo"], articolo["Descrizione"])):
                 idArt = row["ID"]
                 unitaMin = row["UnitaMin"]
                 prezzoKg = row["PrezzoKg"]
-                quantita = row["Ordine"]
-                if quantita is None:
-                    quantita = 0
-                self.ordineModel.append([idArt, row["Descrizione"], row["Tipo"], quantita, prezzoKg * unitaMin, quantita * prezzoKg, unitaMin, prezzoKg])
+                quantita = ordineDict.get(idArt, 0)
+                rows.append((idArt, row["Descrizione"], row["Tipo"], quantita, prezzoKg * unitaMin, quantita * prezzoKg, unitaMin, prezzoKg))
                 self.totaleKg += quantita
                 self.totale += (quantita * prezzoKg)
+            utility.ExtTreeView.bulkLoad(self.ordineModel, rows, treeviews=(self.ordineTreeview,))
         except sqlite3.Error as e:
             utility.gtkErrorMsg(e, self.suppletivoDialog)
         finally:
@@ -597,15 +580,12 @@ class SuppletivoDialog(utility.GladeWindow):
             try:
                 conn = prefs.getConn()
                 cursor = prefs.getCursor(conn)
-                cursor.execute("delete from rigaOrdineSuppletivo where ID_Ordine = ?", (self.idOrdine,))
+                righe = []
                 for row in self.ordineModel:
                     quantita = round(row[3], 3)  # Per evitare prob. con gli arrotondamenti
                     if quantita > 0:
-                        _id = row[0]
-                        descrizione = row[1]
-                        cursor.execute(
-                            "INSERT INTO rigaOrdineSuppletivo(ID, Descrizione, ID_Ordine, Ordine) VALUES(?, ?, ?, ?)",
-                            (_id, descrizione, self.idOrdine, quantita))
+                        righe.append((row[0], row[1], quantita))
+                repository.replaceRigheSuppletivo(cursor, self.idOrdine, righe)
                 cursor.execute("Update ordineTabacchi set DataSuppletivo = ?, Suppletivo = ? where ID = ?", (data, tipo, self.idOrdine))
                 conn.commit()
             except sqlite3.Error as e:
@@ -644,8 +624,71 @@ class SuppletivoDialog(utility.GladeWindow):
         self.suppletivoDialog.destroy()
 
 
+# Journal delle modifiche a un ordine non ancora scritte nel DB: una riga JSON per modifica,
+# scritta subito nel file senza attendere il disco (fsync). Cancellato quando le modifiche sono nel DB.
+class JournalOrdine:
+    PATTERN = "ordine-*.journal"
+
+    def __init__(self, idOrdine):
+        self.pathname = config.user_data_dir / f"ordine-{idOrdine}.journal"
+        self.idOrdine = idOrdine
+        self.file = None
+
+    # row: tupla (ID, Descrizione, Ordine, Prezzo, Giacenza, Consumo)
+    def append(self, row):
+        if self.file is None:
+            self.file = open(self.pathname, "a", buffering=1)
+        self.file.write(json.dumps(row) + "\n")
+
+    def clear(self):
+        self.close()
+        if self.pathname.exists():
+            self.pathname.unlink()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    # Ritorna le modifiche registrate, l'ultima per ogni articolo (le righe incomplete sono ignorate)
+    def rows(self):
+        rows = dict()
+        if not self.pathname.exists():
+            return []
+        with open(self.pathname, "r") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                rows[row[0]] = row
+        return list(rows.values())
+
+
+# Scrive nel DB le modifiche agli ordini rimaste nei journal (programma chiuso senza salvarle)
+def recuperaJournal():
+    for pathname in config.user_data_dir.glob(JournalOrdine.PATTERN):
+        try:
+            idOrdine = int(pathname.stem.split("-")[1])
+            journal = JournalOrdine(idOrdine)
+            rows = journal.rows()
+            with prefs.transaction() as cursor:
+                cursor.execute("SELECT ID FROM ordineTabacchi WHERE ID = ?", (idOrdine,))
+                if cursor.fetchone():
+                    repository.upsertRigheOrdine(cursor, idOrdine, rows)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            log.error(f"[recuperaJournal] {pathname}: {e}")
+        else:
+            log.info(f"[recuperaJournal] ordine {idOrdine}: recuperate {len(rows)} righe")
+            journal.clear()
+            prefs.setDBDirty()
+            consumi.aggiorna()
+
+
 class OrdineDialog(utility.GladeWindow):
     ID_QUANTITA, ID_ORDINE, ID_COSTO, ID_CONSUMO = (0, 1, 2, 3)
+    FLUSH_EDITS = 20        # Modifiche in memoria oltre le quali si scrive nel DB
+    FLUSH_IDLE = 5          # Secondi di inattività dopo i quali si scrive nel DB
 
     def __init__(self, parent, ordineID=None, mode=EDIT_MODE):
         super().__init__(parent, "ordineDialog.glade")
@@ -657,6 +700,12 @@ class OrdineDialog(utility.GladeWindow):
         self.mainIndex = 0
         self.mainTotal = 0
         self.ordineID = ordineID
+        self.previsioni = dict()
+        self.closed = False
+        # Modifiche non ancora scritte nel DB: {ID articolo: (ID, Descrizione, Ordine, Prezzo, Giacenza, Consumo)}
+        self.pendenti = dict()
+        self.flushTimeout = None
+        self.journal = None
 
         self.error = True
         cursor = None
@@ -664,10 +713,8 @@ class OrdineDialog(utility.GladeWindow):
         try:
             conn = prefs.getConn()
             cursor = prefs.getCursor(conn)
-            # Legge la lista dei record dei tabacchi
-            cursor.execute(
-                "SELECT t.ID, t.Descrizione, t.UnitaMin, t.PrezzoKg, t.PezziUnitaMin, t.LivelloMin, t.Tipo FROM tabacchi t where t.InMagazzino order by t.Tipo desc, t.Descrizione")
-            self.tabacchiList = cursor.fetchall()
+            # Lista dei tabacchi in magazzino
+            self.tabacchiList = catalogo.getCatalogo().inMagazzino
             self.mainSize = len(self.tabacchiList)
 
             if (self.mainSize == 0):
@@ -691,16 +738,16 @@ class OrdineDialog(utility.GladeWindow):
                     self.mainTotal += costo
                     self.ordineDict[row["ID"]] = [row["Giacenza"], ordine, costo, row["Consumo"]]
 
-            cursor.execute("select Data as 'Data [timestamp]', Stato, LastPos from ordineTabacchi where ID = ?", (self.ordineID,))
+            self.journal = JournalOrdine(self.ordineID)
+            self.__ripristinaJournal()
+            cursor.execute("select Data as 'Data [timestamp]', Stato, LastPos, ID_Precedente from ordineTabacchi where ID = ?", (self.ordineID,))
             row = cursor.fetchone()
             self.date = row["Data"]
             self.stato = row["Stato"]
             self.mainIndex = row["LastPos"]
 
             # memorizza tutte le quantita e il tabacco ordinato nell'ordine precedente
-            cursor.execute(
-                "SELECT ID, Ordine, Giacenza FROM rigaOrdineTabacchi where ID_Ordine = (select ID from ordineTabacchi where Data = (select max(Data) from ordineTabacchi where Data < ? order by Data desc))",
-                (self.date,))
+            cursor.execute("SELECT ID, Ordine, Giacenza FROM rigaOrdineTabacchi where ID_Ordine = ?", (row["ID_Precedente"],))
             resultset = cursor.fetchall()
             for row in resultset:
                 self.ordinePrecDict[row["ID"]] = [row["Giacenza"], row["Ordine"]]
@@ -734,6 +781,7 @@ class OrdineDialog(utility.GladeWindow):
             self.ordineSpinbutton = self.builder.get_object("ordineSpinbutton")
             self.totaleLabel = self.builder.get_object("totaleLabel")
             self.counterLabel = self.builder.get_object("counterLabel")
+            self.previsioniToolbutton = self.builder.get_object("previsioniToolbutton")
 
             self.ordineDialog.set_transient_for(parent)
 
@@ -744,6 +792,8 @@ class OrdineDialog(utility.GladeWindow):
                                           "on_nxtToolbutton_clicked": self.next,
                                           "on_preToolbutton_clicked": self.previous,
                                           "on_statsToolbutton_clicked": self.showStats,
+                                          "on_previsioniToolbutton_clicked": self.applicaPrevisioni,
+                                          "on_grigliaToolbutton_clicked": self.showGriglia,
                                           "on_quantitaSpinbutton_value_changed": self.quantitaChange,
                                           "on_ordineSpinbutton_value_changed": self.ordineChange})
             self.quantitaSpinbutton.set_sensitive(mode != VIEW_MODE)
@@ -756,6 +806,10 @@ class OrdineDialog(utility.GladeWindow):
             else:
                 self.mainIndex = self.mainSize - 1
                 self.__showInfo(self.mainIndex)
+
+            # Previsioni dei consumi calcolate in background
+            if mode == EDIT_MODE:
+                previsioni.PrevisioniThread(self.date, self.__previsioniCallback).start()
         finally:
             if cursor:
                 cursor.close()
@@ -773,55 +827,162 @@ class OrdineDialog(utility.GladeWindow):
             precOrdine = precTuple[self.ID_ORDINE]
         return (precQuantita + precOrdine) - quantita
 
-    # Aggiorna il DB e il dizionario con le quantità e gli ordini modificati
+    # Ordine suggerito per un articolo: fino al livello minimo oppure, se è maggiore, fino al consumo
+    # previsto per la prossima levata arrotondato per eccesso all'unità minima
+    def __suggerito(self, index, quantita):
+        articolo = self.tabacchiList[index]
+        previsto = self.previsioni.get(articolo["ID"])
+        if (previsto is None) or (previsto <= articolo["LivelloMin"]):
+            return round(max(articolo["LivelloMin"] - quantita, 0), 3)
+        ordine = previsto - quantita
+        unitaMin = articolo["UnitaMin"]
+        if unitaMin > 0:
+            ordine = math.ceil(round(ordine / unitaMin, 6)) * unitaMin
+        return round(max(ordine, 0), 3)
+
+    # Previsioni pronte (nel thread della GUI)
+    def __previsioniCallback(self, previsioni):
+        if not self.closed:
+            self.previsioni = previsioni
+            self.previsioniToolbutton.set_sensitive(len(previsioni) > 0)
+            self.__showLivello(self.mainIndex)
+
+    # Applica gli ordini suggeriti a tutti gli articoli di cui è stata inserita la giacenza
+    def applicaPrevisioni(self, widget):
+        self.__update()
+        if not self.__flush():
+            return
+        modifiche = []
+        for index, articolo in enumerate(self.tabacchiList):
+            idArt = articolo["ID"]
+            if idArt in self.ordineDict:
+                ordine = self.__suggerito(index, self.ordineDict[idArt][self.ID_QUANTITA])
+                if ordine != round(self.ordineDict[idArt][self.ID_ORDINE], 3):
+                    modifiche.append((idArt, articolo["Descrizione"], ordine, articolo["PrezzoKg"]))
+
+        if len(modifiche) == 0:
+            return
+        msgDialog = Gtk.MessageDialog(parent=self.ordineDialog, modal=True, message_type=Gtk.MessageType.QUESTION,
+                                      buttons=Gtk.ButtonsType.YES_NO, text=f"Applicare gli ordini suggeriti a {len(modifiche)} articoli?")
+        msgDialog.format_secondary_text("Sono modificati solo gli articoli di cui è stata inserita la giacenza.")
+        msgDialog.set_title("Ordini suggeriti")
+        response = msgDialog.run()
+        msgDialog.destroy()
+        if response != Gtk.ResponseType.YES:
+            return
+
+        try:
+            with prefs.transaction() as cursor:
+                repository.upsertOrdinato(cursor, self.ordineID, modifiche)
+        except sqlite3.Error as e:
+            utility.gtkErrorMsg(e, self.ordineDialog)
+        else:
+            for idArt, _, ordine, prezzo in modifiche:
+                data = self.ordineDict[idArt]
+                self.mainTotal += ordine * prezzo - data[self.ID_COSTO]
+                data[self.ID_ORDINE] = ordine
+                data[self.ID_COSTO] = ordine * prezzo
+            prefs.setDBDirty()
+            consumi.aggiorna()
+            self.__showInfo(self.mainIndex)
+
+    # Aggiorna il dizionario con le quantità e gli ordini modificati
     def __update(self):
         if self.dirtyFlag:
             self.dirtyFlag = False
-            idArt = self.tabacchiList[self.mainIndex]["ID"]
-            ordine = round(self.ordineSpinbutton.get_value(), 3)
-            prezzo = self.tabacchiList[self.mainIndex]["PrezzoKg"]
-            costo = ordine * prezzo
-            quantita = round(self.quantitaSpinbutton.get_value(), 3)
-            consumo = self.__calcolaConsumo(idArt, quantita)
+            self.modifica(self.mainIndex, round(self.quantitaSpinbutton.get_value(), 3), round(self.ordineSpinbutton.get_value(), 3))
+
+    # Registra giacenza e ordine di un articolo nel dizionario e nel journal; il DB è aggiornato da __flush.
+    # Ritorna (consumo, costo)
+    def modifica(self, index, quantita, ordine):
+        articolo = self.tabacchiList[index]
+        idArt = articolo["ID"]
+        prezzo = articolo["PrezzoKg"]
+        costo = ordine * prezzo
+        consumo = self.__calcolaConsumo(idArt, quantita)
+
+        # se questo articolo esiste (ha quantità o ordine inseriti)
+        # si toglie il vecchio costo dal totale
+        if idArt in self.ordineDict:
+            data = self.ordineDict[idArt]
+            self.mainTotal -= data[self.ID_COSTO]
+
+        self.ordineDict[idArt] = [quantita, ordine, costo, consumo]
+        self.mainTotal += costo
+
+        row = (idArt, articolo["Descrizione"], ordine, float(prezzo), quantita, float(consumo))
+        self.pendenti[idArt] = row
+        try:
+            self.journal.append(row)
+        except OSError as e:
+            log.error(f"[OrdineDialog] journal non disponibile: {e}")
 
-            # se questo articolo esiste (ha quantità o ordine inseriti)
-            # si toglie il vecchio costo dal totale
+        if len(self.pendenti) >= self.FLUSH_EDITS:
+            self.__flush()
+        else:
+            if self.flushTimeout:
+                GLib.source_remove(self.flushTimeout)
+            self.flushTimeout = GLib.timeout_add_seconds(self.FLUSH_IDLE, self.__flushIdle)
+        return (consumo, costo)
+
+    def __flushIdle(self):
+        self.flushTimeout = None
+        self.__flush()
+        return False
+
+    # Le modifiche rimaste nel journal (scrittura nel DB non riuscita) tornano tra quelle da scrivere,
+    # in modo che il journal non venga cancellato dal prossimo __flush prima che siano nel DB
+    def __ripristinaJournal(self):
+        try:
+            rows = self.journal.rows()
+        except OSError as e:
+            log.error(f"[OrdineDialog] journal non leggibile: {e}")
+            return
+        for row in rows:
+            (idArt, _, ordine, prezzo, quantita, consumo) = row
             if idArt in self.ordineDict:
-                data = self.ordineDict[idArt]
-                self.mainTotal -= data[self.ID_COSTO]
-
+                self.mainTotal -= self.ordineDict[idArt][self.ID_COSTO]
+            costo = ordine * prezzo
             self.ordineDict[idArt] = [quantita, ordine, costo, consumo]
             self.mainTotal += costo
+            self.pendenti[idArt] = tuple(row)
+        if rows:
+            log.info(f"[OrdineDialog] ordine {self.ordineID}: {len(rows)} modifiche dal journal da scrivere")
+
+    # Scrive nel DB le modifiche in memoria, in una sola transazione
+    def __flush(self):
+        if self.flushTimeout:
+            GLib.source_remove(self.flushTimeout)
+            self.flushTimeout = None
+        if len(self.pendenti) == 0:
+            return True
+        try:
+            with prefs.transaction() as cursor:
+                repository.upsertRigheOrdine(cursor, self.ordineID, self.pendenti.values())
+        except sqlite3.Error as e:
+            utility.gtkErrorMsg(e, self.ordineDialog)
+            return False
+        log.debug(f"[OrdineDialog] scritte {len(self.pendenti)} righe")
+        self.pendenti.clear()
+        self.journal.clear()
+        prefs.setDBDirty()
+        consumi.aggiorna()
+        return True
 
-            cursor = None
-            conn = None
-            try:
-                conn = prefs.getConn()
-                cursor = prefs.getCursor(conn)
-                cursor.execute("UPDATE rigaOrdineTabacchi SET Ordine=?, Giacenza=?, Consumo=? WHERE ID = ? and ID_Ordine = ?",
-                               (ordine, quantita, float(consumo), idArt, self.ordineID))
-                if cursor.rowcount == 0:
-                    descrizione = self.tabacchiList[self.mainIndex]["Descrizione"]
-                    cursor.execute(
-                        "INSERT INTO rigaOrdineTabacchi(ID, ID_Ordine, Descrizione, Ordine, Prezzo, Giacenza, Consumo) VALUES(?, ?, ?, ?, ?, ?, ?)",
-                        (idArt, self.ordineID, descrizione, ordine, float(prezzo),
-                         quantita, float(consumo)))
-
-                conn.commit()
-            except sqlite3.Error as e:
-                if conn:
-                    conn.rollback()
-                utility.gtkErrorMsg(e, self.ordineDialog)
-            else:
-                prefs.setDBDirty()
-            finally:
-                if cursor:
-                    cursor.close()
-                if conn:
-                    conn.close()
+    # Passa all'inserimento a griglia e torna sull'ultimo articolo modificato
+    def showGriglia(self, widget):
+        self.__update()
+        grigliaDialog = OrdineGrigliaDialog(self.ordineDialog, self)
+        grigliaDialog.run()
+        self.mainIndex = grigliaDialog.index
+        self.__showInfo(self.mainIndex)
 
     # Mostra statistiche sull'articolo corrente
     def showStats(self, widget):
+        # Le statistiche leggono dal DB: prima si scrivono le modifiche in memoria
+        self.__update()
+        if not self.__flush():
+            return
         idArt = self.tabacchiList[self.mainIndex]["ID"]
         statsDialog = stats.StatsDialog(self.ordineDialog, idArt)
         statsDialog.run()
@@ -832,7 +993,7 @@ class OrdineDialog(utility.GladeWindow):
         self.dirtyFlag = True
         # aggiornamento campi ordineSpinButton e consumoLabel
         if self.mode == EDIT_MODE:
-            self.ordineSpinbutton.set_value(self.tabacchiList[self.mainIndex]["LivelloMin"] - widget.get_value())
+            self.ordineSpinbutton.set_value(self.__suggerito(self.mainIndex, widget.get_value()))
         idList = self.tabacchiList[self.mainIndex]["ID"]
         self.consumoLabel.set_text(locale.format_string("%.3f kg", self.__calcolaConsumo(idList, widget.get_value())))
 
@@ -871,6 +1032,14 @@ class OrdineDialog(utility.GladeWindow):
         self.mainIndex = (self.mainIndex + 10) % self.mainSize
         self.__showInfo(self.mainIndex)
 
+    # Livello minimo e consumo previsto fino alla prossima levata
+    def __showLivello(self, index):
+        testo = locale.format_string("%.3f kg", self.tabacchiList[index]["LivelloMin"])
+        previsto = self.previsioni.get(self.tabacchiList[index]["ID"])
+        if previsto is not None:
+            testo += locale.format_string(" (previsti %.3f kg)", previsto)
+        self.livelloLabel.set_text(testo)
+
     def __showInfo(self, index):
         idArticolo = self.tabacchiList[index]["ID"]
         unitaMin = self.tabacchiList[index]["UnitaMin"]
@@ -887,7 +1056,7 @@ class OrdineDialog(utility.GladeWindow):
         self.pezziUnitaLabel.set_text("%i" % pezziUnitaMin)
         self.prezzoLabel.set_text(locale.currency(prezzoKg, True, True))
         self.prezzoConfLabel.set_text(locale.currency(prezzoConf, True, True))
-        self.livelloLabel.set_text(locale.format_string("%.3f kg", self.tabacchiList[index]["LivelloMin"]))
+        self.__showLivello(index)
 
         # Se l'articolo e' stato ordinato
         if idArticolo in self.ordineDict:
@@ -925,7 +1094,12 @@ class OrdineDialog(utility.GladeWindow):
         return self.result
 
     def close(self, widget, event=None):
+        self.closed = True
         self.__update()
+        # Se la scrittura non riesce le modifiche restano nel journal e saranno recuperate al riavvio
+        self.__flush()
+        if self.journal:
+            self.journal.close()
 
         cursor = None
         conn = None
@@ -945,3 +1119,98 @@ class OrdineDialog(utility.GladeWindow):
             if conn:
                 conn.close()
         self.ordineDialog.destroy()
+
+
+# Inserimento di giacenze e ordini su una griglia con tutti gli articoli:
+# Invio conferma il valore e passa alla riga successiva. Le modifiche sono registrate
+# dall'OrdineDialog che la apre (OrdineDialog.modifica), con le stesse regole di scrittura nel DB.
+class OrdineGrigliaDialog(utility.GladeWindow):
+    CODICE, DESCRIZIONE, TIPO, LIVELLO, GIACENZA, CONSUMO, ORDINE, IMPORTO, INDICE, UNITA_MIN = range(10)
+
+    def __init__(self, parent, ordineDialog):
+        super().__init__(parent, "ordineGrigliaDialog.glade")
+        self.ordineDialog = ordineDialog
+        self.index = ordineDialog.mainIndex
+
+        self.ordineGrigliaDialog = self.builder.get_object("ordineGrigliaDialog")
+        self.ordineGrigliaDialog.set_transient_for(parent)
+        self.ordineGrigliaDialog.set_title("Ordine %s" % ordineDialog.date.strftime("%d %b %Y - %H:%M"))
+        self.ordineTreeview = self.builder.get_object("tabacchiTreeView")
+        self.totaleLabel = self.builder.get_object("totaleLabel")
+
+        modGiacenza = "*" if ordineDialog.mode != VIEW_MODE else ""
+        modOrdine = "*" if ordineDialog.mode == EDIT_MODE else ""
+        modelInfoList = [
+            ("Codice", "str"),
+            ("+Descrizione", "str"),
+            ("Tipo", "str"),
+            ("Livello min.", "float"),
+            (f"{modGiacenza}Giacenza", "float#3,3/i9,0,999"),
+            ("Consumo", "float"),
+            (f"{modOrdine}Ordine", "float#3,3/i9,0,999"),
+            ("Importo", "currency"),
+            (None, "int"),
+            (None, "float")]
+        grigliaProp = {self.TIPO: {"xalign": 0.5, "scale": utility.PANGO_SCALE_SMALL}}
+        extTreeView = utility.ExtTreeView(modelInfoList, self.ordineTreeview, edit_callbacks={self.GIACENZA: self.__changeValue, self.ORDINE: self.__changeValue},
+                                          properties=grigliaProp)
+        self.ordineModel = self.ordineTreeview.get_model()
+        # Colonne della treeview in editing, per colonna del modello (le posizioni nella vista possono essere diverse)
+        self.colonne = {self.GIACENZA: extTreeView.columns[self.GIACENZA], self.ORDINE: extTreeView.columns[self.ORDINE]}
+
+        self.totaleKg = 0
+        rows = []
+        for index, articolo in enumerate(ordineDialog.tabacchiList):
+            data = ordineDialog.ordineDict.get(articolo["ID"])
+            quantita, ordine, costo, consumo = (data[OrdineDialog.ID_QUANTITA], data[OrdineDialog.ID_ORDINE], data[OrdineDialog.ID_COSTO],
+                                                float(data[OrdineDialog.ID_CONSUMO])) if data else (0, 0, 0, 0)
+            rows.append((articolo["ID"], articolo["Descrizione"], articolo["Tipo"], articolo["LivelloMin"],
+                         quantita, consumo, ordine, costo, index, articolo["UnitaMin"]))
+            self.totaleKg += ordine
+        utility.ExtTreeView.bulkLoad(self.ordineModel, rows, treeviews=(self.ordineTreeview,))
+        self.__showTotale()
+
+        self.ordineGrigliaDialog.connect("show", self.__startEditing)
+
+    def __showTotale(self):
+        self.totaleLabel.set_text(f"Peso: {locale.format_string('%.3f', self.totaleKg)} kg   Importo: {locale.currency(self.ordineDialog.mainTotal, True, True)}")
+
+    # Parte dall'articolo corrente dell'OrdineDialog, con la prima colonna modificabile in editing
+    def __startEditing(self, widget):
+        path = Gtk.TreePath.new_from_indices([self.index])
+        self.ordineTreeview.scroll_to_cell(path, None, True, 0.5, 0)
+        if self.ordineDialog.mode != VIEW_MODE:
+            self.ordineTreeview.set_cursor(path, self.colonne[self.GIACENZA], True)
+        else:
+            self.ordineTreeview.set_cursor(path, None, False)
+
+    def __changeValue(self, widget, path, value, model, col_id):
+        row = model[path]
+        value = round(value, 3)
+        self.index = row[self.INDICE]
+        # Confermare un valore invariato (scorrendo con Invio) non registra modifiche
+        if value != row[col_id]:
+            oldOrdine = row[self.ORDINE]
+            row[col_id] = value
+            consumo, costo = self.ordineDialog.modifica(self.index, row[self.GIACENZA], row[self.ORDINE])
+            row[self.CONSUMO] = float(consumo)
+            row[self.IMPORTO] = costo
+            self.totaleKg += row[self.ORDINE] - oldOrdine
+            self.__showTotale()
+        GLib.idle_add(self.__nextRow, path, col_id)
+
+    # Invio: modifica la stessa colonna nella riga successiva, se il cursore non è stato spostato altrove
+    def __nextRow(self, path, col_id):
+        cursorPath, _ = self.ordineTreeview.get_cursor()
+        if (cursorPath is not None) and (cursorPath.to_string() == path):
+            nextIndex = cursorPath.get_indices()[0] + 1
+            if nextIndex < len(self.ordineModel):
+                nextPath = Gtk.TreePath.new_from_indices([nextIndex])
+                self.ordineTreeview.scroll_to_cell(nextPath, None, False, 0, 0)
+                self.ordineTreeview.set_cursor(nextPath, self.colonne[col_id], True)
+        return False
+
+    def run(self):
+        result = self.ordineGrigliaDialog.run()
+        self.ordineGrigliaDialog.destroy()
+        return result
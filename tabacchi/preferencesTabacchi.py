@@ -3,15 +3,21 @@
 #
 
 import configparser
+import contextlib
 import keyring
+import os
 import sqlite3
 import subprocess
+import threading
 import bluetooth
 import gi
 import datetime
 
 from . import config
 from .config import log
+from . import regolePezzi
+from . import schema
+from . import sqltrace
 from . import utility
 from .utility import WorkerThread
 
@@ -141,6 +147,228 @@ class ReadBarcodeThread(WorkerThread):
         return False
 
 
+# Connessione riutilizzabile: close() non chiude realmente la connessione, ma quando
+# l'ultimo utilizzatore la rilascia annulla le eventuali transazioni rimaste aperte
+class PooledConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.users = 0
+        self.tracer = None
+
+    # Con il tracing attivo ritorna un cursore che misura gli statement
+    # (creato da super().cursor perché erediti il row_factory della connessione)
+    def cursor(self, factory=sqlite3.Cursor):
+        if self.tracer and factory is sqlite3.Cursor:
+            return super().cursor(lambda conn: sqltrace.TracingCursor(conn, self.tracer))
+        return super().cursor(factory)
+
+    # conn.execute ed executemany non passano da cursor(), per cui vanno ridefiniti
+    def execute(self, sql, parameters=()):
+        if self.tracer:
+            return self.cursor().execute(sql, parameters)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.tracer:
+            return self.cursor().executemany(sql, seq_of_parameters)
+        return super().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.users > 0:
+            self.users -= 1
+        if (self.users == 0) and self.in_transaction:
+            self.rollback()
+
+    # Chiude definitivamente la connessione
+    def dispose(self):
+        super().close()
+
+
+# Gestisce una connessione persistente per ogni thread (il main thread GTK e i WorkerThread)
+class ConnectionManager:
+    CACHED_STATEMENTS = 256
+    BUSY_TIMEOUT = 10.0     # secondi di attesa prima di "database is locked"
+    WAL_AUTOCHECKPOINT = 10000      # pagine (circa 40 MB con pagine da 4 KB)
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.walMode = False
+        self.checkpointThread = None
+        self.tracer = None
+
+    # Apre una nuova connessione configurata per l'applicazione.
+    # Le connessioni raw non convertono i tipi e ritornano tuple (vedi repository.fetchRows)
+    def __open(self, raw=False):
+        conn = sqlite3.connect(self.pathname, detect_types=0 if raw else sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               factory=PooledConnection, cached_statements=self.CACHED_STATEMENTS,
+                               timeout=self.BUSY_TIMEOUT)
+        if not raw:
+            conn.row_factory = sqlite3.Row
+        conn.text_factory = str
+        conn.tracer = self.tracer
+        conn.execute("pragma foreign_keys=ON;")
+        if self.walMode:
+            # In WAL i checkpoint li esegue il CheckpointThread; l'autocheckpoint resta con una soglia alta
+            # solo come riserva, perché il WAL non cresca senza limiti se il thread si ferma
+            conn.execute("pragma synchronous=NORMAL;")
+            conn.execute("pragma wal_autocheckpoint=%d;" % self.WAL_AUTOCHECKPOINT)
+        with self.lock:
+            self.opened += 1
+        log.debug("[ConnectionManager] nuova connessione per il thread %s" % threading.current_thread().name)
+        return conn
+
+    # Ritorna la connessione del thread corrente (creandola la prima volta)
+    def getConn(self, raw=False):
+        name = 'rawConn' if raw else 'conn'
+        conn = getattr(self.local, name, None)
+        if conn is None:
+            conn = self.__open(raw)
+            setattr(self.local, name, conn)
+        conn.users += 1
+        return conn
+
+    # Imposta il journal mode del DB (WAL o rollback journal) e avvia/ferma il thread dei checkpoint
+    def setJournalMode(self, walMode, checkpointInterval):
+        self.stopCheckpoint()
+        self.release()
+        self.walMode = walMode
+        conn = self.getConn()
+        try:
+            mode = conn.execute("pragma journal_mode=%s;" % ("WAL" if walMode else "DELETE")).fetchone()[0]
+        finally:
+            conn.close()
+        log.debug("[ConnectionManager] journal mode: %s" % mode)
+        self.walMode = (mode.lower() == "wal")
+        if self.walMode:
+            self.checkpointThread = CheckpointThread(self, checkpointInterval)
+            self.checkpointThread.start()
+        else:
+            # Riapre la connessione senza le impostazioni specifiche del WAL
+            self.release()
+
+    # Ferma il thread dei checkpoint
+    def stopCheckpoint(self):
+        if self.checkpointThread:
+            self.checkpointThread.stop()
+            self.checkpointThread.join()
+            self.checkpointThread = None
+
+    # Esegue un checkpoint e ritorna la tupla (busy, pagine nel WAL, pagine trasferite nel DB)
+    def checkpoint(self, mode="PASSIVE"):
+        conn = self.getConn()
+        try:
+            return tuple(conn.execute("pragma wal_checkpoint(%s);" % mode).fetchone())
+        finally:
+            conn.close()
+
+    # Dimensione in byte del file WAL
+    def walSize(self):
+        try:
+            return os.path.getsize(f"{self.pathname}-wal")
+        except OSError:
+            return 0
+
+    # Statistiche sui checkpoint
+    def getStats(self):
+        stats = {'walMode': self.walMode, 'walSize': self.walSize()}
+        if self.checkpointThread:
+            stats.update(self.checkpointThread.getStats())
+        return stats
+
+    # Chiude la connessione del thread corrente
+    def release(self):
+        for name in ('conn', 'rawConn'):
+            conn = getattr(self.local, name, None)
+            if conn is not None:
+                setattr(self.local, name, None)
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.dispose()
+
+    # Esegue il blocco in una transazione: commit se termina correttamente, rollback altrimenti
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.getConn()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+
+# Thread che esegue periodicamente i checkpoint del WAL, in modo che il file non cresca
+# senza limiti e che i checkpoint non blocchino il main thread
+class CheckpointThread(threading.Thread):
+    def __init__(self, manager, interval):
+        super().__init__(name="CheckpointThread", daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self.stopEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.busyCount = 0
+        self.pagesCheckpointed = 0
+        self.maxWalSize = 0
+        self.lastWalSize = 0
+        self.lastCheckpoint = None
+        self.totalTime = 0.0
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def getStats(self):
+        with self.lock:
+            return {'checkpoints': self.count,
+                    'busy': self.busyCount,
+                    'pages': self.pagesCheckpointed,
+                    'maxWalSize': self.maxWalSize,
+                    'lastWalSize': self.lastWalSize,
+                    'lastCheckpoint': self.lastCheckpoint,
+                    'avgTime': (self.totalTime / self.count) if self.count else 0.0}
+
+    # Ritorna data_version, che cambia solo quando altre connessioni modificano il DB
+    def __dataVersion(self):
+        conn = self.manager.getConn()
+        try:
+            return conn.execute("pragma data_version;").fetchone()[0]
+        finally:
+            conn.close()
+
+    def run(self):
+        lastVersion = None
+        try:
+            while not self.stopEvent.wait(self.interval):
+                walSize = self.manager.walSize()
+                version = self.__dataVersion()
+                if (walSize == 0) or (version == lastVersion):
+                    continue
+                start = datetime.datetime.now()
+                busy, walPages, pages = self.manager.checkpoint("PASSIVE")
+                # Se il checkpoint non è stato completo si riprova al prossimo giro
+                lastVersion = version if (not busy and walPages == pages) else None
+                elapsed = (datetime.datetime.now() - start).total_seconds()
+                with self.lock:
+                    self.count += 1
+                    self.busyCount += busy
+                    self.pagesCheckpointed += pages
+                    self.maxWalSize = max(self.maxWalSize, walSize)
+                    self.lastWalSize = walSize
+                    self.lastCheckpoint = start
+                    self.totalTime += elapsed
+        except sqlite3.Error as e:
+            log.error(f"Checkpoint thread exception: {e}")
+        finally:
+            self.manager.release()
+
+
 # Opzioni del programma
 class Preferences(utility.Preferences):
     TABACCHI_STR = "Logista Website password"
@@ -174,18 +402,64 @@ class Preferences(utility.Preferences):
         self.defaultBarcode = -1
         self.barcodeList = []
         self.pianoConsegneList = []
+        self.walMode = False
+        self.checkpointInterval = 30
+        self.sqlTrace = False
+        self.sqlTraceThreshold = 100    # ms
+        self.anniArchivio = 5           # ordini più vecchi spostati nell'archivio
+        self.regolePezzi = list(regolePezzi.REGOLE_DEFAULT)     # (espressione, formula) per PezziUnitaMin
+        self.connectionManager = ConnectionManager(self.DB_PATHNAME)
 
     # Controlla se è possibile ottenere una connessione con la configurazione attuale
     def checkDB(self):
         return self.DB_PATHNAME.exists()
 
-    # Ritorna una nuova connessione
+    # Ritorna la connessione del thread corrente (close() la rilascia senza chiuderla)
     def getConn(self):
-        conn = sqlite3.connect(self.DB_PATHNAME, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = str
-        conn.execute("pragma foreign_keys=ON;")
-        return conn
+        return self.connectionManager.getConn()
+
+    # Ritorna la connessione senza conversione dei tipi del thread corrente, per le letture veloci
+    def getRawConn(self):
+        return self.connectionManager.getConn(raw=True)
+
+    # Chiude le connessioni del thread corrente: va chiamata alla fine dei thread che usano il DB,
+    # altrimenti le loro connessioni restano aperte e possono bloccare il checkpoint finale
+    def releaseConn(self):
+        self.connectionManager.release()
+
+    # Context manager che restituisce un cursore e gestisce commit e rollback
+    def transaction(self):
+        return self.connectionManager.transaction()
+
+    # Imposta il journal mode e il tracing degli statement in base alle preferenze
+    def setupDB(self):
+        self.connectionManager.tracer = sqltrace.Tracer(self.sqlTraceThreshold / 1000) if self.sqlTrace else None
+        self.connectionManager.setJournalMode(self.walMode, self.checkpointInterval)
+
+    # Aggiorna lo schema del DB all'ultima versione
+    def migrateDB(self):
+        conn = self.getConn()
+        try:
+            applied = schema.migrate(conn)
+        finally:
+            conn.close()
+        if applied > 0:
+            log.debug(f"[schema] applicate {applied} migrazioni, versione {schema.SCHEMA_VERSION}")
+            self.setDBDirty()
+
+    # Chiude la connessione del thread corrente, trasferendo prima nel DB il contenuto del WAL
+    def closeConn(self):
+        manager = self.connectionManager
+        manager.stopCheckpoint()
+        if manager.walMode:
+            try:
+                manager.checkpoint("TRUNCATE")
+            except sqlite3.Error as e:
+                log.error(f"Checkpoint error: {e}")
+            log.debug(f"[WAL] statistiche: {manager.getStats()}")
+        manager.release()
+        if manager.tracer:
+            manager.tracer.writeReport(config.user_log_dir / 'sqltrace.log')
 
     # Ritorna un cursore, data una connessione
     def getCursor(self, conn):
@@ -207,6 +481,17 @@ class Preferences(utility.Preferences):
                 i += 1
                 self.barcodeList.append([device, addr, port])
 
+        # Regole per il n. di pezzi delle confezioni, in ordine di priorità
+        if config.has_section('RegolePezzi'):
+            self.regolePezzi = []
+            i = 0
+            while config.has_option('RegolePezzi', f'regola{i}'):
+                try:
+                    self.regolePezzi.append(regolePezzi.parseRegola(config.get('RegolePezzi', f'regola{i}')))
+                except (ValueError, configparser.Error) as e:
+                    log.error(f"[regolePezzi] {e}")
+                i += 1
+
         if config.has_section("Tabacchi"):
             tabacchi = config['Tabacchi']
             self.numRivendita = tabacchi.get('numRivendita', '')
@@ -231,6 +516,11 @@ class Preferences(utility.Preferences):
             self.tabacchiUser = tabacchi.get('user', '')
             self.catalogoUrl = tabacchi.get('catalogoUrl', '')
             self.loginUrl = tabacchi.get('loginUrl', '')
+            self.walMode = tabacchi.getboolean('walMode', False)
+            self.checkpointInterval = tabacchi.getint('checkpointInterval', 30)
+            self.sqlTrace = tabacchi.getboolean('sqlTrace', False)
+            self.sqlTraceThreshold = tabacchi.getint('sqlTraceThreshold', 100)
+            self.anniArchivio = tabacchi.getint('anniArchivio', 5)
 
             value = keyring.get_password(self.TABACCHI_STR, self.tabacchiUser)
             if value:
@@ -283,11 +573,21 @@ class Preferences(utility.Preferences):
                               'firmaH': self.firmaH,
                               'user': self.tabacchiUser,
                               'catalogoUrl': self.catalogoUrl,
-                              'loginUrl': self.loginUrl
+                              'loginUrl': self.loginUrl,
+                              'walMode': self.walMode,
+                              'checkpointInterval': self.checkpointInterval,
+                              'sqlTrace': self.sqlTrace,
+                              'sqlTraceThreshold': self.sqlTraceThreshold,
+                              'anniArchivio': self.anniArchivio
                               }
 
         keyring.set_password(self.TABACCHI_STR, self.tabacchiUser, self.tabacchiPwd)
 
+        config['RegolePezzi'] = {}
+        for i, regola in enumerate(self.regolePezzi):
+            # Le espressioni regolari possono contenere '%', che nel file di configurazione va raddoppiato
+            config.set('RegolePezzi', f'regola{i}', regolePezzi.formatRegola(regola).replace('%', '%%'))
+
         if self.pianoConsegneDaSito:
             config["PianoLevate"] = {}
             for row in self.pianoConsegneList:
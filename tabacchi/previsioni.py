@@ -0,0 +1,153 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import datetime
+import threading
+import time
+
+import numpy as np
+import gi
+
+from . import analisi
+from .config import log
+from .preferencesTabacchi import prefs
+from . import preferencesTabacchi
+
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib  # noqa: E402
+
+# Previsione dei consumi con smorzamento esponenziale con trend (Holt) sul consumo settimanale
+# di ogni articolo, calcolato dallo storico degli ordini (analisi.Storico)
+ALPHA = 0.3     # peso delle nuove osservazioni sul livello
+BETA = 0.1      # peso delle nuove osservazioni sul trend
+PHI = 0.9       # smorzamento del trend sull'orizzonte di previsione
+
+
+# Consumo settimanale (kg) di ogni riga degli ordini nelle colonne da inizio a fine (esclusa), NaN dove non calcolabile.
+# Il consumo di una riga copre il periodo dalla riga precedente dello stesso articolo.
+def consumiSettimanali(storico, inizio, fine):
+    presente = storico.presente[:, :fine]
+    n = presente.shape[1]
+    if n == 0:
+        # Nessun ordine prima di fine
+        return np.full((presente.shape[0], 0), np.nan)
+    # Colonna della riga precedente dello stesso articolo (-1 se non c'è)
+    indici = np.where(presente, np.arange(n), -1)
+    ultima = np.maximum.accumulate(indici, axis=1)
+    precedente = np.concatenate((np.full((presente.shape[0], 1), -1), ultima[:, :-1]), axis=1)[:, inizio:]
+    giorni = storico.date[:fine].astype(np.int64) / 86400.0
+    settimane = (giorni[inizio:] - giorni[precedente.clip(min=0)]) / 7
+    valide = presente[:, inizio:] & (precedente >= 0)
+    consumo = storico.consumo[:, inizio:fine].clip(min=0) / np.maximum(settimane, 1 / 7)
+    return np.where(valide, consumo, np.nan)
+
+
+# Livello e trend del consumo settimanale per ogni articolo, usando gli ordini fino alla colonna fine (esclusa)
+def holt(storico, fine):
+    consumi = consumiSettimanali(storico, 0, fine)
+    livello = np.zeros(consumi.shape[0])
+    trend = np.zeros(consumi.shape[0])
+    iniziato = np.zeros(consumi.shape[0], dtype=bool)
+    for j in range(consumi.shape[1]):
+        valide = ~np.isnan(consumi[:, j])
+        if not valide.any():
+            continue
+        x = consumi[valide, j]
+        l0, b0 = livello[valide], trend[valide]
+        nuove = ~iniziato[valide]
+        l1 = np.where(nuove, x, ALPHA * x + (1 - ALPHA) * (l0 + b0))
+        b1 = np.where(nuove, 0, BETA * (l1 - l0) + (1 - BETA) * b0)
+        livello[valide], trend[valide] = l1, b1
+        iniziato[valide] = True
+    return (livello, trend, iniziato)
+
+
+# Consumo previsto (kg) nelle prossime settimane con trend smorzato
+def prevedi(livello, trend, settimane):
+    smorzamento = sum(PHI ** k for k in range(1, int(np.ceil(settimane)) + 1))
+    return (livello * settimane + trend * smorzamento).clip(min=0)
+
+
+# Settimane da coprire con un ordine fatto in data: dalla sua levata a quella dell'ordine successivo.
+# Non dipende da quando si calcola: per un ordine vecchio il piano consegne dal sito ha solo le levate
+# future, ma l'intervallo tra due levate consecutive resta quello di un ordine.
+def orizzonte(data):
+    (dataOrdine, levata) = preferencesTabacchi.dataLimiteOrdine(data)
+    (_, levataSuccessiva) = preferencesTabacchi.dataLimiteOrdine(dataOrdine + datetime.timedelta(seconds=1))
+    return max((levataSuccessiva - levata).days / 7, 1)
+
+
+# Livelli minimi consigliati: percentile del consumo settimanale nell'ultimo anno, moltiplicato
+# per le settimane di copertura (tempo tra la levata di un ordine e quella dell'ordine successivo).
+# Ritorna {ID articolo: livello in kg} per gli articoli con almeno OSSERVAZIONI_MIN righe.
+PERCENTILE_LIVELLO = 90
+OSSERVAZIONI_MIN = 4
+
+
+def livelliMinimi(data=None):
+    if data is None:
+        data = datetime.datetime.now().replace(microsecond=0)
+    storico = analisi.getStorico()
+    periodo = storico.colonne(np.datetime64(data - datetime.timedelta(days=365), 's'), np.datetime64(data, 's'))
+    if periodo.start == periodo.stop:
+        # Nessun ordine nell'ultimo anno
+        return {}
+    consumi = consumiSettimanali(storico, periodo.start, periodo.stop)
+    osservazioni = (~np.isnan(consumi)).sum(axis=1)
+    validi = osservazioni >= OSSERVAZIONI_MIN
+    percentili = np.zeros(consumi.shape[0])
+    if validi.any():
+        percentili[validi] = np.nanpercentile(consumi[validi], PERCENTILE_LIVELLO, axis=1)
+    livelli = percentili * orizzonte(data)
+    return {idArt: float(livello) for idArt, livello, valido in zip(storico.articoli.tolist(), livelli, validi) if valido}
+
+
+# Previsioni già calcolate, per (versione dei dati, data dell'ordine)
+__cache = {}
+__lock = threading.Lock()
+
+
+# Ritorna {ID articolo: consumo previsto fino alla levata successiva} per un ordine con la data indicata.
+# Sono usati solo gli ordini precedenti.
+def previsioniOrdine(data):
+    chiave = (prefs.dataVersion, data)
+    with __lock:
+        if chiave in __cache:
+            return __cache[chiave]
+
+    start = time.perf_counter()
+    storico = analisi.getStorico()
+    fine = storico.colonne("1970-01-01", np.datetime64(data, 's'))
+    if fine.stop == 0:
+        # Primo ordine: nessuno storico da cui prevedere
+        log.debug("[previsioni] nessun ordine precedente")
+        return {}
+    livello, trend, iniziato = holt(storico, fine.stop)
+    settimane = orizzonte(data)
+    previsto = prevedi(livello, trend, settimane)
+    previsioni = {idArt: round(float(valore), 3) for idArt, valore, valido in zip(storico.articoli.tolist(), previsto, iniziato) if valido}
+    log.debug(f"[previsioni] {len(previsioni)} articoli, orizzonte {settimane:.1f} settimane, in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    with __lock:
+        __cache.clear()
+        __cache[chiave] = previsioni
+    return previsioni
+
+
+# Calcola in background le previsioni per un ordine e le passa a callback(previsioni) nel thread della GUI
+class PrevisioniThread(threading.Thread):
+    def __init__(self, data, callback):
+        super().__init__(daemon=True)
+        self.data = data
+        self.callback = callback
+
+    def run(self):
+        try:
+            previsioni = previsioniOrdine(self.data)
+        except Exception as e:
+            log.error(f"[previsioni] calcolo non riuscito: {e}")
+        else:
+            GLib.idle_add(self.callback, previsioni)
+        finally:
+            prefs.releaseConn()
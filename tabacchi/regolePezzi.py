@@ -0,0 +1,85 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import ast
+import re
+
+from .config import log
+
+# Regole per ricavare dalla descrizione Logista il n. di pezzi in una confezione (PezziUnitaMin).
+# Ogni regola è una coppia (espressione regolare, formula): vale la prima regola la cui espressione
+# si trova nella descrizione. La formula è un'espressione aritmetica (+ - * / // e parentesi) in cui si
+# possono usare unitaMin e i gruppi dell'espressione regolare (g1, g2, ...) convertiti in numero.
+# Nel file di configurazione sono nella sezione [RegolePezzi], come regola0 = espressione => formula
+REGOLE_DEFAULT = [
+    (r"\*(CART|AST)20", "10"),
+    (r"\*AST10", "20"),
+    (r"\*(\d{1,3})GR", "unitaMin / (g1 / 1000)"),
+]
+
+SEPARATORE = "=>"
+
+NODI_AMMESSI = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+                ast.UAdd, ast.USub, ast.Constant, ast.Name, ast.Load)
+
+
+# Converte una regola dal formato del file di configurazione
+def parseRegola(testo):
+    espressione, separatore, formula = testo.rpartition(SEPARATORE)
+    if not separatore:
+        raise ValueError(f"Regola senza '{SEPARATORE}': {testo}")
+    return (espressione.strip(), formula.strip())
+
+
+def formatRegola(regola):
+    return f"{regola[0]} {SEPARATORE} {regola[1]}"
+
+
+# Compila la formula dopo aver controllato che sia solo un'espressione aritmetica con nomi noti
+def compilaFormula(formula, nomi):
+    tree = ast.parse(formula, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, NODI_AMMESSI):
+            raise ValueError(f"Formula non ammessa: {formula}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Formula non ammessa: {formula}")
+        if isinstance(node, ast.Name) and node.id not in nomi:
+            raise ValueError(f"Nome sconosciuto '{node.id}' nella formula: {formula}")
+    usati = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)})
+    return (compile(tree, "<regola>", "eval"), usati)
+
+
+class RegolePezzi:
+    def __init__(self, regole=REGOLE_DEFAULT):
+        self.regole = []        # (pattern compilato, formula compilata, nomi usati dalla formula)
+        self.__cache = dict()
+        for espressione, formula in regole:
+            try:
+                pattern = re.compile(espressione)
+                nomi = {"unitaMin"} | {f"g{i}" for i in range(1, pattern.groups + 1)}
+                self.regole.append((pattern, *compilaFormula(formula, nomi)))
+            except (re.error, SyntaxError, ValueError) as e:
+                log.error(f"[regolePezzi] regola ignorata '{espressione}': {e}")
+
+    # N. di pezzi della confezione, 0 se nessuna regola è applicabile.
+    # Il risultato è memorizzato per (descrizione, unitaMin)
+    def pezzi(self, unitaMin, descrizione):
+        chiave = (descrizione, unitaMin)
+        value = self.__cache.get(chiave)
+        if value is None:
+            value = self.__cache[chiave] = self.__calcola(unitaMin, descrizione)
+        return value
+
+    def __calcola(self, unitaMin, descrizione):
+        for pattern, formula, usati in self.regole:
+            match = pattern.search(descrizione)
+            if not match:
+                continue
+            try:
+                nomi = {nome: (unitaMin if nome == "unitaMin" else float(match.group(int(nome[1:])))) for nome in usati}
+                value = eval(formula, {"__builtins__": {}}, nomi)
+            except (TypeError, ValueError, ArithmeticError):
+                continue
+            return int(value)
+        return 0
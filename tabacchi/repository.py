@@ -0,0 +1,282 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+# Accesso ai dati con scritture in blocco (executemany + UPSERT).
+# Le funzioni ricevono il cursore del chiamante, che gestisce commit e rollback,
+# in modo che più operazioni possano far parte della stessa transazione.
+
+import datetime
+import functools
+import sqlite3
+
+from . import schema
+
+
+# Conversione delle date memorizzata: negli elenchi le stesse date si ripetono spesso
+@functools.lru_cache(maxsize=4096)
+def parseDate(value):
+    return datetime.date.fromisoformat(value)
+
+
+@functools.lru_cache(maxsize=4096)
+def parseTimestamp(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+CONVERTERS = {'date': parseDate, 'timestamp': parseTimestamp}
+
+
+# Riga compatta: i valori restano nella tupla letta da sqlite, i nomi delle colonne
+# sono risolti con una mappa condivisa da tutte le righe della stessa query e le
+# date sono convertite solo quando vengono lette
+class FastRow:
+    __slots__ = ('values',)
+    index = {}
+    converters = {}
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        if key.__class__ is str:
+            key = self.index[key]
+        value = self.values[key]
+        converter = self.converters.get(key)
+        if (converter is not None) and (value is not None):
+            return converter(value)
+        return value
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return list(self.index)
+
+
+# Classi FastRow per query, indicizzate per (colonne, date)
+__rowClasses = {}
+
+
+def getRowClass(description, dates):
+    names = tuple(column[0] for column in description)
+    key = (names, tuple(sorted(dates.items())))
+    rowClass = __rowClasses.get(key)
+    if rowClass is None:
+        index = {name: i for i, name in enumerate(names)}
+        converters = {index[name]: CONVERTERS[kind] for name, kind in dates.items()}
+        rowClass = type('FastRow', (FastRow,), {'__slots__': (), 'index': index, 'converters': converters})
+        __rowClasses[key] = rowClass
+    return rowClass
+
+
+# Esegue la query su un cursore di una connessione raw (prefs.getRawConn) e ritorna una lista di FastRow.
+# dates: {colonna: 'date' | 'timestamp'} per le colonne da convertire in date
+def fetchRows(cursor, sql, parameters=(), dates=None):
+    cursor.execute(sql, parameters)
+    rowClass = getRowClass(cursor.description, dates or {})
+    return [rowClass(values) for values in cursor.fetchall()]
+
+
+# Articoli
+
+# rows: tuple (ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza, PezziUnitaMin, Barcode)
+def upsertTabacchi(cursor, rows):
+    cursor.executemany(
+        "INSERT INTO tabacchi(ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza, PezziUnitaMin, Barcode) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(ID) DO UPDATE SET Descrizione=excluded.Descrizione, UnitaMin=excluded.UnitaMin, PrezzoKg=excluded.PrezzoKg, Tipo=excluded.Tipo, "
+        "InMagazzino=excluded.InMagazzino, LivelloMin=excluded.LivelloMin, Decorrenza=excluded.Decorrenza, PezziUnitaMin=excluded.PezziUnitaMin, Barcode=excluded.Barcode",
+        rows)
+
+
+# rows: tuple (ID, LivelloMin)
+def setLivelliMinimi(cursor, rows):
+    cursor.executemany("UPDATE tabacchi SET LivelloMin = ?2 WHERE ID = ?1", rows)
+
+
+# Aggiornamento del catalogo: il catalogo scaricato viene caricato in una tabella temporanea
+# e confrontato con tabacchi direttamente in SQL
+
+# Condizione di articolo modificato, t: riga di tabacchi, n: riga del catalogo scaricato
+CATALOGO_MODIFICATO = ("({t}.PrezzoKg IS NOT {n}.PrezzoKg) OR ({t}.Descrizione IS NOT {n}.Descrizione) OR ({t}.UnitaMin IS NOT {n}.UnitaMin) OR ({t}.Tipo IS NOT {n}.Tipo) "
+                       "OR ({t}.Decorrenza IS NOT {n}.Decorrenza) OR (({n}.PezziUnitaMin > 0) AND ({t}.PezziUnitaMin IS NOT {n}.PezziUnitaMin))")
+
+
+# rows: tuple (ID, Descrizione, UnitaMin, PrezzoKg, Tipo, Decorrenza, PezziUnitaMin)
+def caricaCatalogo(cursor, rows):
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS catalogoNuovo (ID TEXT NOT NULL PRIMARY KEY, Descrizione TEXT NOT NULL, UnitaMin REAL NOT NULL, "
+                   "PrezzoKg REAL NOT NULL, Tipo TEXT NOT NULL, Decorrenza DATE, PezziUnitaMin INTEGER NOT NULL) WITHOUT ROWID;")
+    cursor.execute("DELETE FROM temp.catalogoNuovo;")
+    # In caso di codici ripetuti vale l'ultima riga
+    cursor.executemany("INSERT OR REPLACE INTO temp.catalogoNuovo(ID, Descrizione, UnitaMin, PrezzoKg, Tipo, Decorrenza, PezziUnitaMin) VALUES(?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+# Ritorna (numero articoli nuovi, numero articoli modificati, articoli non più in catalogo)
+# con gli articoli non più in catalogo come tuple (ID, Descrizione, InMagazzino)
+def diffCatalogo(cursor):
+    cursor.execute("SELECT count(*) FROM temp.catalogoNuovo n WHERE n.ID NOT IN (SELECT ID FROM main.tabacchi);")
+    nuovi = cursor.fetchone()[0]
+    cursor.execute(f"SELECT count(*) FROM temp.catalogoNuovo n JOIN main.tabacchi t ON t.ID = n.ID WHERE {CATALOGO_MODIFICATO.format(t='t', n='n')};")
+    modificati = cursor.fetchone()[0]
+    cursor.execute("SELECT t.ID, t.Descrizione, t.InMagazzino FROM main.tabacchi t WHERE t.ID NOT IN (SELECT ID FROM temp.catalogoNuovo) ORDER BY t.Tipo desc, t.Descrizione;")
+    rimossi = [tuple(row) for row in cursor.fetchall()]
+    return (nuovi, modificati, rimossi)
+
+
+# Inserisce gli articoli nuovi, aggiorna solo quelli modificati e, se richiesto, cancella quelli
+# non più in catalogo. Il numero di pezzi è aggiornato solo se è stato ricavato dalla descrizione.
+def applicaCatalogo(cursor, eliminaRimossi):
+    cursor.execute(
+        "INSERT INTO main.tabacchi(ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza, PezziUnitaMin, Barcode) "
+        "SELECT ID, Descrizione, UnitaMin, PrezzoKg, Tipo, 0, 0, Decorrenza, PezziUnitaMin, '' FROM temp.catalogoNuovo n WHERE true "
+        "ON CONFLICT(ID) DO UPDATE SET Descrizione=excluded.Descrizione, UnitaMin=excluded.UnitaMin, PrezzoKg=excluded.PrezzoKg, Tipo=excluded.Tipo, "
+        "Decorrenza=excluded.Decorrenza, PezziUnitaMin=(CASE WHEN excluded.PezziUnitaMin > 0 THEN excluded.PezziUnitaMin ELSE tabacchi.PezziUnitaMin END) "
+        f"WHERE {CATALOGO_MODIFICATO.format(t='tabacchi', n='excluded')};")
+    if eliminaRimossi:
+        cursor.execute("DELETE FROM main.tabacchi WHERE ID NOT IN (SELECT ID FROM temp.catalogoNuovo);")
+    cursor.execute("DELETE FROM temp.catalogoNuovo;")
+
+
+# Articoli senza n. di pezzi per confezione: (ID, Descrizione, InMagazzino), prima quelli in magazzino
+def articoliSenzaPezzi(cursor):
+    cursor.execute("SELECT ID, Descrizione, InMagazzino FROM tabacchi WHERE PezziUnitaMin <= 0 ORDER BY InMagazzino desc, Descrizione;")
+    return cursor.fetchall()
+
+
+# Storico prezzi
+
+# Prezzo al kg dell'articolo {id} in vigore alla data {data} (espressioni SQL), NULL se non registrato
+PREZZO_AL = "(SELECT p.PrezzoKg FROM prezziStorico p WHERE p.ID = {id} AND p.Decorrenza <= {data} ORDER BY p.Decorrenza DESC LIMIT 1)"
+
+
+# Ritorna {ID: prezzo al kg} in vigore alla data ('%Y-%m-%d') per gli articoli con un prezzo registrato
+def prezziAl(cursor, data):
+    # Con max() le colonne non aggregate sono quelle della riga con la decorrenza massima
+    cursor.execute("SELECT ID, PrezzoKg, max(Decorrenza) FROM prezziStorico WHERE Decorrenza <= ? GROUP BY ID;", (data,))
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+# Ordini
+
+def setStatoOrdine(cursor, idOrdine, stato):
+    cursor.execute("UPDATE ordineTabacchi SET Stato = ? WHERE ID = ?", (stato, idOrdine))
+
+
+# Ricalcola il riepilogo degli ordini mantenuto dai trigger
+def rebuildOrdineSummary(cursor):
+    for statement in schema.REBUILD_ORDINE_SUMMARY:
+        cursor.execute(statement)
+
+
+# Righe ordine
+
+# rows: tuple (ID, Descrizione, Ordine, Prezzo, Giacenza, Consumo)
+def insertRigheOrdine(cursor, idOrdine, rows):
+    cursor.executemany(
+        "INSERT INTO rigaOrdineTabacchi(ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo) VALUES(?1, ?2, ?7, ?3, ?4, ?5, ?6)",
+        (tuple(row) + (idOrdine,) for row in rows))
+
+
+# rows: tuple (ID, Descrizione, Ordine, Prezzo, Giacenza, Consumo)
+def upsertRigheOrdine(cursor, idOrdine, rows):
+    cursor.executemany(
+        "INSERT INTO rigaOrdineTabacchi(ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo) VALUES(?1, ?2, ?7, ?3, ?4, ?5, ?6) "
+        "ON CONFLICT(ID, ID_Ordine) DO UPDATE SET Ordine=excluded.Ordine, Giacenza=excluded.Giacenza, Consumo=excluded.Consumo",
+        (tuple(row) + (idOrdine,) for row in rows))
+
+
+# Aggiorna solo la quantità ordinata, inserendo le righe mancanti.
+# rows: tuple (ID, Descrizione, Ordine, Prezzo)
+def upsertOrdinato(cursor, idOrdine, rows):
+    cursor.executemany(
+        "INSERT INTO rigaOrdineTabacchi(ID, Descrizione, ID_Ordine, Ordine, Prezzo) VALUES(?1, ?2, ?5, ?3, ?4) "
+        "ON CONFLICT(ID, ID_Ordine) DO UPDATE SET Ordine=excluded.Ordine",
+        (tuple(row) + (idOrdine,) for row in rows))
+
+
+# Azzera la quantità ordinata delle righe esistenti
+def azzeraOrdinato(cursor, idOrdine, ids):
+    cursor.executemany("UPDATE rigaOrdineTabacchi SET Ordine = 0 WHERE ID = ? AND ID_Ordine = ?", ((_id, idOrdine) for _id in ids))
+
+
+# Consumo di ogni riga: giacenza + ordinato della riga precedente dello stesso articolo
+# (in ordine di data dell'ordine) meno la giacenza attuale
+CONSUMO_RIGA = ("round(coalesce(LAG(round(r.Giacenza, 3) + round(r.Ordine, 3)) OVER (PARTITION BY r.ID ORDER BY o.Data), 0) - round(r.Giacenza, 3), 3)")
+
+
+# Scrive nel DB principale i consumi calcolati nella tabella temporanea ricalcoloConsumi.
+# Ritorna il numero di righe aggiornate
+def __scriviConsumi(cursor):
+    # UPDATE ... FROM è disponibile da SQLite 3.33
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        # Senza statistiche sulla tabella temporanea il planner scorre tutta rigaOrdineTabacchi
+        # anche per poche righe da aggiornare
+        cursor.execute("ANALYZE temp.ricalcoloConsumi;")
+        cursor.execute(
+            "UPDATE main.rigaOrdineTabacchi SET Consumo = c.Consumo FROM temp.ricalcoloConsumi c "
+            "WHERE rigaOrdineTabacchi.ID = c.ID AND rigaOrdineTabacchi.ID_Ordine = c.ID_Ordine;")
+    else:
+        cursor.execute(
+            "UPDATE main.rigaOrdineTabacchi SET Consumo = (SELECT c.Consumo FROM temp.ricalcoloConsumi c WHERE c.ID = rigaOrdineTabacchi.ID AND c.ID_Ordine = rigaOrdineTabacchi.ID_Ordine) "
+            "WHERE (ID, ID_Ordine) IN (SELECT ID, ID_Ordine FROM temp.ricalcoloConsumi);")
+    updated = cursor.rowcount
+    cursor.execute("DELETE FROM temp.ricalcoloConsumi;")
+    return updated
+
+
+def __creaRicalcoloConsumi(cursor):
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS ricalcoloConsumi (ID TEXT NOT NULL, ID_Ordine INTEGER NOT NULL, Consumo REAL NOT NULL, PRIMARY KEY (ID, ID_Ordine)) WITHOUT ROWID;")
+    cursor.execute("DELETE FROM temp.ricalcoloConsumi;")
+
+
+# Ricalcola il consumo di tutte le righe. I valori calcolati con una window function
+# vanno in una tabella temporanea e sono scritte solo le righe cambiate.
+# ordini, righe: tabelle (o viste sull'archivio, vedi archivio.tabelle) da cui leggere lo storico,
+# le righe aggiornate sono sempre quelle del DB principale. Ritorna il numero di righe aggiornate.
+def ricalcolaConsumi(cursor, ordini="ordineTabacchi", righe="rigaOrdineTabacchi"):
+    __creaRicalcoloConsumi(cursor)
+    cursor.execute(
+        "INSERT INTO temp.ricalcoloConsumi(ID, ID_Ordine, Consumo) SELECT ID, ID_Ordine, Consumo FROM ("
+        f"SELECT r.ID, r.ID_Ordine, r.Consumo AS Attuale, {CONSUMO_RIGA} AS Consumo "
+        f"FROM {righe} r JOIN {ordini} o ON r.ID_Ordine = o.ID) WHERE Consumo IS NOT Attuale;")
+    updated = __scriviConsumi(cursor)
+    cursor.execute("DELETE FROM main.consumiDirty;")
+    return updated
+
+
+# Ricalcola solo i consumi degli articoli segnati dai trigger in consumiDirty, dalla data DataDa in poi.
+# Da eseguire in una transazione IMMEDIATE: consumiDirty viene svuotata alla fine.
+def ricalcolaConsumiDirty(cursor, ordini="ordineTabacchi", righe="rigaOrdineTabacchi"):
+    __creaRicalcoloConsumi(cursor)
+    cursor.execute(
+        "INSERT INTO temp.ricalcoloConsumi(ID, ID_Ordine, Consumo) SELECT x.ID, x.ID_Ordine, x.Consumo FROM ("
+        f"SELECT r.ID, r.ID_Ordine, o.Data, r.Consumo AS Attuale, {CONSUMO_RIGA} AS Consumo "
+        f"FROM {righe} r JOIN {ordini} o ON r.ID_Ordine = o.ID WHERE r.ID IN (SELECT ID FROM main.consumiDirty)) x "
+        "JOIN main.consumiDirty d ON d.ID = x.ID WHERE (x.Data >= d.DataDa) AND (x.Consumo IS NOT x.Attuale);")
+    updated = __scriviConsumi(cursor)
+    cursor.execute("DELETE FROM main.consumiDirty;")
+    return updated
+
+
+# Verifiche ordine
+
+# rows: tuple (ID, Carico, Peso, Eliminato)
+def upsertVerifiche(cursor, idOrdine, rows):
+    cursor.executemany(
+        "INSERT INTO verificaOrdine(ID, ID_Ordine, Carico, Peso, Eliminato) VALUES(?1, ?5, ?2, ?3, ?4) "
+        "ON CONFLICT(ID, ID_Ordine) DO UPDATE SET Carico=excluded.Carico, Peso=excluded.Peso, Eliminato=excluded.Eliminato",
+        (tuple(row) + (idOrdine,) for row in rows))
+
+
+def deleteVerifiche(cursor, idOrdine):
+    cursor.execute("DELETE FROM verificaOrdine WHERE ID_Ordine = ?", (idOrdine,))
+
+
+# Ordini suppletivi
+
+# Sostituisce le righe del suppletivo. rows: tuple (ID, Descrizione, Ordine)
+def replaceRigheSuppletivo(cursor, idOrdine, rows):
+    cursor.execute("DELETE FROM rigaOrdineSuppletivo WHERE ID_Ordine = ?", (idOrdine,))
+    cursor.executemany(
+        "INSERT INTO rigaOrdineSuppletivo(ID, Descrizione, ID_Ordine, Ordine) VALUES(?1, ?2, ?4, ?3)",
+        (tuple(row) + (idOrdine,) for row in rows))
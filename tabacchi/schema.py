@@ -0,0 +1,170 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import sqlite3
+
+from .config import log
+
+# Ricalcola da zero il riepilogo degli ordini (usato dalla migrazione e dal comando di ricostruzione)
+REBUILD_ORDINE_SUMMARY = [
+    "DELETE FROM ordineSummary;",
+    "INSERT INTO ordineSummary(ID_Ordine, Peso, Importo, Righe, PesoSuppletivo, RigheSuppletivo) "
+    "SELECT O.ID, "
+    "coalesce((SELECT round(sum(R.Ordine), 6) FROM rigaOrdineTabacchi R WHERE R.ID_Ordine = O.ID), 0), "
+    "coalesce((SELECT round(sum(R.Ordine * R.Prezzo), 6) FROM rigaOrdineTabacchi R WHERE R.ID_Ordine = O.ID), 0), "
+    "(SELECT count(*) FROM rigaOrdineTabacchi R WHERE R.ID_Ordine = O.ID AND R.Ordine > 0), "
+    "coalesce((SELECT round(sum(S.Ordine), 6) FROM rigaOrdineSuppletivo S WHERE S.ID_Ordine = O.ID), 0), "
+    "(SELECT count(*) FROM rigaOrdineSuppletivo S WHERE S.ID_Ordine = O.ID AND S.Ordine > 0) "
+    "FROM ordineTabacchi O;",
+]
+
+# Ricalcola i collegamenti all'ordine precedente e successivo di ordineTabacchi (due ricerche sull'indice di Data)
+ORDINE_LINKS = (
+    "ID_Precedente = (SELECT P.ID FROM ordineTabacchi P WHERE P.Data < ordineTabacchi.Data ORDER BY P.Data DESC LIMIT 1), "
+    "ID_Successivo = (SELECT S.ID FROM ordineTabacchi S WHERE S.Data > ordineTabacchi.Data ORDER BY S.Data LIMIT 1)")
+
+
+# Segna da ricalcolare il consumo dell'articolo idArt dalla data dell'ordine idOrdine in poi (espressioni SQL del trigger)
+def segnaConsumi(idArt, idOrdine):
+    return ("INSERT INTO consumiDirty(ID, DataDa) SELECT " + idArt + ", O.Data FROM ordineTabacchi O WHERE O.ID = " + idOrdine + " "
+            "ON CONFLICT(ID) DO UPDATE SET DataDa = min(DataDa, excluded.DataDa);")
+
+
+# Migrazioni dello schema, in ordine di versione (PRAGMA user_version).
+# La migrazione i-esima porta il DB dalla versione i alla versione i+1.
+# Non modificare le migrazioni già rilasciate: aggiungerne di nuove in coda.
+MIGRATIONS = [
+    # Versione 1: schema iniziale (i DB creati prima del versionamento lo hanno già)
+    [
+        "CREATE TABLE IF NOT EXISTS ordineTabacchi (ID INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, Data DATETIME NOT NULL, LastPos INTEGER NOT NULL DEFAULT (0), DataSuppletivo DATE DEFAULT NULL, Stato INTEGER NOT NULL DEFAULT (0), Levata DATE DEFAULT NULL, Suppletivo BOOLEAN NOT NULL DEFAULT (0), UNIQUE (Data), UNIQUE (Levata));",
+        "CREATE TABLE IF NOT EXISTS rigaOrdineSuppletivo (ID varchar (8) NOT NULL, Descrizione varchar (50) NOT NULL, ID_Ordine integer NOT NULL, Ordine float NOT NULL DEFAULT '0', PRIMARY KEY (ID, ID_Ordine), CONSTRAINT fk_riga_suppletivo FOREIGN KEY (ID_Ordine) REFERENCES ordineTabacchi (ID));",
+        "CREATE TABLE IF NOT EXISTS rigaOrdineTabacchi (ID TEXT (8) NOT NULL, Descrizione TEXT (50) NOT NULL, ID_Ordine INTEGER NOT NULL, Ordine REAL NOT NULL DEFAULT (0), Prezzo REAL NOT NULL DEFAULT (0), Giacenza REAL NOT NULL DEFAULT (0), Consumo REAL NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_Ordine), CONSTRAINT fk_riga_ordine FOREIGN KEY (ID_Ordine) REFERENCES ordineTabacchi (ID));",
+        "CREATE TABLE IF NOT EXISTS tabacchi (ID TEXT (8) NOT NULL, Descrizione TEXT (50) NOT NULL DEFAULT NULL, UnitaMin REAL NOT NULL DEFAULT (0), PrezzoKg REAL NOT NULL DEFAULT (0), Tipo TEXT (50) NOT NULL, InMagazzino BOOLEAN NOT NULL DEFAULT (0), LivelloMin REAL NOT NULL DEFAULT (0), Decorrenza DATE NOT NULL DEFAULT ('0000-00-00'), PezziUnitaMin INTEGER NOT NULL DEFAULT (0), Barcode TEXT (20) NOT NULL, PRIMARY KEY (ID));",
+        "CREATE TABLE IF NOT EXISTS verificaOrdine (ID VARCHAR (8) NOT NULL, ID_ordine INTEGER NOT NULL, Carico REAL NOT NULL DEFAULT (0), Peso REAL NOT NULL DEFAULT (0), Eliminato BOOLEAN NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_ordine), CONSTRAINT fk_verificaOrdine_OrdineTabacchi FOREIGN KEY (ID_ordine) REFERENCES ordineTabacchi (ID) ON DELETE NO ACTION ON UPDATE NO ACTION);",
+        "CREATE INDEX IF NOT EXISTS idx_rigaOrdineSuppletivo_fk_riga_suppletivo ON rigaOrdineSuppletivo (ID_Ordine);",
+        "CREATE INDEX IF NOT EXISTS idx_rigaOrdineTabacchi_fk_riga_ordine ON rigaOrdineTabacchi (ID_Ordine);",
+        "CREATE INDEX IF NOT EXISTS idx_tabacchi_k_inmagazzino ON tabacchi (InMagazzino);",
+        "CREATE INDEX IF NOT EXISTS idx_tabacchi_k_tipo ON tabacchi (Tipo);",
+        "CREATE INDEX IF NOT EXISTS idx_verificaOrdine_fk_verificaOrdine_OrdineTabacchi ON verificaOrdine (ID_ordine);",
+    ],
+    # Versione 2: indici per le query più frequenti.
+    # Per ordineTabacchi.Data basta l'indice del vincolo UNIQUE, che contiene anche ID (rowid)
+    [
+        # Storico di un articolo (StatsDialog, ricalcolo consumi) senza accedere alla tabella
+        "CREATE INDEX IF NOT EXISTS idx_rigaOrdineTabacchi_k_storico ON rigaOrdineTabacchi (ID, ID_Ordine, Consumo, Giacenza, Ordine);",
+        # Ricerca per barcode
+        "CREATE INDEX IF NOT EXISTS idx_tabacchi_k_barcode ON tabacchi (Barcode);",
+        # Stampa etichette dei prezzi variati
+        "CREATE INDEX IF NOT EXISTS idx_tabacchi_k_decorrenza ON tabacchi (Decorrenza);",
+    ],
+    # Versione 3: riepilogo degli ordini aggiornato dai trigger (vedi REBUILD_ORDINE_SUMMARY)
+    [
+        "CREATE TABLE IF NOT EXISTS ordineSummary (ID_Ordine INTEGER NOT NULL PRIMARY KEY, Peso REAL NOT NULL DEFAULT (0), Importo REAL NOT NULL DEFAULT (0), Righe INTEGER NOT NULL DEFAULT (0), PesoSuppletivo REAL NOT NULL DEFAULT (0), RigheSuppletivo INTEGER NOT NULL DEFAULT (0));",
+        # Ordini
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_ai_summary AFTER INSERT ON ordineTabacchi BEGIN "
+        "INSERT OR IGNORE INTO ordineSummary(ID_Ordine) VALUES (NEW.ID); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_ad_summary AFTER DELETE ON ordineTabacchi BEGIN "
+        "DELETE FROM ordineSummary WHERE ID_Ordine = OLD.ID; END;",
+        # Righe ordine
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_ai_summary AFTER INSERT ON rigaOrdineTabacchi BEGIN "
+        "INSERT INTO ordineSummary(ID_Ordine, Peso, Importo, Righe) VALUES (NEW.ID_Ordine, NEW.Ordine, NEW.Ordine * NEW.Prezzo, NEW.Ordine > 0) "
+        "ON CONFLICT(ID_Ordine) DO UPDATE SET Peso = round(Peso + excluded.Peso, 6), Importo = round(Importo + excluded.Importo, 6), Righe = Righe + excluded.Righe; END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_ad_summary AFTER DELETE ON rigaOrdineTabacchi BEGIN "
+        "UPDATE ordineSummary SET Peso = round(Peso - OLD.Ordine, 6), Importo = round(Importo - OLD.Ordine * OLD.Prezzo, 6), Righe = Righe - (OLD.Ordine > 0) WHERE ID_Ordine = OLD.ID_Ordine; END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_au_summary AFTER UPDATE OF Ordine, Prezzo, ID_Ordine ON rigaOrdineTabacchi BEGIN "
+        "UPDATE ordineSummary SET Peso = round(Peso - OLD.Ordine, 6), Importo = round(Importo - OLD.Ordine * OLD.Prezzo, 6), Righe = Righe - (OLD.Ordine > 0) WHERE ID_Ordine = OLD.ID_Ordine; "
+        "INSERT INTO ordineSummary(ID_Ordine, Peso, Importo, Righe) VALUES (NEW.ID_Ordine, NEW.Ordine, NEW.Ordine * NEW.Prezzo, NEW.Ordine > 0) "
+        "ON CONFLICT(ID_Ordine) DO UPDATE SET Peso = round(Peso + excluded.Peso, 6), Importo = round(Importo + excluded.Importo, 6), Righe = Righe + excluded.Righe; END;",
+        # Righe suppletivo
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineSuppletivo_ai_summary AFTER INSERT ON rigaOrdineSuppletivo BEGIN "
+        "INSERT INTO ordineSummary(ID_Ordine, PesoSuppletivo, RigheSuppletivo) VALUES (NEW.ID_Ordine, NEW.Ordine, NEW.Ordine > 0) "
+        "ON CONFLICT(ID_Ordine) DO UPDATE SET PesoSuppletivo = round(PesoSuppletivo + excluded.PesoSuppletivo, 6), RigheSuppletivo = RigheSuppletivo + excluded.RigheSuppletivo; END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineSuppletivo_ad_summary AFTER DELETE ON rigaOrdineSuppletivo BEGIN "
+        "UPDATE ordineSummary SET PesoSuppletivo = round(PesoSuppletivo - OLD.Ordine, 6), RigheSuppletivo = RigheSuppletivo - (OLD.Ordine > 0) WHERE ID_Ordine = OLD.ID_Ordine; END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineSuppletivo_au_summary AFTER UPDATE OF Ordine, ID_Ordine ON rigaOrdineSuppletivo BEGIN "
+        "UPDATE ordineSummary SET PesoSuppletivo = round(PesoSuppletivo - OLD.Ordine, 6), RigheSuppletivo = RigheSuppletivo - (OLD.Ordine > 0) WHERE ID_Ordine = OLD.ID_Ordine; "
+        "INSERT INTO ordineSummary(ID_Ordine, PesoSuppletivo, RigheSuppletivo) VALUES (NEW.ID_Ordine, NEW.Ordine, NEW.Ordine > 0) "
+        "ON CONFLICT(ID_Ordine) DO UPDATE SET PesoSuppletivo = round(PesoSuppletivo + excluded.PesoSuppletivo, 6), RigheSuppletivo = RigheSuppletivo + excluded.RigheSuppletivo; END;",
+    ] + REBUILD_ORDINE_SUMMARY,
+    # Versione 4: collegamenti all'ordine precedente e successivo (per Data) aggiornati dai trigger
+    [
+        "ALTER TABLE ordineTabacchi ADD COLUMN ID_Precedente INTEGER DEFAULT NULL;",
+        "ALTER TABLE ordineTabacchi ADD COLUMN ID_Successivo INTEGER DEFAULT NULL;",
+        "UPDATE ordineTabacchi SET " + ORDINE_LINKS + ";",
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_ai_links AFTER INSERT ON ordineTabacchi BEGIN "
+        "UPDATE ordineTabacchi SET " + ORDINE_LINKS + " WHERE Data IN (NEW.Data, "
+        "(SELECT max(Data) FROM ordineTabacchi WHERE Data < NEW.Data), (SELECT min(Data) FROM ordineTabacchi WHERE Data > NEW.Data)); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_au_links AFTER UPDATE OF Data ON ordineTabacchi BEGIN "
+        "UPDATE ordineTabacchi SET " + ORDINE_LINKS + " WHERE ID IN (OLD.ID_Precedente, OLD.ID_Successivo) OR Data IN (NEW.Data, "
+        "(SELECT max(Data) FROM ordineTabacchi WHERE Data < NEW.Data), (SELECT min(Data) FROM ordineTabacchi WHERE Data > NEW.Data)); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_ad_links AFTER DELETE ON ordineTabacchi BEGIN "
+        "UPDATE ordineTabacchi SET " + ORDINE_LINKS + " WHERE ID IN (OLD.ID_Precedente, OLD.ID_Successivo); END;",
+    ],
+    # Versione 5: articoli con consumi da ricalcolare (dalla data DataDa in poi), segnati dai trigger
+    # quando cambiano giacenza o ordinato di una riga o la data di un ordine
+    [
+        "CREATE TABLE IF NOT EXISTS consumiDirty (ID TEXT (8) NOT NULL PRIMARY KEY, DataDa DATETIME NOT NULL) WITHOUT ROWID;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_ai_consumi AFTER INSERT ON rigaOrdineTabacchi BEGIN "
+        + segnaConsumi("NEW.ID", "NEW.ID_Ordine") + " END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_ad_consumi AFTER DELETE ON rigaOrdineTabacchi BEGIN "
+        + segnaConsumi("OLD.ID", "OLD.ID_Ordine") + " END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_rigaOrdineTabacchi_au_consumi AFTER UPDATE OF Ordine, Giacenza, ID, ID_Ordine ON rigaOrdineTabacchi BEGIN "
+        + segnaConsumi("OLD.ID", "OLD.ID_Ordine") + " " + segnaConsumi("NEW.ID", "NEW.ID_Ordine") + " END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_ordineTabacchi_au_consumi AFTER UPDATE OF Data ON ordineTabacchi BEGIN "
+        "INSERT INTO consumiDirty(ID, DataDa) SELECT R.ID, min(OLD.Data, NEW.Data) FROM rigaOrdineTabacchi R WHERE R.ID_Ordine = NEW.ID "
+        "ON CONFLICT(ID) DO UPDATE SET DataDa = min(DataDa, excluded.DataDa); END;",
+    ],
+    # Versione 6: storico dei prezzi per data di decorrenza, solo in aggiunta (scritto dai trigger di tabacchi).
+    # Per una stessa decorrenza resta il primo prezzo registrato
+    [
+        "CREATE TABLE IF NOT EXISTS prezziStorico (ID TEXT (8) NOT NULL, Decorrenza DATE NOT NULL, PrezzoKg REAL NOT NULL, PRIMARY KEY (ID, Decorrenza)) WITHOUT ROWID;",
+        "INSERT OR IGNORE INTO prezziStorico(ID, Decorrenza, PrezzoKg) SELECT ID, Decorrenza, PrezzoKg FROM tabacchi;",
+        "CREATE TRIGGER IF NOT EXISTS trg_tabacchi_ai_prezzi AFTER INSERT ON tabacchi BEGIN "
+        "INSERT OR IGNORE INTO prezziStorico(ID, Decorrenza, PrezzoKg) VALUES (NEW.ID, NEW.Decorrenza, NEW.PrezzoKg); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_tabacchi_au_prezzi AFTER UPDATE OF PrezzoKg, Decorrenza ON tabacchi BEGIN "
+        "INSERT OR IGNORE INTO prezziStorico(ID, Decorrenza, PrezzoKg) VALUES (NEW.ID, NEW.Decorrenza, NEW.PrezzoKg); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_prezziStorico_bu BEFORE UPDATE ON prezziStorico BEGIN "
+        "SELECT RAISE(ABORT, 'prezziStorico: storico dei prezzi non modificabile'); END;",
+        "CREATE TRIGGER IF NOT EXISTS trg_prezziStorico_bd BEFORE DELETE ON prezziStorico BEGIN "
+        "SELECT RAISE(ABORT, 'prezziStorico: storico dei prezzi non modificabile'); END;",
+    ],
+]
+
+# Versione dello schema richiesta dal programma
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# Ritorna la versione dello schema del DB
+def getVersion(conn):
+    return conn.execute("pragma user_version;").fetchone()[0]
+
+
+# Porta il DB all'ultima versione dello schema, una migrazione per transazione.
+# Ritorna il numero di migrazioni applicate.
+def migrate(conn):
+    version = getVersion(conn)
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(f"Il DB ha una versione dello schema ({version}) più recente di quella del programma ({SCHEMA_VERSION}).")
+
+    applied = 0
+    for i in range(version, SCHEMA_VERSION):
+        log.debug(f"[schema] migrazione alla versione {i + 1}")
+        try:
+            conn.execute("BEGIN")
+            for statement in MIGRATIONS[i]:
+                conn.execute(statement)
+            # user_version non accetta parametri
+            conn.execute(f"pragma user_version={i + 1};")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied += 1
+
+    # Aggiorna le statistiche usate dal query planner
+    if applied > 0:
+        conn.execute("ANALYZE;")
+        conn.commit()
+
+    return applied
@@ -0,0 +1,155 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from .config import log
+
+# Statement per cui ha senso chiedere il piano di esecuzione
+EXPLAIN_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+# Statistiche aggregate di uno statement SQL
+class StatementStats:
+    __slots__ = ('sql', 'calls', 'totalTime', 'maxTime', 'rows', 'callSites', 'plan')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.rows = 0
+        self.callSites = {}
+        self.plan = None
+
+
+# Raccoglie i tempi di esecuzione degli statement eseguiti con i TracingCursor
+class Tracer:
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold      # secondi oltre i quali lo statement è lento
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.started = datetime.datetime.now()
+
+    # Ritorna il chiamante più vicino esterno a questo modulo e ai metodi di connessioni e cursori
+    @staticmethod
+    def callSite():
+        frame = sys._getframe(2)
+        while frame and ((frame.f_code.co_filename == __file__) or
+                         isinstance(frame.f_locals.get('self'), (sqlite3.Connection, sqlite3.Cursor))):
+            frame = frame.f_back
+        if frame is None:
+            return "?"
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+    # Registra l'esecuzione di uno statement e ritorna le sue statistiche
+    def record(self, sql, elapsed, rows, callSite):
+        with self.lock:
+            stat = self.stats.get(sql)
+            if stat is None:
+                stat = StatementStats(sql)
+                self.stats[sql] = stat
+            stat.calls += 1
+            stat.totalTime += elapsed
+            stat.maxTime = max(stat.maxTime, elapsed)
+            stat.rows += max(rows, 0)
+            stat.callSites[callSite] = stat.callSites.get(callSite, 0) + 1
+        return stat
+
+    # Aggiunge tempo e righe lette con i fetch allo statement
+    def addFetch(self, stat, elapsed, rows):
+        with self.lock:
+            stat.totalTime += elapsed
+            stat.rows += rows
+
+    # Registra il piano di esecuzione di uno statement lento (una sola volta)
+    def explain(self, conn, stat, parameters, elapsed):
+        if stat.plan is not None or not stat.sql.lstrip().upper().startswith(EXPLAIN_PREFIXES):
+            return
+        try:
+            cursor = sqlite3.Cursor(conn)
+            try:
+                rows = cursor.execute("EXPLAIN QUERY PLAN " + stat.sql, parameters).fetchall()
+            finally:
+                cursor.close()
+        except sqlite3.Error as e:
+            stat.plan = f"(piano non disponibile: {e})"
+        else:
+            stat.plan = "\n".join(f"    {row[0]}|{row[1]}| {row[3]}" for row in rows)
+        log.warning(f"[sqltrace] statement lento ({elapsed * 1000:.1f} ms): {stat.sql}\n{stat.plan}")
+
+    # Scrive il report con gli statement ordinati per tempo totale
+    def writeReport(self, pathname, top=30):
+        with self.lock:
+            stats = sorted(self.stats.values(), key=lambda stat: stat.totalTime, reverse=True)
+        with open(pathname, 'w') as f:
+            f.write(f"SQL trace dal {self.started:%Y-%m-%d %H:%M:%S} al {datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n")
+            f.write(f"Soglia statement lenti: {self.threshold * 1000:.0f} ms\n\n")
+            for stat in stats[:top]:
+                f.write(f"{stat.totalTime * 1000:10.1f} ms totali  {stat.calls:6d} chiamate  "
+                        f"{stat.totalTime * 1000 / stat.calls:8.2f} ms medi  {stat.maxTime * 1000:8.1f} ms max  {stat.rows:8d} righe\n")
+                f.write(f"    {stat.sql}\n")
+                for callSite, count in sorted(stat.callSites.items(), key=lambda item: item[1], reverse=True):
+                    f.write(f"    <- {callSite} ({count})\n")
+                if stat.plan:
+                    f.write(f"{stat.plan}\n")
+                f.write("\n")
+        log.debug(f"[sqltrace] report scritto in {pathname}")
+
+
+# Cursore che misura tempi, righe e chiamante di ogni statement
+class TracingCursor(sqlite3.Cursor):
+    def __init__(self, conn, tracer):
+        super().__init__(conn)
+        self.tracer = tracer
+        self.stat = None
+
+    # Esegue lo statement misurandone il tempo. Il piano è calcolato con i parametri
+    # della execute, per la executemany (explainParameters = None) non è disponibile
+    def __trace(self, method, sql, parameters, explainParameters):
+        callSite = self.tracer.callSite()
+        start = time.perf_counter()
+        result = method(sql, parameters)
+        elapsed = time.perf_counter() - start
+        self.stat = self.tracer.record(sql, elapsed, self.rowcount, callSite)
+        if (elapsed >= self.tracer.threshold) and (explainParameters is not None):
+            self.tracer.explain(self.connection, self.stat, explainParameters, elapsed)
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self.__trace(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.__trace(super().executemany, sql, seq_of_parameters, None)
+
+    def __fetch(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        if self.stat:
+            rows = len(result) if isinstance(result, list) else (0 if result is None else 1)
+            self.tracer.addFetch(self.stat, time.perf_counter() - start, rows)
+        return result
+
+    def fetchone(self):
+        return self.__fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.__fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self.__fetch(super().fetchall)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.__fetch(super().fetchone)
+        if row is None:
+            raise StopIteration
+        return row
@@ -18,6 +18,7 @@ import gi
 from . import utility
 from . import ordini
 from .preferencesTabacchi import prefs
+from . import repository
 
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, Gio  # noqa: E402
@@ -58,7 +59,9 @@ class InventarioReport(utility.Report):
         ROW_HEIGHT = 0.45 * cm
         COL_WIDTHS = (1.5 * cm, 11 * cm, 2 * cm, 2 * cm, 2.5 * cm)
         COL_DESC = ("ID", "Descrizione", "Magazzino", "Scaffale", "Valore")
-        QUERY = "select r.ID, r.Descrizione, r.Giacenza, t.unitaMin, ((r.Giacenza + t.unitaMin) * t.prezzoKG) Valore from tabacchi t, rigaOrdineTabacchi r, ordineTabacchi o where t.ID = r.ID and r.ID_Ordine = o.ID and o.ID = %s and t.InMagazzino order by Valore desc" % _id
+        # Valorizzato con i prezzi in vigore alla data dell'ordine (quelli attuali se non sono registrati)
+        prezzo = "coalesce(%s, t.prezzoKG)" % repository.PREZZO_AL.format(id="t.ID", data="date(o.Data)")
+        QUERY = "select r.ID, r.Descrizione, r.Giacenza, t.unitaMin, ((r.Giacenza + t.unitaMin) * %s) Valore from tabacchi t, rigaOrdineTabacchi r, ordineTabacchi o where t.ID = r.ID and r.ID_Ordine = o.ID and o.ID = %s and t.InMagazzino order by Valore desc" % (prezzo, _id)
         utility.Report.__init__(self, parent, prefs, QUERY, "Magazzino Tabacchi valorizzato a %s" %
                                 data.strftime("%A %d %B %Y"), NUM_ROWS, COL_DESC, COL_WIDTHS, ROW_HEIGHT)
         self.totale = 0
@@ -5,6 +5,7 @@
 import datetime
 import sqlite3
 
+import numpy as np
 from matplotlib import dates
 from matplotlib import ticker
 from matplotlib.backends.backend_gtk3cairo import FigureCanvasGTK3Cairo as FigureCanvas
@@ -12,6 +13,7 @@ from matplotlib.dates import MonthLocator, DateFormatter
 from matplotlib.figure import Figure
 import gi
 
+from . import analisi
 from .preferencesTabacchi import prefs
 from . import utility
 
@@ -125,25 +127,21 @@ class StatsDialog(SimpleStatsDialog):
             self.unitaMin = row['UnitaMin']
             dataFine = self.dataFineEntry.data.strftime("%Y-%m-%d")
             dataInizio = self.dataInizioEntry.data.strftime("%Y-%m-%d")
-            cursor.execute(
-                "SELECT r.Consumo, r.Giacenza, r.Ordine, o.Data as 'Data [timestamp]' FROM rigaOrdineTabacchi r, ordineTabacchi o where (r.ID_Ordine = o.ID) and (r.ID = ?) and (o.Data < ?) and (o.Data > ?) order by o.Data",
-                (self.id, dataFine, dataInizio))
-            result_set = cursor.fetchall()
             self.date[:] = []
             self.consumi[:] = []
             self.giacenze[:] = []
             self.ordini[:] = []
-            oldOrdine = 0
-            for row in result_set:
-                data = row['Data']
-                consumo = round(row['Consumo'], 3)
-                ordine = round(row['Ordine'], 3)
-                giacenza = round(row['Giacenza'], 3) - oldOrdine
-                self.date.append(data)
-                self.consumi.append(consumo if (consumo > 0) else 0)
-                self.ordini.append(ordine if (ordine > 0) else 0)
-                self.giacenze.append(giacenza if (giacenza > 0) else 0)
-                oldOrdine = ordine
+            serie = analisi.getStorico(dataInizio).serieArticolo(self.id, dataInizio, dataFine)
+            if serie is not None:
+                date, consumi, ordini, giacenze = serie
+                consumi = consumi.round(3)
+                ordini = ordini.round(3)
+                # La giacenza comprende l'ordinato della riga precedente
+                giacenze = giacenze.round(3) - np.concatenate(([0], ordini[:-1]))
+                self.date.extend(date.tolist())
+                self.consumi.extend(consumi.clip(min=0).tolist())
+                self.ordini.extend(ordini.clip(min=0).tolist())
+                self.giacenze.extend(giacenze.clip(min=0).tolist())
         except sqlite3.Error as e:
             utility.gtkErrorMsg(e, self.statsDialog)
         finally:
@@ -159,7 +157,7 @@ class StatsDialog(SimpleStatsDialog):
 
 
 class GlobalStatsDialog(SimpleStatsDialog):
-    modelInfoList = [("+Descrizione", "str"), ("^Totale acquisti", "float"), ("^Data ultimo acquisto", "date")]
+    modelInfoList = [("+Descrizione", "str"), ("^Totale acquisti", "float"), ("^Importo acquisti", "currency"), ("^Data ultimo acquisto", "date")]
 
     def __init__(self, parent):
         SimpleStatsDialog.__init__(self, parent)
@@ -192,35 +190,25 @@ class GlobalStatsDialog(SimpleStatsDialog):
             cursor = prefs.getCursor(conn)
             dataFine = self.dataFineEntry.data.strftime("%Y-%m-%d")
             dataInizio = self.dataInizioEntry.data.strftime("%Y-%m-%d")
-            cursor.execute(
-                "SELECT t.Descrizione, SUM(r.Ordine) totPeso, MAX(o.Data) as 'maxData [timestamp]' FROM rigaOrdineTabacchi r, ordineTabacchi o, tabacchi t where (r.ID = t.ID) and t.InMagazzino and (r.ID_Ordine = o.ID) and (r.Ordine > 0) and (o.Data < ?) and (o.Data > ?) group by r.ID order by totPeso desc",
-                (dataFine, dataInizio))
-            result_set = cursor.fetchall()
-            self.piuAcquistatiModel.clear()
-            for row in result_set:
-                self.piuAcquistatiModel.append([row["Descrizione"], row["totPeso"], row["maxData"]])
-            cursor.execute(
-                "SELECT SUM(r.Consumo) as Consumo, SUM(r.Giacenza) as Giacenza, SUM(r.Ordine) as Ordine, o.Data as 'Data [timestamp]' FROM rigaOrdineTabacchi r, ordineTabacchi o where (r.ID_Ordine = o.ID) and ((r.Consumo > 0) or (r.Giacenza > 0) or (r.Ordine > 0)) and (o.Data < ?) and (o.Data > ?) group by o.ID order by o.Data",
-                (dataFine, dataInizio))
-            result_set = cursor.fetchall()
-
-            self.date[:] = []
-            self.consumi[:] = []
-            self.giacenze[:] = []
-            self.ordini[:] = []
-            # oldOrdine = 0
-            for row in result_set:
-                data = row['Data']
-                consumo = round(row['Consumo'], 3)
-                ordine = round(row['Ordine'], 3)
-                esistenza = round(row['Giacenza'], 3)
-                giacenza = esistenza  # - oldOrdine
-
-                self.date.append(data)
-                self.consumi.append(consumo if (consumo > 0) else 0)
-                self.ordini.append(ordine if (ordine > 0) else 0)
-                self.giacenze.append(giacenza if (giacenza > 0) else 0)
-                # oldOrdine = ordine
+            storico = analisi.getStorico(dataInizio)
+
+            cursor.execute("SELECT ID, Descrizione FROM tabacchi WHERE InMagazzino")
+            descrizioni = {row["ID"]: row["Descrizione"] for row in cursor}
+            # Importo degli acquisti ai prezzi in vigore alla data di ogni ordine
+            periodo = storico.colonne(dataInizio, dataFine)
+            ordine = storico.ordine[:, periodo]
+            importi = np.nansum(np.where(ordine > 0, ordine * analisi.getPrezzi(storico)[:, periodo], 0), axis=1)
+            rows = []
+            for idArt, totale, data in zip(*(valori.tolist() for valori in storico.acquisti(dataInizio, dataFine))):
+                if idArt in descrizioni:
+                    rows.append((descrizioni[idArt], totale, float(importi[storico.indiceArticoli[idArt]]), data))
+            utility.ExtTreeView.bulkLoad(self.piuAcquistatiModel, rows, treeviews=(self.piuAcquistatiTreeview,))
+
+            date, consumi, ordini, giacenze = storico.totaliOrdini(dataInizio, dataFine)
+            self.date[:] = date.tolist()
+            self.consumi[:] = consumi.round(3).clip(min=0).tolist()
+            self.ordini[:] = ordini.round(3).clip(min=0).tolist()
+            self.giacenze[:] = giacenze.round(3).clip(min=0).tolist()
         except sqlite3.Error as e:
             utility.gtkErrorMsg(e, self.statsDialog)
         finally:
@@ -90,6 +90,8 @@ class Preferences:
         self.backup = True
         self.history = 10
         self.isDBDirty = False
+        self.dataVersion = 0    # incrementato a ogni modifica del DB, per invalidare le cache
+        self.catalogoVersion = 0    # incrementato a ogni modifica della tabella tabacchi (vedi catalogo.py)
 
     def getPwd(self):
         val = keyring.get_password(self.program_desc, self.ENCRYPTION_STR.format(self.backupFolder))
@@ -107,6 +109,12 @@ class Preferences:
 
     def setDBDirty(self):
         self.isDBDirty = True
+        self.dataVersion += 1
+
+    # Da chiamare dopo il commit di ogni scrittura sulla tabella tabacchi
+    def setCatalogoDirty(self):
+        self.catalogoVersion += 1
+        self.setDBDirty()
 
     # Ritorna una nuova connessione (da implementare nelle sottoclassi)
     def getConn(self):
@@ -818,6 +826,7 @@ class ExtTreeView():
         self.adjMax = dict()
         self.adjValues = dict()
         self.adjIndexes = dict()
+        self.columns = dict()       # colonna del modello: TreeViewColumn che la mostra
 
         dataModel = self.__parseInfoList(modelInfoList)
 
@@ -962,9 +971,34 @@ class ExtTreeView():
                 if sortCol:
                     column.set_sort_column_id(modelId)
                 dataTreeview.append_column(column)
+                self.columns[modelId] = column
 
             i += 1
 
+    # Caricamento veloce di un ListStore: sgancia il modello dalle treeview indicate, sospende l'ordinamento
+    # e inserisce ogni riga (tupla con i valori di tutte le colonne, nell'ordine del modello) con una sola
+    # chiamata a insert_with_valuesv, invece di append() seguito da un set_value per colonna.
+    # Ritorna gli iter delle righe inserite (persistenti in un ListStore)
+    @staticmethod
+    def bulkLoad(model, rows, treeviews=(), clear=True):
+        attached = [treeview.get_model() for treeview in treeviews]
+        for treeview in treeviews:
+            treeview.set_model(None)
+        (sortId, sortOrder) = model.get_sort_column_id()
+        if sortId is not None:
+            model.set_sort_column_id(Gtk.TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID, Gtk.SortType.ASCENDING)
+        try:
+            if clear:
+                model.clear()
+            # append(row) di PyGObject converte la tupla ed esegue un solo insert_with_valuesv
+            iterators = [model.append(row) for row in rows]
+        finally:
+            if sortId is not None:
+                model.set_sort_column_id(sortId, sortOrder)
+            for treeview, attachedModel in zip(treeviews, attached):
+                treeview.set_model(attachedModel)
+        return iterators
+
     # Funzione ordinamento date
     def __sort_date_func(self, model, iter1, iter2, user_data=None):
         sort_column, _ = model.get_sort_column_id()
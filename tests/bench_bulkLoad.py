@@ -0,0 +1,63 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+# Caricamento del listino (5000 righe) in un ListStore ordinato e collegato a due treeview:
+# append() seguito da un set_value per colonna, contro ExtTreeView.bulkLoad.
+# Richiede Gtk 3 e un display, ad es.: xvfb-run python tests/bench_bulkLoad.py
+
+import datetime
+import time
+import unittest
+
+try:
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk
+    from tabacchi import utility
+except (ImportError, ValueError) as e:
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+RIGHE = 5000
+RIPETIZIONI = 5
+
+# Stesse colonne del listino (TabacchiDialog.MODEL_INFO_LIST)
+MODEL_INFO_LIST = [("*Magazzino", "bool"), (None, "str"), ("^!+Descrizione", "str"), ("^Tipo", "str"), (None, "currency"),
+                   ("^Decorrenza", "date"), (None, "float"), ("*Pezzi", "int#3,0"), ("Unità min.", "float"), ("Prezzo Kg", "currency"),
+                   (None, "str"), (None, "bool")]
+
+rows = [(i % 3 == 0, str(10000 + i), f"ARTICOLO {RIGHE - i:05d} *CART20", "SIGARETTE", 5.5, datetime.datetime(2021, 1, 1), 0.4, 10,
+         0.2, 275.0, "", False) for i in range(RIGHE)]
+
+
+def appendSetValue(model, treeviews):
+    model.clear()
+    for row in rows:
+        iterator = model.append()
+        for col, value in enumerate(row):
+            model.set_value(iterator, col, value)
+
+
+def bulkLoad(model, treeviews):
+    utility.ExtTreeView.bulkLoad(model, rows, treeviews=treeviews)
+
+
+def main():
+    listinoTreeView = Gtk.TreeView()
+    utility.ExtTreeView(MODEL_INFO_LIST, listinoTreeView)
+    model = listinoTreeView.get_model()
+    model.set_sort_column_id(2, Gtk.SortType.ASCENDING)
+    magazzinoTreeView = Gtk.TreeView(model=model.filter_new())
+    treeviews = (listinoTreeView, magazzinoTreeView)
+
+    for func in (appendSetValue, bulkLoad):
+        tempi = []
+        for _ in range(RIPETIZIONI):
+            start = time.perf_counter()
+            func(model, treeviews)
+            tempi.append(time.perf_counter() - start)
+        print(f"{func.__name__:15} {len(model)} righe: min {min(tempi) * 1000:.1f} ms, media {sum(tempi) / len(tempi) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+# Lettura di un catalogo Logista sintetico (60000 righe) nei tre formati con catalogoLogista.articoli,
+# confrontata con il vecchio ciclo su xlrd (cell_value per ogni cella): righe al secondo e picco di memoria.
+# Uso: python tests/bench_catalogoLogista.py [righe]
+
+import csv
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+from pathlib import Path
+
+try:
+    import openpyxl
+    import xlrd
+    import xlwt
+    from tabacchi import catalogoLogista
+except (ImportError, ValueError) as e:
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+RIGHE = 60000
+RIPETIZIONI = 3
+INTESTAZIONE = ["Codice AAMS", "Marca", "Descrizione", "Tipologia", "Unità minima", "Prezzo Kg", "Prezzo confezione", "Decorrenza"]
+
+
+def genera(dir, n):
+    random.seed(0)
+    date = ["%02d/%02d/2020" % (giorno, mese) for giorno in range(1, 29) for mese in range(1, 4)]
+    righe = [[str(10000 + i), "", f"ARTICOLO {i} *20GR", "SIGARETTE", random.choice([0.2, 0.4, 1.0]), round(random.uniform(100, 400), 2), "",
+              random.choice(date)] for i in range(n)]
+
+    book = xlwt.Workbook()
+    sheet = book.add_sheet("Listino")
+    for r, row in enumerate([INTESTAZIONE] + righe):
+        for c, value in enumerate(row):
+            sheet.write(r, c, value)
+    book.save(str(dir / "catalogo.xls"))
+
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    for row in [INTESTAZIONE] + righe:
+        sheet.append(row)
+    book.save(dir / "catalogo.xlsx")
+
+    with open(dir / "catalogo.csv", "w", newline="", encoding="cp1252") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(INTESTAZIONE)
+        for row in righe:
+            writer.writerow([str(value).replace(".", ",") if isinstance(value, float) else value for value in row])
+
+
+# Lettura come prima di catalogoLogista: tutto il foglio in memoria e una chiamata per cella
+def vecchioXlrd(pathname):
+    book = xlrd.open_workbook(pathname)
+    sheet = book.sheet_by_index(0)
+    for row in range(1, sheet.nrows):
+        yield (sheet.cell_value(row, 0).strip(), sheet.cell_value(row, 2).strip(), sheet.cell_value(row, 3).strip(),
+               float(sheet.cell_value(row, 4)), float(sheet.cell_value(row, 5)), sheet.cell_value(row, 7).strip())
+
+
+# Miglior tempo su RIPETIZIONI letture complete e picco di memoria in una lettura a parte
+# (tracemalloc rallenta molto l'esecuzione)
+def misura(func, pathname):
+    tempi = []
+    for _ in range(RIPETIZIONI):
+        start = time.perf_counter()
+        n = sum(1 for _ in func(pathname))
+        tempi.append(time.perf_counter() - start)
+    tracemalloc.start()
+    sum(1 for _ in func(pathname))
+    picco = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (n, min(tempi), picco)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else RIGHE
+    with tempfile.TemporaryDirectory() as tmpDir:
+        dir = Path(tmpDir)
+        genera(dir, n)
+        for nome, func, pathname in (("vecchio xlrd", vecchioXlrd, dir / "catalogo.xls"),
+                                     ("xls", catalogoLogista.articoli, dir / "catalogo.xls"),
+                                     ("xlsx", catalogoLogista.articoli, dir / "catalogo.xlsx"),
+                                     ("csv", catalogoLogista.articoli, dir / "catalogo.csv")):
+            righe, elapsed, picco = misura(func, pathname)
+            print(f"{nome:14} {righe} righe: {righe / elapsed:10,.0f} righe/s, picco {picco / 1e6:5.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+# Lettura del listino e dell'elenco ordini con repository.fetchRows (connessione raw e FastRow),
+# confrontata con sqlite3.Row e i converter di detect_types usati prima: righe al secondo,
+# leggendo ogni colonna di ogni riga. DB demo con 520 ordini settimanali (10 anni).
+# Uso, dalla directory del progetto: PYTHONPATH=. python tests/bench_fastRow.py [ripetizioni]
+
+import datetime
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+try:
+    from tabacchi import repository
+    from tabacchi import schema
+except (ImportError, ValueError) as e:
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+DEMO_DB = Path(__file__).resolve().parent.parent / "tabacchi" / "demo" / "tabacchi.sqlite"
+ORDINI = 520
+RIPETIZIONI = 50
+
+LISTINO_COLONNE = ["ID", "Descrizione", "UnitaMin", "PrezzoKg", "Tipo", "InMagazzino", "LivelloMin", "Decorrenza", "PezziUnitaMin", "Barcode"]
+LISTINO_ROW = ("SELECT ID, Descrizione, UnitaMin, PrezzoKg, Tipo, InMagazzino, LivelloMin, Decorrenza as 'Decorrenza [date]', PezziUnitaMin, Barcode "
+               "FROM tabacchi order by Tipo desc, Descrizione")
+LISTINO = f"SELECT {', '.join(LISTINO_COLONNE)} FROM tabacchi order by Tipo desc, Descrizione"
+LISTINO_DATE = {'Decorrenza': 'date'}
+
+ORDINI_COLONNE = ["ID", "Data", "Levata", "Costo", "Ordine", "Stato", "Suppletivo", "DataSuppletivo"]
+ORDINI_ROW = ('SELECT O.ID as ID, O.Data as "Data [timestamp]", O.Levata as "Levata [date]", S.Importo as Costo, S.Peso as Ordine, O.Stato as Stato, '
+              'O.Suppletivo as Suppletivo, O.DataSuppletivo as "DataSuppletivo [date]" FROM ordineTabacchi O left join ordineSummary S on S.ID_Ordine = O.ID '
+              'order by O.Data desc')
+ORDINI_QUERY = ('SELECT O.ID as ID, O.Data as Data, O.Levata as Levata, S.Importo as Costo, S.Peso as Ordine, O.Stato as Stato, O.Suppletivo as Suppletivo, '
+                'O.DataSuppletivo as DataSuppletivo FROM ordineTabacchi O left join ordineSummary S on S.ID_Ordine = O.ID order by O.Data desc')
+ORDINI_DATE = {'Data': 'timestamp', 'Levata': 'date', 'DataSuppletivo': 'date'}
+
+
+# Copia del DB demo aggiornata all'ultimo schema, con ORDINI ordini settimanali senza righe
+def prepara(pathname):
+    shutil.copy(DEMO_DB, pathname)
+    conn = sqlite3.connect(pathname)
+    try:
+        schema.migrate(conn)
+        for table in ("verificaOrdine", "rigaOrdineSuppletivo", "rigaOrdineTabacchi", "ordineTabacchi"):
+            conn.execute(f"DELETE FROM {table}")
+        inizio = datetime.datetime(2012, 1, 2, 16)
+        conn.executemany("INSERT INTO ordineTabacchi(ID, Data, Levata, Stato) VALUES(?, ?, ?, 2)",
+                         ((i + 1, str(inizio + datetime.timedelta(weeks=i)), str((inizio + datetime.timedelta(weeks=i, days=3)).date())) for i in range(ORDINI)))
+        repository.rebuildOrdineSummary(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Come prima: sqlite3.Row con la conversione delle date in ogni riga letta
+def leggiRow(conn, sql, colonne, dates):
+    rows = conn.execute(sql).fetchall()
+    for row in rows:
+        for colonna in colonne:
+            row[colonna]
+    return len(rows)
+
+
+def leggiFastRow(conn, sql, colonne, dates):
+    rows = repository.fetchRows(conn.cursor(), sql, dates=dates)
+    for row in rows:
+        for colonna in colonne:
+            row[colonna]
+    return len(rows)
+
+
+# Righe al secondo su n letture, dopo una lettura a vuoto
+def misura(func, conn, sql, colonne, dates, n):
+    func(conn, sql, colonne, dates)
+    righe = 0
+    start = time.perf_counter()
+    for _ in range(n):
+        righe += func(conn, sql, colonne, dates)
+    return righe / (time.perf_counter() - start)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else RIPETIZIONI
+    with tempfile.TemporaryDirectory() as tmpDir:
+        pathname = str(Path(tmpDir) / "tabacchi.sqlite")
+        prepara(pathname)
+        conn = sqlite3.connect(pathname, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn.row_factory = sqlite3.Row
+        rawConn = sqlite3.connect(pathname)
+        try:
+            for nome, sqlRow, sql, colonne, dates in (("listino", LISTINO_ROW, LISTINO, LISTINO_COLONNE, LISTINO_DATE),
+                                                      ("ordini", ORDINI_ROW, ORDINI_QUERY, ORDINI_COLONNE, ORDINI_DATE)):
+                # Stessi valori letti nei due modi
+                attesi = [tuple(row[colonna] for colonna in colonne) for row in conn.execute(sqlRow)]
+                letti = [tuple(row[colonna] for colonna in colonne) for row in repository.fetchRows(rawConn.cursor(), sql, dates=dates)]
+                assert attesi == letti, f"{nome}: valori diversi"
+                row = misura(leggiRow, conn, sqlRow, colonne, dates, n)
+                fastRow = misura(leggiFastRow, rawConn, sql, colonne, dates, n)
+                print(f"{nome:8} {len(attesi):5} righe: sqlite3.Row {row:9,.0f} righe/s, FastRow {fastRow:9,.0f} righe/s ({fastRow / row:.2f}x)")
+        finally:
+            conn.close()
+            rawConn.close()
+
+
+if __name__ == "__main__":
+    main()
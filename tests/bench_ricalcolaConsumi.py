@@ -0,0 +1,122 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+# Ricalcolo dei consumi su un DB sintetico (2000 articoli x 250 ordini = 500000 righe) con
+# repository.ricalcolaConsumi, confrontato con il vecchio ciclo che aggiornava una riga alla volta.
+# Il vecchio ciclo è misurato senza l'idle_add per la barra di avanzamento che pagava nel programma.
+# Uso, dalla directory del progetto: PYTHONPATH=. python tests/bench_ricalcolaConsumi.py [articoli] [ordini]
+
+import datetime
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+try:
+    from tabacchi import repository
+    from tabacchi import schema
+except (ImportError, ValueError) as e:
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+ARTICOLI = 2000
+ORDINI = 250
+
+
+# DB all'ultimo schema con un ordine ogni due settimane e una riga per articolo in ogni ordine, consumi a zero
+def genera(pathname, articoli, ordini):
+    random.seed(1)
+    conn = sqlite3.connect(pathname)
+    try:
+        schema.migrate(conn)
+        inizio = datetime.datetime(2010, 1, 1, 10)
+        conn.executemany("INSERT INTO ordineTabacchi(ID, Data) VALUES(?, ?)", ((i + 1, str(inizio + datetime.timedelta(days=14 * i))) for i in range(ordini)))
+        conn.executemany("INSERT INTO rigaOrdineTabacchi(ID, Descrizione, ID_Ordine, Ordine, Prezzo, Giacenza, Consumo) VALUES(?, 'ARTICOLO', ?, ?, 1.0, ?, 0)",
+                         ((f"{a:05d}", o + 1, round(random.random(), 3), round(random.random() * 2, 3)) for a in range(articoli) for o in range(ordini)))
+        conn.execute("DELETE FROM consumiDirty")
+        conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+# Come prima in RicalcolaConsumiThread: tutte le righe lette in Python e un UPDATE per riga
+def vecchioCiclo(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT r.ID, r.Ordine, r.Giacenza, r.ID_Ordine FROM rigaOrdineTabacchi r, ordineTabacchi o where r.ID_Ordine = o.ID order by r.ID, r.ID_Ordine")
+    oldId = None
+    oldPeso = 0
+    oldQuantita = 0
+    aggiornate = 0
+    for row in cursor.fetchall():
+        peso = round(row["Ordine"], 3)
+        quantita = round(row["Giacenza"], 3)
+        if row["ID"] != oldId:
+            oldPeso = 0
+            oldQuantita = 0
+        consumo = round((oldQuantita + oldPeso) - quantita, 3)
+        cursor.execute("update rigaOrdineTabacchi set Consumo = ? where ID = ? and ID_Ordine = ?", (consumo, row["ID"], row["ID_Ordine"]))
+        aggiornate += 1
+        oldPeso = peso
+        oldQuantita = quantita
+        oldId = row["ID"]
+    return aggiornate
+
+
+def ricalcola(conn):
+    return repository.ricalcolaConsumi(conn.cursor())
+
+
+# UPDATE correlato usato con SQLite precedente alla 3.33
+def ricalcolaSenzaUpdateFrom(conn):
+    with mock.patch.object(repository, "sqlite3", mock.Mock(sqlite_version_info=(3, 31, 1))):
+        return ricalcola(conn)
+
+
+def consumi(conn):
+    return conn.execute("SELECT ID, ID_Ordine, Consumo FROM rigaOrdineTabacchi ORDER BY ID, ID_Ordine").fetchall()
+
+
+def main():
+    articoli = int(sys.argv[1]) if len(sys.argv) > 1 else ARTICOLI
+    ordini = int(sys.argv[2]) if len(sys.argv) > 2 else ORDINI
+    with tempfile.TemporaryDirectory() as tmpDir:
+        originale = str(Path(tmpDir) / "originale.sqlite")
+        pathname = str(Path(tmpDir) / "tabacchi.sqlite")
+        genera(originale, articoli, ordini)
+        print(f"{articoli} articoli x {ordini} ordini = {articoli * ordini} righe, SQLite {sqlite3.sqlite_version}")
+
+        risultati = {}
+        for nome, func, ripeti in (("vecchio ciclo", vecchioCiclo, False),
+                                   ("ricalcolaConsumi", ricalcola, False),
+                                   ("senza UPDATE FROM", ricalcolaSenzaUpdateFrom, False),
+                                   ("nessuna modifica", ricalcola, True)):
+            shutil.copy(originale, pathname)
+            conn = sqlite3.connect(pathname)
+            conn.row_factory = sqlite3.Row
+            try:
+                if ripeti:
+                    # Secondo ricalcolo, con i consumi già aggiornati
+                    ricalcola(conn)
+                    conn.commit()
+                start = time.perf_counter()
+                aggiornate = func(conn)
+                conn.commit()
+                elapsed = time.perf_counter() - start
+                risultati[nome] = [tuple(row) for row in consumi(conn)]
+            finally:
+                conn.close()
+            print(f"{nome:18} {elapsed:6.2f} s, {aggiornate} righe aggiornate")
+
+        # Con le date degli ordini nello stesso ordine degli ID i risultati devono coincidere
+        for nome in risultati:
+            assert risultati[nome] == risultati["vecchio ciclo"], f"{nome}: consumi diversi dal vecchio ciclo"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import csv
+import datetime
+import hashlib
+import http.server
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+try:
+    import xlwt
+    from tabacchi import catalogoLogista
+except (ImportError, ValueError) as e:
+    # Servono Gtk, xlrd e le altre dipendenze dell'applicazione
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Colonne del foglio Logista (codice in 0, descrizione in 2, ..., decorrenza in 7)
+INTESTAZIONE = ["Codice AAMS", "Marca", "Descrizione", "Tipologia", "Unità minima", "Prezzo Kg", "Prezzo confezione", "Decorrenza"]
+RIGHE = [
+    ["10001", "MARLBORO", "MARLBORO GOLD *CART20", "SIGARETTE", "0.2", "275.00", "55.00", "01/01/2021"],
+    ["10002", "TOSCANO", "TOSCANO CLASSICO *AST10", "SIGARI", "0.020", "1234.50", "24.69", "15/02/2021"],
+    ["", "", "RIGA SENZA CODICE", "", "", "", "", ""],
+]
+ARTICOLI = [
+    catalogoLogista.ArticoloCatalogo("10001", "MARLBORO GOLD *CART20", "SIGARETTE", 0.2, 275.0, datetime.date(2021, 1, 1)),
+    catalogoLogista.ArticoloCatalogo("10002", "TOSCANO CLASSICO *AST10", "SIGARI", 0.02, 1234.5, datetime.date(2021, 2, 15)),
+]
+
+
+# Le stesse righe come le esporta Excel in italiano: virgola decimale e punto per le migliaia
+RIGHE_ITALIANO = [
+    ["10001", "MARLBORO", "MARLBORO GOLD *CART20", "SIGARETTE", "0,2", "275,00", "55,00", "01/01/2021"],
+    ["10002", "TOSCANO", "TOSCANO CLASSICO *AST10", "SIGARI", "0,020", "1.234,50", "24,69", "15/02/2021"],
+    ["", "", "RIGA SENZA CODICE", "", "", "", "", ""],
+]
+
+
+def scriviCsv(pathname, righe, delimiter, encoding):
+    with open(pathname, "w", newline="", encoding=encoding) as f:
+        csv.writer(f, delimiter=delimiter).writerows([INTESTAZIONE] + righe)
+
+
+def catalogoCsv():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        pathname = Path(tmpDir) / "catalogo.csv"
+        scriviCsv(pathname, RIGHE_ITALIANO, ";", "cp1252")
+        return pathname.read_bytes()
+
+
+CATALOGO = catalogoCsv()
+
+
+class ArticoliTest(unittest.TestCase):
+    def setUp(self):
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        self.dir = Path(tmpDir.name)
+
+    def test_numeri(self):
+        # Il nome nel modulo non subisce il name mangling, ma catalogoLogista.__numero nella classe sì
+        numero = getattr(catalogoLogista, "__numero")
+        self.assertEqual(numero("1.234,5"), 1234.5)
+        self.assertEqual(numero("0,2"), 0.2)
+        self.assertEqual(numero("0.020"), 0.02)
+        self.assertEqual(numero("123.50"), 123.5)
+        self.assertEqual(numero(" 275 "), 275.0)
+        self.assertEqual(numero(0.4), 0.4)
+        self.assertEqual(numero(""), 0.0)
+        self.assertEqual(numero(None), 0.0)
+
+    def test_xls(self):
+        pathname = self.dir / "catalogo.xls"
+        book = xlwt.Workbook()
+        sheet = book.add_sheet("Listino")
+        for r, row in enumerate([INTESTAZIONE] + RIGHE):
+            for c, value in enumerate(row):
+                # Nel foglio xls unità minima e prezzo sono celle numeriche
+                sheet.write(r, c, float(value) if (r > 0) and (c in (4, 5, 6)) and value else value)
+        book.save(str(pathname))
+        self.assertEqual(catalogoLogista.formato(pathname), catalogoLogista.XLS)
+        self.assertEqual(list(catalogoLogista.articoli(pathname)), ARTICOLI)
+
+    @unittest.skipIf(openpyxl is None, "openpyxl non installato")
+    def test_xlsx(self):
+        pathname = self.dir / "catalogo.xlsx"
+        book = openpyxl.Workbook()
+        for r, row in enumerate([INTESTAZIONE] + RIGHE):
+            book.active.append([float(value) if (r > 0) and (c in (4, 5, 6)) and value else value for c, value in enumerate(row)])
+        book.save(pathname)
+        self.assertEqual(catalogoLogista.formato(pathname), catalogoLogista.XLSX)
+        self.assertEqual(list(catalogoLogista.articoli(pathname)), ARTICOLI)
+
+    def test_csv_italiano(self):
+        pathname = self.dir / "catalogo.csv"
+        pathname.write_bytes(CATALOGO)
+        self.assertEqual(catalogoLogista.formato(pathname), catalogoLogista.CSV)
+        self.assertEqual(list(catalogoLogista.articoli(pathname)), ARTICOLI)
+
+    def test_csv_punto_decimale(self):
+        pathname = self.dir / "catalogo.csv"
+        scriviCsv(pathname, RIGHE, ",", "utf-8")
+        self.assertEqual(catalogoLogista.formato(pathname), catalogoLogista.CSV)
+        self.assertEqual(list(catalogoLogista.articoli(pathname)), ARTICOLI)
+
+    def test_righe_incomplete(self):
+        pathname = self.dir / "catalogo.csv"
+        scriviCsv(pathname, [row[:6] for row in RIGHE], ";", "utf-8")
+        self.assertEqual(list(catalogoLogista.articoli(pathname)), [])
+
+
+# Serve il catalogo con un ETag e risponde 304 se il client ha già quella versione
+class CatalogoHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.richieste.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProgressDialog:
+    def setSteps(self, steps):
+        pass
+
+    def updateProgress(self):
+        pass
+
+    def close(self, thread):
+        return False
+
+
+class DownloadCatalogoTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), CatalogoHandler)
+        self.server.etag = '"v1"'
+        self.server.body = CATALOGO
+        self.server.richieste = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/catalogo.csv"
+
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        cacheDir = Path(tmpDir.name) / "catalogo"
+        for name, value in (("CACHE_DIR", cacheDir), ("METADATI_PATHNAME", cacheDir / "catalogo.json")):
+            patcher = mock.patch.object(catalogoLogista, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def download(self):
+        thread = catalogoLogista.DownloadCatalogoThread(self.url)
+        thread.setProgressDialog(FakeProgressDialog())
+        thread.run()
+        self.assertEqual(thread.status, thread.DONE, thread.error)
+        return thread
+
+    def test_download(self):
+        thread = self.download()
+        self.assertNotIn("If-None-Match", self.server.richieste[0])
+        self.assertEqual(thread.pathname.read_bytes(), CATALOGO)
+        self.assertEqual(thread.pathname.suffix, ".csv")
+        self.assertEqual(thread.sha256, hashlib.sha256(CATALOGO).hexdigest())
+        self.assertTrue(thread.modificato)
+        self.assertEqual(list(catalogoLogista.articoli(thread.pathname)), ARTICOLI)
+
+    def test_non_modificato(self):
+        primo = self.download()
+        secondo = self.download()
+        self.assertEqual(self.server.richieste[1].get("If-None-Match"), '"v1"')
+        self.assertEqual(secondo.pathname, primo.pathname)
+        self.assertEqual(secondo.sha256, primo.sha256)
+        # Non ancora applicato al DB
+        self.assertTrue(secondo.modificato)
+
+        catalogoLogista.segnaApplicato(primo.sha256)
+        self.assertFalse(self.download().modificato)
+
+    def test_stesso_hash(self):
+        # Nuovo ETag ma contenuto identico: il file viene riscaricato ma non c'è niente da applicare
+        primo = self.download()
+        catalogoLogista.segnaApplicato(primo.sha256)
+        self.server.etag = '"v2"'
+        secondo = self.download()
+        self.assertEqual(len(self.server.richieste), 2)
+        self.assertEqual(secondo.sha256, primo.sha256)
+        self.assertFalse(secondo.modificato)
+
+        self.server.body = CATALOGO.replace(b"275,00", b"280,00")
+        self.server.etag = '"v3"'
+        self.assertTrue(self.download().modificato)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import contextlib
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+try:
+    from tabacchi import config
+    from tabacchi import ordini
+except (ImportError, ValueError) as e:
+    # Servono Gtk e le altre dipendenze dell'applicazione
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+ID_ORDINE = 7
+ARTICOLI = [{"ID": "10001", "Descrizione": "MARLBORO GOLD", "PrezzoKg": 275.0, "UnitaMin": 0.2, "LivelloMin": 0.4},
+            {"ID": "10002", "Descrizione": "TOSCANO CLASSICO", "PrezzoKg": 1234.5, "UnitaMin": 0.02, "LivelloMin": 0.04}]
+
+
+# Preferenze con il solo DB delle righe d'ordine; con guasto = True le transazioni falliscono
+class FakePrefs:
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(pathname)
+        self.conn.execute("CREATE TABLE rigaOrdineTabacchi (ID TEXT NOT NULL, Descrizione TEXT NOT NULL, ID_Ordine INTEGER NOT NULL, "
+                          "Ordine REAL NOT NULL DEFAULT (0), Prezzo REAL NOT NULL DEFAULT (0), Giacenza REAL NOT NULL DEFAULT (0), "
+                          "Consumo REAL NOT NULL DEFAULT (0), PRIMARY KEY (ID, ID_Ordine))")
+        self.guasto = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.guasto:
+            raise sqlite3.OperationalError("database is locked")
+        cursor = self.conn.cursor()
+        try:
+            yield cursor
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def setDBDirty(self):
+        pass
+
+    def righe(self):
+        return {row[0]: row[1:] for row in self.conn.execute("SELECT ID, Ordine, Giacenza FROM rigaOrdineTabacchi WHERE ID_Ordine = ?", (ID_ORDINE,))}
+
+
+class JournalOrdineTest(unittest.TestCase):
+    def setUp(self):
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        self.prefs = FakePrefs(str(Path(tmpDir.name) / "tabacchi.sqlite"))
+        self.addCleanup(self.prefs.conn.close)
+        for patcher in (mock.patch.object(config, "user_data_dir", Path(tmpDir.name)),
+                        mock.patch.object(ordini, "prefs", self.prefs),
+                        mock.patch.object(ordini.consumi, "aggiorna"),
+                        mock.patch.object(ordini.utility, "gtkErrorMsg"),
+                        mock.patch.object(ordini.GLib, "timeout_add_seconds"),
+                        mock.patch.object(ordini.GLib, "source_remove")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Solo lo stato usato da modifica e __flush, senza costruire la finestra
+    def apri(self):
+        dialog = ordini.OrdineDialog.__new__(ordini.OrdineDialog)
+        dialog.ordineID = ID_ORDINE
+        dialog.tabacchiList = ARTICOLI
+        dialog.ordineDict = {}
+        dialog.ordinePrecDict = {}
+        dialog.mainTotal = 0
+        dialog.pendenti = {}
+        dialog.flushTimeout = None
+        dialog.ordineDialog = None
+        dialog.journal = ordini.JournalOrdine(ID_ORDINE)
+        dialog._OrdineDialog__ripristinaJournal()
+        return dialog
+
+    def chiudi(self, dialog):
+        dialog._OrdineDialog__flush()
+        dialog.journal.close()
+
+    def test_flush_non_riuscito(self):
+        self.prefs.guasto = True
+        dialog = self.apri()
+        dialog.modifica(0, 0.2, 0.4)
+        self.chiudi(dialog)
+        self.assertEqual(self.prefs.righe(), {})
+        self.assertTrue(dialog.journal.pathname.exists())
+
+        # Riaperto l'ordine, la modifica non scritta torna tra quelle da scrivere
+        self.prefs.guasto = False
+        dialog = self.apri()
+        self.assertIn("10001", dialog.pendenti)
+        self.assertEqual(dialog.ordineDict["10001"][dialog.ID_ORDINE], 0.4)
+        self.assertAlmostEqual(dialog.mainTotal, 0.4 * 275.0)
+        dialog.modifica(1, 0.02, 0.04)
+        self.chiudi(dialog)
+
+        self.assertEqual(self.prefs.righe(), {"10001": (0.4, 0.2), "10002": (0.04, 0.02)})
+        self.assertFalse(dialog.journal.pathname.exists())
+
+    def test_journal_assente(self):
+        dialog = self.apri()
+        self.assertEqual(dialog.pendenti, {})
+        self.assertTrue(dialog._OrdineDialog__flush())
+
+
+class SuggeritoTest(unittest.TestCase):
+    def suggerito(self, index, quantita, previsioni):
+        dialog = ordini.OrdineDialog.__new__(ordini.OrdineDialog)
+        dialog.tabacchiList = ARTICOLI
+        dialog.previsioni = previsioni
+        return dialog._OrdineDialog__suggerito(index, quantita)
+
+    def test_senza_previsione(self):
+        # Come prima delle previsioni: livello minimo meno giacenza, senza arrotondare all'unità minima
+        self.assertEqual(self.suggerito(0, 0.1, {}), 0.3)
+        self.assertEqual(self.suggerito(0, 0.5, {}), 0)
+        # Previsione sotto il livello minimo: non viene usata
+        self.assertEqual(self.suggerito(0, 0.1, {"10001": 0.35}), 0.3)
+
+    def test_con_previsione(self):
+        # Consumo previsto oltre il livello minimo, arrotondato per eccesso all'unità minima
+        self.assertEqual(self.suggerito(0, 0.1, {"10001": 0.75}), 0.8)
+        self.assertEqual(self.suggerito(1, 0.0, {"10002": 0.05}), 0.06)
+
+
+if __name__ == "__main__":
+    unittest.main()
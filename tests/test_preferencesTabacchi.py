@@ -0,0 +1,108 @@
+#
+# Copyright (C) Francesco Guarnieri 2020 <francesco@guarnie.net>
+#
+
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+try:
+    from tabacchi import preferencesTabacchi
+    from tabacchi import sqltrace
+except (ImportError, ValueError) as e:
+    # Servono Gtk, keyring, bluetooth e le altre dipendenze dell'applicazione
+    raise unittest.SkipTest(f"dipendenze mancanti: {e}")
+
+
+class ConnectionManagerTest(unittest.TestCase):
+    def setUp(self):
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        self.connectionManager = preferencesTabacchi.ConnectionManager(str(Path(tmpDir.name) / "tabacchi.sqlite"))
+        self.addCleanup(self.connectionManager.release)
+
+        conn = self.connectionManager.getConn()
+        try:
+            conn.execute("CREATE TABLE tabacchi (ID TEXT PRIMARY KEY, Descrizione TEXT)")
+            conn.execute("INSERT INTO tabacchi VALUES ('1', 'MARLBORO GOLD')")
+            conn.commit()
+        finally:
+            conn.close()
+        # Le connessioni successive sono aperte con il tracing attivo
+        self.connectionManager.release()
+        self.tracer = sqltrace.Tracer(threshold=10)
+        self.connectionManager.tracer = self.tracer
+
+    def test_tracing_row_factory(self):
+        conn = self.connectionManager.getConn()
+        try:
+            cursor = conn.cursor()
+            self.assertIsInstance(cursor, sqltrace.TracingCursor)
+            row = cursor.execute("SELECT ID, Descrizione FROM tabacchi").fetchone()
+            cursor.close()
+            self.assertIsInstance(row, sqlite3.Row)
+            self.assertEqual(row["Descrizione"], "MARLBORO GOLD")
+
+            # Anche conn.execute passa dal cursore che misura gli statement
+            rows = [row["ID"] for row in conn.execute("SELECT ID FROM tabacchi")]
+            self.assertEqual(rows, ["1"])
+        finally:
+            conn.close()
+        self.assertIn("SELECT ID, Descrizione FROM tabacchi", self.tracer.stats)
+
+    def test_tracing_raw(self):
+        conn = self.connectionManager.getConn(raw=True)
+        try:
+            row = conn.execute("SELECT ID, Descrizione FROM tabacchi").fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(row, ("1", "MARLBORO GOLD"))
+
+
+class ReleaseTest(unittest.TestCase):
+    def setUp(self):
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        self.connectionManager = preferencesTabacchi.ConnectionManager(str(Path(tmpDir.name) / "tabacchi.sqlite"))
+        self.addCleanup(self.connectionManager.release)
+        self.connectionManager.setJournalMode(True, 3600)
+        self.addCleanup(self.connectionManager.stopCheckpoint)
+        with self.connectionManager.transaction() as cursor:
+            cursor.execute("CREATE TABLE tabacchi (ID TEXT PRIMARY KEY, Descrizione TEXT)")
+            cursor.executemany("INSERT INTO tabacchi VALUES (?, ?)", [(str(i), f"ARTICOLO {i}") for i in range(100)])
+
+    # Thread che resta attivo dopo aver usato il DB, come AggiornaConsumiThread tra due richieste
+    def lettore(self, letto, fine):
+        conn = self.connectionManager.getConn()
+        cursor = conn.execute("SELECT * FROM tabacchi")
+        cursor.fetchone()
+        cursor.close()
+        conn.close()
+        self.connectionManager.release()
+        letto.set()
+        fine.wait()
+
+    def test_chiusura_con_thread_attivo(self):
+        letto = threading.Event()
+        fine = threading.Event()
+        thread = threading.Thread(target=self.lettore, args=(letto, fine))
+        thread.start()
+        try:
+            letto.wait()
+            with self.connectionManager.transaction() as cursor:
+                cursor.execute("UPDATE tabacchi SET Descrizione = 'MARLBORO GOLD' WHERE ID = '1'")
+            # Come closeConn: alla chiusura dell'ultima connessione SQLite trasferisce il WAL nel DB e lo elimina
+            self.connectionManager.stopCheckpoint()
+            busy, _, _ = self.connectionManager.checkpoint("TRUNCATE")
+            self.connectionManager.release()
+            self.assertEqual(busy, 0)
+            self.assertFalse(Path(f"{self.connectionManager.pathname}-wal").exists())
+        finally:
+            fine.set()
+            thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()